@@ -14,6 +14,9 @@ setup(
     package_dir={ 'speedy' : 'speedy' },
     packages=['speedy'],
     install_requires=['pyzmq'],
+    entry_points={
+      'console_scripts' : [ 'speedy-bench = speedy.bench:main' ],
+    },
     long_description='''
 Speedy - A Fast RPC System for Python
 =====================================
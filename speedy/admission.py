@@ -0,0 +1,215 @@
+'''
+Admission control and scheduling for servers.
+
+An :class:`Admission` bounds the number of requests a `Server` runs at
+once: in total (``config.server_max_inflight``), and per method (see
+``Server.limit``).  Requests over the limit wait in a queue of at most
+``config.server_max_queue`` requests, and are started as running ones
+finish.  When the queue is full, ``config.server_overload_policy``
+decides what happens to new requests:
+
+* ``reject``: reply with an `Overloaded` error, which callers may retry
+  (`PoolClient` does, for idempotent methods).
+* ``pause``: queue the request, and stop reading from the server socket
+  until the queue is half empty.  Requests back up in zeromq, whose high
+  water marks then push back on the clients.
+
+Queued requests are scheduled by priority class (`HIGH`, `NORMAL` or
+`LOW`; see ``Server.priority``): a request only runs when no request of
+a higher class is waiting.  Within a class, clients (the ``source`` of
+their requests) get a fair share of the server, in proportion to their
+weight (see ``Server.weight``), whatever the number of requests each
+has queued.  ``config.server_reserved_inflight`` of the running slots
+are kept for `HIGH` requests, and the queue limit does not apply to
+them, so control RPCs stay responsive while bulk requests saturate the
+server.
+
+Scheduling only reorders queued requests: with a thread pool, set
+``config.server_max_inflight`` to (about) the number of threads, so
+that requests wait here rather than in the pool's own queue.
+'''
+import collections
+import heapq
+import itertools
+import threading
+
+POLICIES = ('reject', 'pause')
+
+# results of `Admission.submit`
+RUN = 'run'
+QUEUED = 'queued'
+REJECTED = 'rejected'
+
+# priority classes, highest first
+HIGH = 0
+NORMAL = 1
+LOW = 2
+CLASSES = (HIGH, NORMAL, LOW)
+
+# reserved RPCs of `Server`
+DEFAULT_PRIORITIES = { 'diediedie' : HIGH, '_stats' : HIGH }
+
+
+class _FairQueue(object):
+  '''Requests of one priority class, in start-time fair queuing order.
+
+  Each request is tagged with a virtual start time: the later of the
+  current virtual time and the tag of the previous request from the same
+  source, plus ``1 / weight``.  Requests run in tag order.
+  '''
+  def __init__(self):
+    self._heap = []
+    self._seq = itertools.count()
+    self._vtime = 0.0
+    # source -> tag of its last queued request
+    self._last = {}
+
+  def __len__(self):
+    return len(self._heap)
+
+  def push(self, source, weight, method, item):
+    tag = max(self._vtime, self._last.get(source, 0.0)) + 1.0 / weight
+    self._last[source] = tag
+    heapq.heappush(self._heap, (tag, self._seq.next(), method, item))
+
+  def pop(self, can_run):
+    '''Remove and return (method, item) for the first request for which
+    ``can_run(method)``, or None.'''
+    heap = self._heap
+    if not heap:
+      return None
+    if can_run(heap[0][2]):
+      entry = heapq.heappop(heap)
+    else:
+      # blocked by its method limit: look further down
+      entry = next((e for e in sorted(heap) if can_run(e[2])), None)
+      if entry is None:
+        return None
+      heap.remove(entry)
+      heapq.heapify(heap)
+
+    self._vtime = entry[0]
+    if not heap:
+      self._last.clear()
+    return entry[2], entry[3]
+
+
+class Admission(object):
+  '''Counts running requests, and queues those over the limits.'''
+  def __init__(self, socket, max_inflight=0, max_queue=0, policy='reject', reserved=0):
+    '''
+    :param socket: the server socket, paused by the ``pause`` policy.
+    :param max_inflight: requests running at once (0: no limit).
+    :param max_queue: requests waiting to run.
+    :param policy: ``reject`` or ``pause``.
+    :param reserved: running slots only used by `HIGH` requests.
+    '''
+    assert policy in POLICIES, policy
+    self.socket = socket
+    self.max_inflight = max_inflight
+    self.max_queue = max_queue
+    self.policy = policy
+    self.reserved = reserved
+    # method -> requests of that method running at once
+    self.method_limits = {}
+    # method -> priority class
+    self.priorities = dict(DEFAULT_PRIORITIES)
+    # source -> weight (default 1)
+    self.weights = {}
+    self.inflight = 0
+    self._method_inflight = collections.defaultdict(int)
+    self._queues = [_FairQueue() for c in CLASSES]
+    self._queued = 0
+    self._lock = threading.Lock()
+    self.paused = False
+    self.rejected = 0
+    self.pauses = 0
+    self.peak_queued = 0
+
+  @property
+  def active(self):
+    'Are there any limits to enforce?'
+    return bool(self.max_inflight or self.method_limits)
+
+  def _can_run(self, method, cls=None):
+    if cls is None:
+      cls = self.priorities.get(method, NORMAL)
+    if self.max_inflight:
+      limit = self.max_inflight if cls == HIGH else self.max_inflight - self.reserved
+      if self.inflight >= limit:
+        return False
+    limit = self.method_limits.get(method)
+    return not limit or self._method_inflight[method] < limit
+
+  def _run(self, method):
+    self.inflight += 1
+    self._method_inflight[method] += 1
+
+  def submit(self, method, item, source=None):
+    '''Admit a request for ``method`` from ``source``.
+
+    Returns `RUN` if it may start now, `QUEUED` if ``item`` has been
+    queued (see `next`), or `REJECTED` if the queue is full.
+    '''
+    cls = self.priorities.get(method, NORMAL)
+    with self._lock:
+      if self._can_run(method, cls):
+        self._run(method)
+        return RUN
+
+      if cls != HIGH and self._queued >= self.max_queue:
+        if self.policy == 'reject':
+          self.rejected += 1
+          return REJECTED
+        if not self.paused:
+          self.paused = True
+          self.pauses += 1
+          self.socket.pause_reading()
+
+      self._queues[cls].push(source, self.weights.get(source, 1), method, item)
+      self._queued += 1
+      self.peak_queued = max(self.peak_queued, self._queued)
+      return QUEUED
+
+  def release(self, method):
+    'A request for ``method`` finished.'
+    with self._lock:
+      self.inflight -= 1
+      self._method_inflight[method] -= 1
+
+  def next(self):
+    '''Returns the next queued item which may now run (counting it as
+    running), or None.'''
+    with self._lock:
+      if not self._queued:
+        return None
+      for cls, queue in enumerate(self._queues):
+        if not queue:
+          continue
+        entry = queue.pop(lambda method: self._can_run(method, cls))
+        if entry is not None:
+          break
+        if not self.method_limits:
+          # nothing of a lower class may run either
+          return None
+      else:
+        return None
+
+      method, item = entry
+      self._queued -= 1
+      self._run(method)
+
+      if self.paused and self._queued <= self.max_queue // 2:
+        self.paused = False
+        self.socket.resume_reading()
+      return item
+
+  def snapshot(self):
+    with self._lock:
+      return { 'inflight' : self.inflight,
+               'queued' : self._queued,
+               'queued_by_priority' : [len(q) for q in self._queues],
+               'peak_queued' : self.peak_queued,
+               'rejected' : self.rejected,
+               'pauses' : self.pauses,
+               'paused' : self.paused }
@@ -0,0 +1,218 @@
+'''
+asyncio integration.
+
+:class:`AsyncClient` proxy methods return asyncio futures, which are
+resolved from the polling thread through ``loop.call_soon_threadsafe``,
+so no thread is blocked per outstanding call::
+
+  client = AsyncClient(zeromq.client_socket(addr), loop=loop)
+  result = yield From(client.foo(request))  # or `await` on Python 3
+
+:class:`AsyncServer` runs handlers on an event loop.  A handler may be a
+coroutine, and returns its result instead of calling ``handle.done``.
+
+Streamed calls (``client.foo.stream(request)``) return an
+:class:`AsyncStream`, whose chunks are awaited one at a time.
+
+Uses :mod:`asyncio` where available, and the :mod:`trollius` backport
+otherwise.
+'''
+import collections
+import time
+import types
+
+try:
+  import asyncio
+except ImportError:
+  import trollius as asyncio
+
+from . import config, util
+from .common import (NO_RESULT, Client, ExpiredRequest, Future, ProxyMethod, RPCException,
+                     Server, Stream, capture_exception)
+
+try:
+  StopAsyncIteration = StopAsyncIteration
+except NameError:
+  class StopAsyncIteration(Exception):
+    '''Raised by `AsyncStream.next_chunk` at the end of the stream.'''
+
+
+class LoopFuture(Future):
+  '''A `Future` which also resolves an asyncio future on ``loop``.'''
+  def __init__(self, addr, rpc_id, loop):
+    Future.__init__(self, addr, rpc_id)
+    self.loop = loop
+    self.aio_future = asyncio.Future(loop=loop)
+    # times the call out at its deadline (see `AsyncClient._expire`)
+    self.expiry = None
+
+  def _set_result(self, result):
+    Future._set_result(self, result)
+    self.loop.call_soon_threadsafe(self._resolve)
+
+  def _resolve(self):
+    if self.expiry is not None:
+      self.expiry.cancel()
+      self.expiry = None
+    f = self.aio_future
+    if f.done():
+      # cancelled (e.g. by asyncio.wait_for)
+      return
+
+    if isinstance(self.result, RPCException):
+      exc = self.result.exception()
+      if config.throw_remote_exceptions:
+        f.set_exception(exc)
+        return
+      util.log_info('Remote host threw an exception (ignored)')
+      util.log_info(exc)
+      f.set_result(None)
+    else:
+      f.set_result(self.result)
+
+
+class AsyncStream(Stream):
+  '''A `Stream` whose chunks are awaited on ``loop``::
+
+    chunk = yield From(stream.next_chunk())  # or `async for` on Python 3
+
+  ``next_chunk`` fails with `StopAsyncIteration` at the end.
+  '''
+  def __init__(self, client, rpc_id, window, loop):
+    Stream.__init__(self, client, rpc_id, window)
+    self.loop = loop
+    # futures returned by next_chunk, not yet resolved
+    self._waiters = collections.deque()
+
+  def _chunk_arrived(self):
+    self.loop.call_soon_threadsafe(self._wake)
+
+  def _set_result(self, result):
+    Stream._set_result(self, result)
+    self.loop.call_soon_threadsafe(self._wake)
+
+  def next_chunk(self):
+    f = asyncio.Future(loop=self.loop)
+    self._waiters.append(f)
+    self._wake()
+    return f
+
+  def __aiter__(self):
+    return self
+
+  def __anext__(self):
+    return self.next_chunk()
+
+  def _wake(self):
+    while self._waiters:
+      f = self._waiters[0]
+      if f.done():
+        # cancelled
+        self._waiters.popleft()
+        continue
+
+      with self._cv:
+        try:
+          chunk = self._poll()
+        except StopIteration:
+          chunk, exc = None, StopAsyncIteration()
+        except Exception, e:
+          chunk, exc = None, e
+        else:
+          exc = None
+      if chunk is NO_RESULT:
+        return
+
+      self._waiters.popleft()
+      if exc is not None:
+        f.set_exception(exc)
+      else:
+        f.set_result(chunk)
+
+
+class AsyncProxyMethod(ProxyMethod):
+  def __call__(self, request=None, deadline=None):
+    f = ProxyMethod.__call__(self, request, deadline)
+    if not f.have_result and f.expiry is None:
+      f.expiry = self.client._loop.call_later(max(0, f._deadline - time.time()),
+                                              self.client._expire, f)
+    return f.aio_future
+
+
+class AsyncClient(Client):
+  '''A `Client` whose methods return asyncio futures bound to ``loop``.
+
+  Methods are called from the loop's thread.  A call which gets no reply
+  by its deadline fails with `DeadlineExceeded`.
+  '''
+  def __init__(self, socket, loop=None, **kw):
+    self._loop = loop or asyncio.get_event_loop()
+    Client.__init__(self, socket, **kw)
+
+  def __getattr__(self, method_name):
+    return AsyncProxyMethod(self, method_name)
+
+  def _expire(self, f):
+    'Fail ``f`` if it is still waiting for its reply at its deadline.'
+    f.expiry = None
+    if self._futures.get(f.rpc_id) is not f or self._futures.pop(f.rpc_id) is not f:
+      return
+    f._set_result(ExpiredRequest(py_exc='Timed out on remote call (%s %s).' % (f.addr, f.rpc_id)))
+
+  def _new_future(self, rpc_id):
+    return LoopFuture(self._socket.addr, rpc_id, self._loop)
+
+  def _new_stream(self, rpc_id, window):
+    return AsyncStream(self, rpc_id, window, self._loop)
+
+
+class AsyncServer(Server):
+  '''A `Server` which runs its handlers on an asyncio event loop.
+
+  Handlers are called as ``handler(handle, request)``.  The return value
+  (or, for coroutines, the eventual result) is sent as the reply, unless
+  the handler already called ``handle.done``.  Generators (which are not
+  coroutines) stream what they yield, as for `Server`.  Uncaught
+  exceptions are returned to the caller as a `RemoteException`.
+
+  The loop must be running for requests to be processed.
+  '''
+  def __init__(self, socket, loop=None):
+    Server.__init__(self, socket)
+    self._loop = loop or asyncio.get_event_loop()
+
+  def _dispatch(self, rpc_name, handle, req):
+    self._loop.call_soon_threadsafe(self._run, rpc_name, handle, req)
+
+  def _run(self, rpc_name, handle, req):
+    if handle.expired():
+      handle.expire()
+      return
+    handle.started = time.time()
+    try:
+      handler = getattr(self, rpc_name)
+      result = handler(handle, req)
+    except:
+      handle.done(capture_exception())
+      return
+
+    if isinstance(result, types.GeneratorType) and not asyncio.iscoroutinefunction(handler):
+      # (generator based coroutines are generators too)
+      handle.stream_from(result)
+    elif asyncio.iscoroutine(result) or isinstance(result, asyncio.Future):
+      task = asyncio.ensure_future(result, loop=self._loop)
+      task.add_done_callback(lambda t: self._finish_task(handle, t))
+    elif not handle.finished:
+      handle.done(result)
+
+  def _finish_task(self, handle, task):
+    if handle.finished:
+      return
+
+    if task.cancelled():
+      handle.done(RPCException(py_exc='Handler was cancelled.'))
+    elif task.exception() is not None:
+      exc = task.exception()
+      handle.done(capture_exception((type(exc), exc, getattr(exc, '__traceback__', None))))
+    else:
+      handle.done(task.result())
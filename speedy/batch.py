@@ -0,0 +1,154 @@
+'''
+Batched handlers.
+
+The :func:`batched` decorator turns a `Server` method which handles a
+list of requests into an ordinary handler::
+
+  class Lookup(speedy.Server):
+    @batched(max_batch=256, max_delay=0.002)
+    def lookup(self, keys):
+      return self.table[keys]
+
+Requests are buffered until ``max_batch`` of them have arrived or the
+oldest has waited ``max_delay`` seconds, then the method is called once
+with all of them, and its results are sent back to each caller.  Clients
+call the method as usual, one request at a time.
+'''
+import functools
+import Queue
+import threading
+
+from . import config, timer, util
+from .common import capture_exception
+from .serialization import numpy
+
+FLUSHER = None
+FLUSHER_LOCK = threading.Lock()
+
+
+class _Flusher(threading.Thread):
+  '''Runs batches flushed by their delay, for servers without a thread
+  pool, so that handlers do not hold up the timer thread.'''
+  def __init__(self):
+    threading.Thread.__init__(self, name='speedy.BatchFlusher')
+    self.setDaemon(True)
+    self.queue = Queue.Queue()
+
+  def run(self):
+    while True:
+      fn, args = self.queue.get()
+      fn(*args)
+
+
+def _flusher():
+  global FLUSHER
+  with FLUSHER_LOCK:
+    if FLUSHER is None:
+      FLUSHER = _Flusher()
+      FLUSHER.start()
+    return FLUSHER
+
+
+class _Batcher(object):
+  '''Pending requests for one batched method of a server.'''
+  def __init__(self, server, fn, max_batch, max_delay, stack):
+    self.server = server
+    self.fn = fn
+    self.max_batch = max_batch
+    self.max_delay = max_delay
+    self.stack = stack
+    self._handles = []
+    self._requests = []
+    self._lock = threading.Lock()
+    # incremented for each batch taken, so a stale timer does nothing.
+    self._generation = 0
+
+  def add(self, handle, req):
+    with self._lock:
+      self._handles.append(handle)
+      self._requests.append(req)
+      if len(self._handles) >= self.max_batch:
+        batch = self._take()
+      else:
+        batch = None
+        if len(self._handles) == 1:
+          timer.schedule(self.max_delay, self._timed_out, self._generation)
+
+    if batch is not None:
+      self._run(*batch)
+
+  def _take(self):
+    batch = self._handles, self._requests
+    self._handles, self._requests = [], []
+    self._generation += 1
+    return batch
+
+  def _timed_out(self, generation):
+    with self._lock:
+      if generation != self._generation or not self._handles:
+        return
+      batch = self._take()
+
+    # don't hold up the timer thread with the handler.
+    pool = self.server._thread_pool
+    if pool:
+      pool.apply_async(self._run, batch)
+    else:
+      _flusher().queue.put((self._run, batch))
+
+  def _run(self, handles, requests):
+    try:
+      if self.stack:
+        requests = numpy.stack(requests)
+      results = self.fn(self.server, requests)
+      if len(results) != len(handles):
+        raise ValueError('Batched handler %s returned %d results for %d requests.' % (
+          self.fn.__name__, len(results), len(handles)))
+    except:
+      util.log_info('Exception in batched handler.', exc_info=1)
+      error = capture_exception()
+      for handle in handles:
+        handle.done(error)
+      return
+
+    for handle, result in zip(handles, results):
+      handle.done(result)
+
+
+def batched(max_batch=None, max_delay=None, stack=False):
+  '''Decorator for `Server` methods which handle many requests at once.
+
+  The method is called as ``method(self, requests)``, with a list of
+  requests (or, with ``stack=True``, a numpy array stacking them along
+  a new first axis), and returns a sequence (or array) of results, one
+  per request.  If it raises, every request in the batch gets the error.
+
+  :param max_batch: requests per call (default ``config.batch_max_size``).
+  :param max_delay: seconds the first request of a batch may wait for
+    more (default ``config.batch_max_delay``).  Batches flushed by the
+    delay run on the server's thread pool if it has one, else on a
+    thread shared by all batched handlers.
+  '''
+  if stack:
+    assert numpy is not None, 'stack=True requires numpy.'
+
+  def decorator(fn):
+    attr = '_batcher_' + fn.__name__
+    lock = threading.Lock()
+
+    @functools.wraps(fn)
+    def handler(self, handle, req):
+      batcher = self.__dict__.get(attr)
+      if batcher is None:
+        with lock:
+          batcher = self.__dict__.get(attr)
+          if batcher is None:
+            batcher = _Batcher(self, fn,
+                               max_batch or config.batch_max_size,
+                               config.batch_max_delay if max_delay is None else max_delay,
+                               stack)
+            setattr(self, attr, batcher)
+      batcher.add(handle, req)
+
+    return handler
+  return decorator
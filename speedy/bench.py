@@ -0,0 +1,211 @@
+'''
+RPC benchmarks.
+
+Runs against servers in this process and writes the results as JSON::
+
+  python -m speedy.bench --output results.json
+
+Measured:
+
+* ``latency``: round trip latency percentiles of small messages.
+* ``throughput``: calls/sec with a fixed number of calls in flight.
+* ``bandwidth``: MB/s for echoing arrays of different sizes.
+* ``forall``: time per `forall` call against different numbers of workers.
+'''
+import argparse
+import collections
+import json
+import platform
+import socket
+import sys
+import time
+
+import numpy
+
+from . import config, util, zeromq
+from .common import Client, Server, forall, wait_for_all
+from .stats import Histogram
+
+MB = 1024. * 1024.
+
+
+class BenchServer(Server):
+  def ping(self, handle, req):
+    handle.done(req)
+
+  def sink(self, handle, req):
+    handle.done(None)
+
+
+def _start_servers(count):
+  servers = []
+  for i in range(count):
+    s = BenchServer(zeromq.server_socket(('127.0.0.1', -1)))
+    s.serve_nonblock()
+    servers.append(s)
+  return servers
+
+def _connect(servers):
+  return [Client(zeromq.client_socket(s.addr)) for s in servers]
+
+def _shutdown(clients, servers):
+  for c in clients:
+    c.close()
+  for s in servers:
+    s.shutdown()
+
+
+def bench_latency(client, calls):
+  '''Sequential round trips of a small message.'''
+  h = Histogram()
+  for i in range(calls):
+    st = time.time()
+    client.ping('x').wait()
+    h.record(time.time() - st)
+
+  result = h.summary()
+  result['calls'] = calls
+  return result
+
+
+def bench_throughput(client, calls, concurrency):
+  '''Pipelined calls, keeping ``concurrency`` calls in flight.'''
+  results = []
+  for c in concurrency:
+    st = time.time()
+    pending = collections.deque()
+    for i in range(calls):
+      pending.append(client.ping('x'))
+      if len(pending) >= c:
+        pending.popleft().wait()
+    wait_for_all(pending)
+    elapsed = time.time() - st
+    results.append({ 'concurrency' : c,
+                     'calls' : calls,
+                     'seconds' : elapsed,
+                     'calls_per_sec' : calls / elapsed })
+  return results
+
+
+def bench_bandwidth(client, sizes, calls):
+  '''Echo ``calls`` float arrays of each of ``sizes`` bytes.'''
+  results = []
+  for size in sizes:
+    array = numpy.ones(size / 8, dtype=numpy.float64)
+    st = time.time()
+    for i in range(calls):
+      client.ping(array).wait()
+    elapsed = time.time() - st
+    results.append({ 'bytes' : size,
+                     'calls' : calls,
+                     'seconds' : elapsed,
+                     # both directions
+                     'mb_per_sec' : 2 * size * calls / MB / elapsed })
+  return results
+
+
+def bench_forall(worker_counts, size, calls, fanout=None):
+  '''`forall` a ``size`` byte array to each of ``worker_counts`` workers.
+
+  ``fanout`` is passed to `forall` (see ``config.forall_fanout``).
+  '''
+  results = []
+  array = numpy.ones(size / 8, dtype=numpy.float64)
+  for count in worker_counts:
+    servers = _start_servers(count)
+    clients = _connect(servers)
+    try:
+      h = Histogram()
+      for i in range(calls):
+        st = time.time()
+        forall(clients, 'sink', array, fanout=fanout).wait()
+        h.record(time.time() - st)
+    finally:
+      _shutdown(clients, servers)
+
+    result = h.summary()
+    result.update({ 'workers' : count, 'bytes' : size, 'calls' : calls,
+                    'fanout' : config.forall_fanout if fanout is None else fanout })
+    results.append(result)
+  return results
+
+
+def run(latency_calls=2000,
+        throughput_calls=5000,
+        concurrency=(1, 8, 64, 256),
+        sizes=(1 << 10, 1 << 16, 1 << 20, 1 << 24),
+        bandwidth_calls=20,
+        workers=(1, 2, 4, 8),
+        forall_size=1 << 20,
+        forall_calls=20,
+        forall_fanout=None):
+  '''Run all benchmarks, returning a JSON serializable dict of results.'''
+  results = {
+    'timestamp' : time.time(),
+    'host' : socket.gethostname(),
+    'python' : platform.python_version(),
+    'config' : { 'oob_threshold' : config.oob_threshold,
+                 'poller_mode' : config.poller_mode,
+                 'poller_threads' : config.poller_threads,
+                 'wire_format' : config.wire_format },
+  }
+
+  servers = _start_servers(1)
+  clients = _connect(servers)
+  try:
+    client = clients[0]
+    util.log_info('Measuring latency...')
+    results['latency'] = bench_latency(client, latency_calls)
+    util.log_info('Measuring throughput...')
+    results['throughput'] = bench_throughput(client, throughput_calls, concurrency)
+    util.log_info('Measuring bandwidth...')
+    results['bandwidth'] = bench_bandwidth(client, sizes, bandwidth_calls)
+  finally:
+    _shutdown(clients, servers)
+
+  util.log_info('Measuring forall...')
+  results['forall'] = bench_forall(workers, forall_size, forall_calls, forall_fanout)
+  return results
+
+
+def _int_list(s):
+  return tuple(int(x) for x in s.split(','))
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Speedy RPC benchmarks.')
+  parser.add_argument('--output', '-o', default='-',
+                      help='file to write JSON results to (default: stdout)')
+  parser.add_argument('--latency-calls', type=int, default=2000)
+  parser.add_argument('--throughput-calls', type=int, default=5000)
+  parser.add_argument('--concurrency', type=_int_list, default=(1, 8, 64, 256))
+  parser.add_argument('--sizes', type=_int_list, default=(1 << 10, 1 << 16, 1 << 20, 1 << 24),
+                      help='comma separated array sizes in bytes')
+  parser.add_argument('--bandwidth-calls', type=int, default=20)
+  parser.add_argument('--workers', type=_int_list, default=(1, 2, 4, 8))
+  parser.add_argument('--forall-size', type=int, default=1 << 20)
+  parser.add_argument('--forall-calls', type=int, default=20)
+  parser.add_argument('--forall-fanout', type=int, default=None,
+                      help='relay forall through a tree with this fanout')
+  args = parser.parse_args(argv)
+
+  results = run(latency_calls=args.latency_calls,
+                throughput_calls=args.throughput_calls,
+                concurrency=args.concurrency,
+                sizes=args.sizes,
+                bandwidth_calls=args.bandwidth_calls,
+                workers=args.workers,
+                forall_size=args.forall_size,
+                forall_calls=args.forall_calls,
+                forall_fanout=args.forall_fanout)
+
+  out = json.dumps(results, indent=2, sort_keys=True)
+  if args.output == '-':
+    print out
+  else:
+    with open(args.output, 'w') as f:
+      f.write(out)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
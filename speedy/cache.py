@@ -0,0 +1,94 @@
+'''
+Client-side cache of RPC results.
+
+Methods marked with ``Client.cacheable`` go through a :class:`ResultCache`,
+keyed on the method name and a digest of the serialized request.  The
+cache holds futures: an identical call made while the first is still in
+flight shares its future, and later calls get the completed future back
+without a round trip.  Remote errors are not cached.
+'''
+import collections
+import hashlib
+import struct
+import threading
+import time
+
+LENGTH = struct.Struct('!Q')
+
+
+def request_key(method, data, buffers):
+  '''Cache key for a request, from its serialized form.
+
+  The request is keyed on a digest, so the cache does not keep a copy of
+  large out of band buffers.
+  '''
+  digest = hashlib.sha1()
+  for piece in [data] + list(buffers):
+    n = getattr(piece, 'nbytes', None)
+    if n is None:
+      n = len(piece) * getattr(piece, 'itemsize', 1)
+    digest.update(LENGTH.pack(n))
+    digest.update(piece)
+  return method, digest.digest()
+
+
+class ResultCache(object):
+  '''A bounded LRU cache of futures, with a time to live per entry.'''
+  def __init__(self, capacity):
+    self.capacity = capacity
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def __len__(self):
+    return len(self._entries)
+
+  def lookup(self, key, ttl, create):
+    '''Returns (future, hit) for ``key``.
+
+    On a miss, ``create()`` is called (with the cache locked) to start the
+    call.  Its future is shared while the call is in flight, and its
+    result for ``ttl`` seconds (forever if None) from the start of the call.
+    '''
+    now = time.time()
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if entry is not None:
+        future, expires = entry
+        if future.have_result:
+          valid = expires is None or expires > now
+        else:
+          valid = not future.timed_out()
+        if valid:
+          self._entries[key] = entry
+          self.hits += 1
+          return future, True
+
+      future = create()
+      self._entries[key] = (future, None if ttl is None else now + ttl)
+      self.misses += 1
+      while len(self._entries) > self.capacity:
+        self._entries.popitem(last=False)
+        self.evictions += 1
+      return future, False
+
+  def discard(self, key, future):
+    'Remove ``key``, if it still maps to ``future``.'
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is not None and entry[0] is future:
+        del self._entries[key]
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+
+  def snapshot(self):
+    with self._lock:
+      return { 'size' : len(self._entries),
+               'capacity' : self.capacity,
+               'hits' : self.hits,
+               'misses' : self.misses,
+               'evictions' : self.evictions }
@@ -6,6 +6,9 @@ sockets which should implement the :class:`.Socket` interface.
 '''
 from cPickle import PickleError
 import collections
+import itertools
+import operator
+import Queue
 import weakref
 import sys
 import threading
@@ -15,11 +18,12 @@ import types
 import cStringIO
 import cPickle
 
-from . import config, util
+from . import admission, cache, config, timer, util, serialization, stats, wire
+from .serialization import cloudpickle, numpy
 
-RPC_ID = xrange(1000000000).__iter__()
+# rpc ids are unsigned 64 bit integers on the wire.
+RPC_ID_MASK = (1 << 64) - 1
 
-CLIENT_PENDING = weakref.WeakKeyDictionary()
 SERVER_PENDING = weakref.WeakKeyDictionary()
 
 DEFAULT_TIMEOUT = 100
@@ -34,16 +38,35 @@ class RPCException(object):
   def __init__(self, py_exc):
     self.py_exc = py_exc
 
+  def exception(self):
+    'The exception raised to the caller for this error.'
+    return RemoteException(self.py_exc)
+
+class ExpiredRequest(RPCException):
+  '''The deadline of a request passed before the server ran it.'''
+  def exception(self):
+    return DeadlineExceeded(self.py_exc)
+
+class Overloaded(RPCException):
+  '''The server was too busy to accept a request (see speedy.admission).
+  It was not run, so it may be retried.'''
+  def exception(self):
+    return ServerOverloaded(self.py_exc)
+
 class PickledData(object):
   '''
   Helper class: indicates that this message has already been pickled,
   and should be sent as is, rather than being re-pickled.
+
+  ``buffers`` holds the out of band buffers returned by `serialization.dumps`.
   '''
-  def __init__(self, data):
+  def __init__(self, data, buffers=()):
     self.data = data
+    self.buffers = buffers
 
 class SocketBase(object):
   def send(self, blob): pass
+  # returns the list of frames for the next message.
   def recv(self): pass
   def flush(self): pass
   def close(self): pass
@@ -58,6 +81,11 @@ class SocketBase(object):
   # server
   def bind(self): pass
 
+  # flow control: stop (and restart) calling the handler for new messages.
+  # Sockets which can't, ignore this.
+  def pause_reading(self): pass
+  def resume_reading(self): pass
+
 
 def capture_exception(exc_info=None):
   if exc_info is None:
@@ -87,22 +115,260 @@ def serialize(obj):
   except (PickleError, TypeError):
     return cloudpickle.dumps(obj, -1)
 
-def read(f):
-  return cPickle.load(f)
+def read(f, buffers=()):
+  return serialization.load(f, buffers)
+
+def encode_message(header, data, buffers=()):
+  '''Build a message from a `wire.Header` and an encoded body.
+
+  Out of band ``buffers`` are appended as extra frames, except with
+  the legacy pickled header: old peers read a single frame, so they are
+  pickled in band.
+  '''
+  if header.format == wire.FORMAT_PICKLE:
+    data = serialization.inline(data, buffers)
+    w = cStringIO.StringIO()
+    legacy = { 'rpc_id' : header.rpc_id }
+    if header.method:
+      legacy['method'] = header.method
+    if header.deadline is not None:
+      legacy['deadline'] = header.deadline
+    cPickle.dump(legacy, w, -1)
+    w.write(data)
+    return w.getvalue()
+
+  return Group([wire.pack(header), data] + list(buffers))
+
+def decode_header(frames):
+  '''Parse the header of a message.
+
+  Returns (header, payload, buffers), where ``payload`` is a
+  file-like object positioned at the start of the body.
+  '''
+  first = frames[0]
+  if wire.is_binary(first):
+    return wire.unpack(first), cStringIO.StringIO(frames[1]), frames[2:]
+
+  if not config.accept_legacy_header:
+    raise ValueError('Received a message with a legacy (pickled) header.')
+
+  reader = cStringIO.StringIO(first)
+  legacy = cPickle.load(reader)
+  header = wire.Header(legacy['rpc_id'], legacy.get('method', ''),
+                       format=wire.FORMAT_PICKLE, deadline=legacy.get('deadline'))
+  return header, reader, frames[1:]
+
+def decode_body(header, payload, buffers):
+  if header.codec == wire.CODEC_RAW:
+    return payload.read()
+  return read(payload, buffers)
+
+def decode_message(frames):
+  '''Inverse of `encode_message`: returns (header, body).'''
+  header, payload, buffers = decode_header(frames)
+  return header, decode_body(header, payload, buffers)
+
+def _frame_size(frame):
+  nbytes = getattr(frame, 'nbytes', None)
+  if nbytes is not None:
+    return nbytes
+  if isinstance(frame, memoryview):
+    return len(frame) * frame.itemsize
+  return len(frame)
+
+def message_size(msg):
+  '''Size in bytes of a message (a string, or a list of frames).'''
+  if isinstance(msg, (list, tuple)):
+    return sum(_frame_size(f) for f in msg)
+  return _frame_size(msg)
 
 NO_RESULT = object()
 
+class _ReplyStream(object):
+  '''Flow control for the reply to a streamed request.
+
+  The client grants credit for ``window`` chunks up front, and more as
+  it consumes them; chunks sent without credit wait in ``backlog``.
+  '''
+  def __init__(self, handle, window, executor, registry, key):
+    self.handle = handle
+    self.credits = window
+    # encoded chunks waiting for credit, then the final reply
+    self.backlog = collections.deque()
+    self.final = None
+    # set when the client closes the stream early.
+    self.cancelled = False
+    # a generator returned by the handler, run as credit arrives
+    self.generator = None
+    self.pumping = False
+    # runs the generator when credit arrives (default: the polling thread)
+    self.executor = executor
+    self.bytes_out = 0
+    self.cv = threading.Condition()
+    self.registry = registry
+    self.key = key
+    registry[key] = self
+
+  def _may_block(self):
+    # the polling threads deliver credit, so they must not wait for it.
+    from .zeromq import ZMQPoller
+    return not isinstance(threading.current_thread(), ZMQPoller)
+
+  def _write(self, msg):
+    self.handle.socket.send(msg)
+    self.bytes_out += message_size(msg)
+
+  def send(self, msg):
+    with self.cv:
+      if not self.credits and not self.backlog and self._may_block():
+        while not self.credits and not self.cancelled and not self.handle.expired():
+          self.cv.wait(0.1)
+      if self.cancelled:
+        return
+      if self.credits and not self.backlog:
+        self.credits -= 1
+        self._write(msg)
+      else:
+        self.backlog.append(msg)
+
+  def finish(self, msg):
+    'Send the final reply ``msg`` once the backlog has been sent.'
+    with self.cv:
+      if self.cancelled:
+        self.registry.pop(self.key, None)
+      elif self.backlog:
+        self.final = msg
+      else:
+        self.registry.pop(self.key, None)
+        self.handle._send(msg)
+
+  def grant(self, n):
+    '''Credit for ``n`` more chunks from the client; a negative ``n``
+    means it closed the stream.'''
+    with self.cv:
+      if n < 0:
+        self.cancelled = True
+        self.backlog.clear()
+        self.final = None
+        self.registry.pop(self.key, None)
+      else:
+        self.credits += n
+        while self.credits and self.backlog:
+          self.credits -= 1
+          self._write(self.backlog.popleft())
+        if self.final is not None and not self.backlog:
+          self.registry.pop(self.key, None)
+          self.handle._send(self.final)
+          self.final = None
+      self.cv.notify_all()
+
+      pump = self.generator is not None and not self.pumping and (self.credits or self.cancelled)
+      if pump:
+        self.pumping = True
+    if pump:
+      _call_on(self.executor, self.pump)
+
+  def pump(self):
+    'Run the generator while there is credit.  The caller sets ``pumping``.'
+    handle = self.handle
+    while True:
+      with self.cv:
+        if not self.credits and not self.cancelled:
+          self.pumping = False
+          return
+        cancelled = self.cancelled
+
+      try:
+        if cancelled:
+          self.generator.close()
+          raise StopIteration
+        chunk = self.generator.next()
+      except StopIteration:
+        handle.done()
+        return
+      except:
+        util.log_info('Exception in streaming handler.', exc_info=1)
+        handle.done(capture_exception())
+        return
+      handle.send_partial(chunk)
+
+
+class _Upload(object):
+  '''A request whose body is arriving in ``_chunk`` messages (see
+  `ProxyMethod.upload`), reassembled into preallocated buffers.'''
+  def __init__(self, rpc_name, handle, header, sizes):
+    self.rpc_name = rpc_name
+    self.handle = handle
+    self.header = header
+    if (not isinstance(sizes, list) or
+        not all(isinstance(n, (int, long)) and n >= 0 for n in sizes)):
+      raise ValueError('Upload sizes must be a list of non-negative ints.')
+    if sum(sizes) > config.upload_max_bytes:
+      raise ValueError('Upload of %d bytes is over config.upload_max_bytes (%d).' %
+                       (sum(sizes), config.upload_max_bytes))
+    if numpy is not None:
+      # unlike bytearray, not zeroed first
+      self.pieces = [numpy.empty(n, numpy.uint8) for n in sizes]
+    else:
+      self.pieces = [bytearray(n) for n in sizes]
+    self.remaining = sum(sizes)
+    self.chunks = 0
+    self.last_active = time.time()
+
+  def add(self, idx, offset, frame):
+    'Copy a chunk into place; returns its size.'
+    data = getattr(frame, 'buffer', frame)
+    piece = self.pieces[idx]
+    n = _nbytes(data)
+    if offset + n > len(piece):
+      raise ValueError('Chunk at %d+%d overruns piece %d of the upload.' % (offset, n, idx))
+    # copied once, straight from the frame
+    if isinstance(data, memoryview):
+      memoryview(piece)[offset:offset + n] = data
+    elif numpy is not None:
+      piece[offset:offset + n] = numpy.frombuffer(data, numpy.uint8)
+    else:
+      piece[offset:offset + n] = data
+    self.remaining -= n
+    self.chunks += 1
+    self.last_active = time.time()
+    return n
+
+
 class PendingRequest(object):
   '''An outstanding RPC request.
 
   Call done(result) when a method is finished processing.
+
+  Results may also be streamed: call ``send_partial(chunk)`` for each
+  chunk, then ``done()``, or make the handler a generator which yields
+  the chunks.  Clients calling ``client.method.stream(request)`` receive
+  the chunks as they are produced; for other calls they are collected
+  into a list, sent by ``done``.
+
+  ``deadline`` is the time (``time.time()``) after which the caller no
+  longer waits for the result, if it sent one.  Handlers making nested
+  calls should pass it along: ``client.foo(req, deadline=handle.deadline)``.
   '''
-  def __init__(self, socket, rpc_id):
+  def __init__(self, socket, rpc_id, wire_format=wire.FORMAT_BINARY, stats=None, bytes_in=0,
+               deadline=None):
     self.socket = socket
     self.rpc_id = rpc_id
+    self.wire_format = wire_format
+    self.deadline = deadline
     self.created = time.time()
+    # set when the handler starts running.
+    self.started = None
     self.finished = False
     self.result = NO_RESULT
+    self.stats = stats
+    self.bytes_in = bytes_in
+    # called with this request once it is finished.
+    self.on_finished = None
+    # flow control state, for streamed requests
+    self.stream = None
+    # chunks sent by send_partial, if not streaming
+    self._chunks = None
 
     SERVER_PENDING[self] = 1
 
@@ -111,18 +377,116 @@ class PendingRequest(object):
       time.sleep(0.001)
     return self.result
 
+  def remaining(self):
+    '''Seconds left until the deadline (at least 0), or None if the
+    caller did not send one.'''
+    if self.deadline is None:
+      return None
+    return max(0.0, self.deadline - time.time())
+
+  def expired(self):
+    return self.deadline is not None and self.deadline < time.time()
+
+  def expire(self):
+    '''Finish a request whose deadline has passed without running it
+    (see ``config.expired_requests``).'''
+    if self.stats is not None:
+      self.stats.record(expired=1)
+    if config.expired_requests == 'drop':
+      self.finished = True
+      if self.stream is not None:
+        # nothing will be sent: forget the stream.
+        self.stream.grant(-1)
+      self._notify_finished()
+      return
+    self.done(ExpiredRequest(py_exc='Deadline expired %.3f seconds before the request ran.' % (
+      time.time() - self.deadline)))
+
+  @property
+  def cancelled(self):
+    'True if the client has closed the stream of results.'
+    return self.stream is not None and self.stream.cancelled
+
+  def send_partial(self, chunk):
+    '''Send one chunk of the result; finish with `done`.
+
+    Waits while the client has no room for more chunks, unless called
+    from the polling thread, where chunks are queued instead.  Chunks
+    are dropped once the client has closed the stream.
+    '''
+    if self.stream is None:
+      if self._chunks is None:
+        self._chunks = []
+      self._chunks.append(chunk)
+    elif self.socket is not None:
+      self.stream.send(self._encode(chunk, wire.FLAG_PARTIAL))
+
+  def stream_from(self, generator):
+    'Send the chunks yielded by ``generator``, then finish.'
+    if self.stream is None:
+      try:
+        for chunk in generator:
+          self.send_partial(chunk)
+      except:
+        self.done(capture_exception())
+      else:
+        self.done()
+      return
+
+    self.stream.generator = generator
+    self.stream.pumping = True
+    self.stream.pump()
+
+  def _encode(self, result, flags=0):
+    header = wire.Header(self.rpc_id, flags=flags, format=self.wire_format)
+    data, buffers = serialization.dumps(result)
+    return encode_message(header, data, buffers)
+
   def done(self, result=None):
     # util.log_info('RPC finished in %.3f seconds' % (time.time() - self.created))
     self.finished = True
+    if self._chunks is not None and not isinstance(result, RPCException):
+      result = self._chunks + ([result] if result is not None else [])
     self.result = result
 
     if self.socket is not None:
-      header = { 'rpc_id' : self.rpc_id }
       # util.log_info('Finished %s, %s', self.socket.addr, self.rpc_id)
-      w = cStringIO.StringIO()
-      cPickle.dump(header, w, -1)
-      serialize_to(result, w)
-      self.socket.send(w.getvalue())
+      if self.stream is not None:
+        self.stream.finish(self._encode(result))
+      else:
+        self._send(self._encode(result))
+    self._notify_finished()
+
+  def forward(self, msg):
+    '''Finish this request with an already encoded reply message.'''
+    self.finished = True
+    if self.socket is not None:
+      if self.stream is not None:
+        self.stream.finish(msg)
+      else:
+        self._send(msg)
+    self._notify_finished()
+
+  def _notify_finished(self):
+    fn, self.on_finished = self.on_finished, None
+    if fn is not None:
+      fn(self)
+
+  def _send(self, msg):
+    self.socket.send(msg)
+    if self.stats is not None:
+      now = time.time()
+      durations = { 'handler_time' : now - (self.started or self.created) }
+      if self.started is not None:
+        durations['queue_time'] = self.started - self.created
+      bytes_out = message_size(msg)
+      if self.stream is not None:
+        bytes_out += self.stream.bytes_out
+      self.stats.record(calls=1,
+                        errors=int(isinstance(self.result, RPCException)),
+                        bytes_in=self.bytes_in,
+                        bytes_out=bytes_out,
+                        **durations)
 
   def __del__(self):
     if not self.finished:
@@ -141,6 +505,16 @@ class RemoteException(Exception):
   def __str__(self):
     return repr(self)
 
+class DeadlineExceeded(RemoteException):
+  '''The server did not run a request because its deadline had passed.'''
+  def __repr__(self):
+    return 'DeadlineExceeded: ' + self._tb
+
+class ServerOverloaded(RemoteException):
+  '''The server rejected a request because it was overloaded.'''
+  def __repr__(self):
+    return 'ServerOverloaded: ' + self._tb
+
 class FnFuture(object):
   '''Chain ``fn`` to the given future.
 
@@ -157,21 +531,33 @@ class FnFuture(object):
     self.result = self.fn(result)
     return self.result
 
+  def timed_out(self):
+    return self.future.timed_out()
+
+  def _add_listener(self, fn):
+    self.future._add_listener(lambda f: fn(self))
+
 class Future(object):
-  def __init__(self, addr, rpc_id):
+  def __init__(self, addr, rpc_id, stats=None):
     self.addr = addr
     self.rpc_id = rpc_id
+    # `stats.MethodStats` for the called method.
+    self.stats = stats
     self.have_result = False
     self.result = None
     self.finished_fn = None
     self._cv = threading.Condition()
     self._start = time.time()
     self._deadline = time.time() + DEFAULT_TIMEOUT
-
-    CLIENT_PENDING[self] = 1
+    # called with this future once the result is set.
+    self._listeners = []
 
   def _set_result(self, result):
     self._cv.acquire()
+    if self.have_result:
+      # e.g. a reply racing `Stream.close`: the first result stands.
+      self._cv.release()
+      return
     self.have_result = True
 
     if self.finished_fn is not None:
@@ -180,8 +566,21 @@ class Future(object):
       self.result = result
 
     self._cv.notify()
+    listeners, self._listeners = self._listeners, None
     self._cv.release()
 
+    for fn in listeners:
+      fn(self)
+
+  def _add_listener(self, fn):
+    '''Call ``fn(self)`` once the result is set: on the thread which sets
+    it, or immediately if it is already available.'''
+    with self._cv:
+      if not self.have_result:
+        self._listeners.append(fn)
+        return
+    fn(self)
+
   def timed_out(self):
     return self._deadline < time.time()
 
@@ -206,13 +605,212 @@ class Future(object):
       return self.handle_exc(Exception('Timed out on remote call (%s %s)', self.addr, self.rpc_id))
 
     if isinstance(self.result, RPCException):
-      return self.handle_exc(RemoteException(self.result.py_exc))
+      return self.handle_exc(self.result.exception())
 
     return self.result
 
   def on_finished(self, fn):
+    '''Returns a `FnFuture`, which applies ``fn`` when waited on (see
+    `then` to apply it as soon as the result arrives).'''
     return FnFuture(self, fn)
 
+  def add_done_callback(self, fn, executor=None):
+    '''Call ``fn(self)`` when the result arrives.
+
+    ``fn`` runs on the polling thread, so it should be quick; pass an
+    ``executor`` (with ``submit``, or ``apply_async`` like a thread pool)
+    to run it there instead.  If the result is already available, ``fn``
+    runs (or is submitted) immediately.
+    '''
+    self._add_listener(lambda f: _call_on(executor, _run_callback, fn, f))
+
+  def then(self, fn, executor=None):
+    '''Returns a `ChainedFuture` for ``fn(result)``, computed as soon as
+    the result arrives (see `add_done_callback`).
+
+    If ``fn`` returns a `Future`, the chained future takes its result,
+    so dependent RPCs can be chained without waiting on any thread.
+    Remote errors are passed along without calling ``fn``.
+    '''
+    chained = ChainedFuture(self.addr, self.rpc_id)
+    self.add_done_callback(lambda f: chained._chain(fn, f.result), executor)
+    return chained
+
+
+class ChainedFuture(Future):
+  '''The result of `Future.then`.'''
+  def _chain(self, fn, result):
+    if not isinstance(result, RPCException):
+      try:
+        result = fn(result)
+      except:
+        result = capture_exception()
+
+    if isinstance(result, Future):
+      result._add_listener(lambda f: self._set_result(f.result))
+    else:
+      self._set_result(result)
+
+
+class Stream(Future):
+  '''The result of a streamed call (see `ProxyMethod.stream`): iterate
+  over it for the chunks of the result as they arrive.
+
+  At most ``window`` chunks are sent ahead of the consumer; credit for
+  more is returned once half of them have been taken.  ``wait()``
+  returns the list of all chunks.
+  '''
+  def __init__(self, client, rpc_id, window):
+    Future.__init__(self, client._socket.addr, rpc_id)
+    self.client = client
+    self.window = window
+    self._chunks = collections.deque()
+    # chunks taken since credit was last returned
+    self._consumed = 0
+    self._ended = False
+    # without an explicit deadline, allow DEFAULT_TIMEOUT between chunks.
+    self._refresh_deadline = True
+
+  def _add_chunk(self, chunk):
+    with self._cv:
+      self._chunks.append(chunk)
+      if self._refresh_deadline:
+        self._deadline = time.time() + DEFAULT_TIMEOUT
+      self._cv.notify()
+    self._chunk_arrived()
+
+  def _chunk_arrived(self):
+    pass
+
+  def _poll(self):
+    '''Returns the next chunk, `NO_RESULT` if none has arrived yet, or
+    raises StopIteration at the end.  Called with ``_cv`` held.'''
+    if self._chunks:
+      chunk = self._chunks.popleft()
+      self._consumed += 1
+      if self._consumed >= max(1, self.window // 2) and not self.have_result:
+        self.client._grant(self.rpc_id, self._consumed)
+        self._consumed = 0
+      return chunk
+
+    if self._ended or not self.have_result:
+      if self._ended or self.timed_out():
+        self._ended = True
+        if not self.have_result:
+          self.handle_exc(Exception('Timed out on stream (%s %s)' % (self.addr, self.rpc_id)))
+        raise StopIteration
+      return NO_RESULT
+
+    self._ended = True
+    if isinstance(self.result, RPCException):
+      self.handle_exc(self.result.exception())
+    elif self.result is not None:
+      return self.result
+    raise StopIteration
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    with self._cv:
+      while True:
+        chunk = self._poll()
+        if chunk is not NO_RESULT:
+          return chunk
+        # use a timeout so that ctrl-c works.
+        self._cv.wait(timeout=0.1)
+
+  def wait(self):
+    return list(self)
+
+  def close(self):
+    '''Stop receiving chunks: the server stops sending them (and
+    running a generator handler).'''
+    with self._cv:
+      if self.have_result:
+        return
+      self._ended = True
+    if self.client._futures.get(self.rpc_id) is self:
+      self.client._futures.pop(self.rpc_id)
+      self.client._grant(self.rpc_id, -1)
+    self._set_result(None)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.close()
+
+
+def _nbytes(piece):
+  return piece.nbytes if hasattr(piece, 'nbytes') else len(piece)
+
+def _split_chunks(pieces, chunk_size):
+  'Yield (piece index, offset, data) for chunks of at most ``chunk_size`` bytes.'
+  for idx, piece in enumerate(pieces):
+    n = _nbytes(piece)
+    for offset in xrange(0, n, chunk_size):
+      # a view, not a copy (offsets are in bytes, whatever the dtype)
+      yield idx, offset, buffer(piece, offset, min(chunk_size, n - offset))
+
+
+class Upload(Future):
+  '''The result of a chunked upload (see `ProxyMethod.upload`).
+
+  Sends the serialized request in chunks, with at most ``window`` of
+  them not yet acknowledged by the server.  Acknowledgements arrive as
+  partial replies, and the next chunks are sent from the polling thread.
+  '''
+  def __init__(self, client, rpc_id, pieces, chunk_size, window):
+    Future.__init__(self, client._socket.addr, rpc_id)
+    self.client = client
+    self.window = window
+    self._chunks = _split_chunks(pieces, chunk_size)
+    self._sent = 0
+    self._acked = 0
+    self._lock = threading.Lock()
+    # without an explicit deadline, allow DEFAULT_TIMEOUT between acks.
+    self._refresh_deadline = True
+
+  def _add_chunk(self, acked):
+    'The server has received ``acked`` chunks.'
+    if self._refresh_deadline:
+      self._deadline = time.time() + DEFAULT_TIMEOUT
+    self._acked = acked
+    self._send_chunks()
+
+  def _send_chunks(self):
+    with self._lock:
+      while self._chunks is not None and self._sent - self._acked < self.window:
+        chunk = next(self._chunks, None)
+        if chunk is None or self.have_result:
+          # finished, or the server has given up on the request
+          self._chunks = None
+          break
+
+        idx, offset, data = chunk
+        header = wire.Header(self.rpc_id, '_chunk', format=self.client._wire_format)
+        msg = encode_message(header, cPickle.dumps((idx, offset), -1), [data])
+        if self.stats is not None:
+          self.stats.record(bytes_out=message_size(msg))
+        self.client._socket.send(msg)
+        self._sent += 1
+
+
+def _call_on(executor, fn, *args):
+  if executor is None:
+    fn(*args)
+  elif hasattr(executor, 'submit'):
+    executor.submit(fn, *args)
+  else:
+    executor.apply_async(fn, args)
+
+def _run_callback(fn, future):
+  try:
+    fn(future)
+  except:
+    util.log_warn('Exception in callback for %s.', future, exc_info=1)
+
 
 class DummyFuture(object):
   def __init__(self, base=None):
@@ -221,12 +819,24 @@ class DummyFuture(object):
   def wait(self):
     return self.v
 
+  def timed_out(self):
+    return False
+
+  def _add_listener(self, fn):
+    fn(self)
+
 DUMMY_FUTURE = DummyFuture()
 
 class FutureGroup(list):
   def wait(self):
     return [f.wait() for f in self]
 
+  def as_completed(self, timeout=None):
+    return as_completed(self, timeout)
+
+  def wait_any(self, timeout=None):
+    return wait_any(self, timeout)
+
 def wait_for_all(futures):
   result = []
   for idx, f in enumerate(futures):
@@ -235,26 +845,267 @@ def wait_for_all(futures):
   return result
   return [f.wait() for f in futures]
 
+def as_completed(futures, timeout=None):
+  '''Yield ``futures`` in the order their results arrive.
+
+  Futures are signalled by `Future._set_result`, so results can be
+  processed while slower requests are still outstanding.  A future
+  whose own deadline passes is yielded then, so that its ``wait()``
+  reports the timeout.
+
+  :param timeout: seconds to wait for all of ``futures``; an exception
+    is raised if some have not finished by then.
+  '''
+  futures = list(futures)
+  arrived = Queue.Queue()
+  # by index, so that a future passed twice is yielded twice.
+  pending = set(range(len(futures)))
+  total = len(pending)
+  for idx, f in enumerate(futures):
+    f._add_listener(lambda f, idx=idx: arrived.put(idx))
+
+  deadline = None if timeout is None else time.time() + timeout
+  while pending:
+    wait_time = 0.1
+    if deadline is not None:
+      wait_time = min(wait_time, deadline - time.time())
+      if wait_time <= 0:
+        raise Exception('Timed out waiting for %d of %d futures.' % (len(pending), total))
+
+    try:
+      idx = arrived.get(timeout=wait_time)
+    except Queue.Empty:
+      for idx in sorted(idx for idx in pending if futures[idx].timed_out()):
+        pending.discard(idx)
+        yield futures[idx]
+      continue
+
+    if idx in pending:
+      pending.discard(idx)
+      yield futures[idx]
+
+def wait_any(futures, timeout=None):
+  '''Returns the first of ``futures`` to finish (see `as_completed`).'''
+  for f in as_completed(futures, timeout):
+    return f
+
+
+def _remote_error(result):
+  '''Handle an `RPCException` result as `Future.wait` does.'''
+  if config.throw_remote_exceptions:
+    raise result.exception()
+  util.log_info('Remote host threw an exception (ignored)')
+  util.log_info(result.py_exc)
+  return None
+
+def when_done(future, fn):
+  '''Call ``fn(result)`` once ``future`` (a `Future`) has its result.
+
+  ``fn`` runs on the thread which receives the result, or immediately
+  if it is already available.
+  '''
+  future._add_listener(lambda f: fn(f.result))
+
+
+class RelayRequest(object):
+  '''Request for the reserved ``_relay`` RPC (see `forall`).
+
+  ``data`` and ``buffers`` are the already serialized request for
+  ``method``; ``children`` are the addresses of the rest of the subtree.
+  '''
+  def __init__(self, method, children, fanout, data, buffers):
+    self.method = method
+    self.children = children
+    self.fanout = fanout
+    self.data = data
+    self.buffers = list(buffers)
+
+
+def _split_tree(items, fanout):
+  'Split ``items`` into at most ``fanout`` contiguous runs of (nearly) equal size.'
+  count = min(fanout, len(items))
+  runs = []
+  start = 0
+  for i in range(count):
+    size = len(items) // count + (1 if i < len(items) % count else 0)
+    runs.append(items[start:start + size])
+    start += size
+  return runs
+
+
+class _Relay(object):
+  '''Collects the results of a ``_relay`` request: the local result,
+  followed by the results of each subtree, in order.'''
+  def __init__(self, handle, sizes):
+    self.handle = handle
+    self.sizes = sizes
+    self.parts = [None] * len(sizes)
+    self.remaining = len(sizes)
+    self.lock = threading.Lock()
+
+  def set(self, idx, result):
+    if idx == 0:
+      result = [result]
+    elif isinstance(result, RPCException):
+      # the whole subtree failed
+      result = [result] * self.sizes[idx]
+
+    with self.lock:
+      self.parts[idx] = result
+      self.remaining -= 1
+      finished = self.remaining == 0
+
+    if finished:
+      self.handle.done(list(itertools.chain(*self.parts)))
+
+
+class _RelayedRequest(PendingRequest):
+  '''Runs the method of a ``_relay`` request locally.'''
+  def __init__(self, handle, relay):
+    PendingRequest.__init__(self, None, handle.rpc_id, handle.wire_format,
+                            deadline=handle.deadline)
+    self.relay = relay
+
+  def done(self, result=None):
+    PendingRequest.done(self, result)
+    self.relay.set(0, result)
+
+  def forward(self, msg):
+    # the reply of a process pool worker
+    try:
+      result = decode_message(msg)[1]
+    except:
+      result = capture_exception()
+    self.done(result)
+
+  def expire(self):
+    # the relay still needs a result for this server, even if dropping.
+    self.done(ExpiredRequest(py_exc='Deadline expired before the request ran.'))
+
+
+def _source(socket):
+  'Identifies the client of a request read from ``socket``.'
+  source = getattr(socket, 'source', None)
+  return getattr(source, 'bytes', source)
+
 
 def run_rpc(server, rpc_name, rpc, req):
   # Python can't pickle bound methods, so we can't pass the result of getattr (a bound method)
   # to pool.run_async.  Instead, pass the object and rpc name and bind here.
   rpc_handler = getattr(server, rpc_name)
-  rpc_handler(rpc, req)
+  if rpc.expired():
+    # it waited too long for a thread
+    rpc.expire()
+    return
+  rpc.started = time.time()
+  result = rpc_handler(rpc, req)
+  if isinstance(result, types.GeneratorType):
+    rpc.stream_from(result)
 
 
 class Server(object):
-  def __init__(self, socket, thread_pool=None):
+  def __init__(self, socket, thread_pool=None, process_pool=None):
+    '''
+    :param socket: `SocketBase` to serve requests from.
+    :param thread_pool: optional pool (with ``apply_async``) to run handlers on.
+    :param process_pool: optional `procpool.ProcessPool`, or a number of
+      worker processes, to run handlers in.
+    '''
     self._socket = socket
     self._socket.register_handler(self.handle_read)
     self._running = False
     self._thread_pool = thread_pool
+    self._method_stats = stats.Stats()
+    # clients of other servers, for relaying broadcasts (see `forall`).
+    self._relay_clients = {}
+    self._relay_lock = threading.Lock()
+    # limits on the requests running at once, and their scheduling
+    # (see `limit`, `priority` and `weight`).
+    self._admission = admission.Admission(socket, config.server_max_inflight,
+                                          config.server_max_queue,
+                                          config.server_overload_policy,
+                                          config.server_reserved_inflight)
+    self._draining = threading.local()
+    # (client, rpc id) -> `_ReplyStream` of streamed requests in progress
+    self._streams = {}
+    # (client, rpc id) -> `_Upload` of requests being received in chunks
+    self._uploads = {}
+    if isinstance(process_pool, int):
+      from .procpool import ProcessPool
+      process_pool = ProcessPool(process_pool)
+    self._process_pool = process_pool
 
   def diediedie(self, handle, req):
     handle.done(None)
     self._socket.flush()
     self.shutdown()
 
+  def _stats(self, handle, req):
+    '''Reserved RPC: returns a `stats.Stats.snapshot` of this server,
+    and an `admission.Admission.snapshot` as ``_admission`` if it
+    limits requests.'''
+    snapshot = self._method_stats.snapshot()
+    if self._admission.active:
+      snapshot['_admission'] = self._admission.snapshot()
+    handle.done(snapshot)
+
+  def limit(self, method, max_inflight):
+    '''Run at most ``max_inflight`` requests for ``method`` at once
+    (0 for no limit other than ``config.server_max_inflight``).
+
+    Requests over the limit wait in the server's queue (see
+    speedy.admission).
+    '''
+    if max_inflight:
+      self._admission.method_limits[method] = max_inflight
+    else:
+      self._admission.method_limits.pop(method, None)
+
+  def priority(self, method, cls):
+    '''Schedule queued requests for ``method`` in priority class ``cls``
+    (``admission.HIGH``, ``NORMAL`` or ``LOW``).'''
+    assert cls in admission.CLASSES, cls
+    self._admission.priorities[method] = cls
+
+  def weight(self, source, weight):
+    '''Give the client ``source`` (``StubSocket.source``, its zeromq
+    identity) ``weight`` times the default share of the server.'''
+    self._admission.weights[source] = weight
+
+  def _relay(self, handle, req):
+    '''Reserved RPC: forward a `RelayRequest` to the rest of its subtree,
+    and run the request here.
+
+    Replies with the list of results for the subtree, this server first.
+    '''
+    subtrees = _split_tree(req.children, req.fanout)
+    relay = _Relay(handle, [1] + [len(t) for t in subtrees])
+    for idx, subtree in enumerate(subtrees):
+      child = self._relay_client(subtree[0])
+      f = child._relay(RelayRequest(req.method, subtree[1:], req.fanout, req.data, req.buffers),
+                       deadline=handle.deadline)
+      when_done(f, lambda result, idx=idx + 1: relay.set(idx, result))
+
+    # run the request here as if it had been read from the socket.
+    local = _RelayedRequest(handle, relay)
+    try:
+      getattr(self, req.method)
+    except AttributeError:
+      local.done(capture_exception())
+      return
+    header = wire.Header(handle.rpc_id, req.method, format=handle.wire_format,
+                         deadline=handle.deadline)
+    self._submit(req.method, local, header, cStringIO.StringIO(req.data), req.buffers)
+
+  def _relay_client(self, addr):
+    with self._relay_lock:
+      client = self._relay_clients.get(addr)
+      if client is None:
+        from . import zeromq
+        client = Client(zeromq.client_socket(addr))
+        self._relay_clients[addr] = client
+      return client
+
   @property
   def addr(self):
     return self._socket.addr
@@ -267,26 +1118,177 @@ class Server(object):
   def serve_nonblock(self):
 #    util.log_info('Running.')
     self._running = True
+    if self._process_pool:
+      self._process_pool.start(self)
     self._socket.bind()
   
   def handle_read(self, socket):
     #util.log_info('Reading...')
 
-    data = socket.recv()
-    reader = cStringIO.StringIO(data)
-    header = cPickle.load(reader)
+    try:
+      frames = socket.recv()
+      header, payload, buffers = decode_header(frames)
+    except:
+      util.log_warn('Dropping malformed request.', exc_info=1)
+      return
+
+    #util.log_info('Reading: %s %s', self._socket.addr, header.rpc_id)
+    rpc_name = header.method
+    if rpc_name == '_credit':
+      self._credit(socket, header, payload, buffers)
+      return
+    if rpc_name == '_chunk':
+      self._chunk(socket, header, payload, buffers)
+      return
 
-    #util.log_info('Reading: %s %s', self._socket.addr, header['rpc_id'])
-    handle = PendingRequest(socket, header['rpc_id'])
-    rpc_name = header['method']
+    method_stats = None
+    if config.collect_stats:
+      method_stats = self._method_stats.method(rpc_name)
+    handle = PendingRequest(socket, header.rpc_id, header.format,
+                            stats=method_stats, bytes_in=message_size(frames),
+                            deadline=header.deadline)
+    if header.window is not None:
+      handle.stream = _ReplyStream(handle, header.window, self._thread_pool, self._streams,
+                                   (_source(socket), header.rpc_id))
+    if handle.expired():
+      # the caller has given up: don't spend time decoding or running it.
+      handle.expire()
+      return
 
     # This is basically equivalent to hasattr, but we want to handle the exception here.
     try:
-      rpc_handler = getattr(self, rpc_name)
-    except KeyError:
+      getattr(self, rpc_name)
+    except AttributeError:
       handle.done(capture_exception())
       return
 
+    if handle.stream is not None and self._process_pool:
+      # workers can't see the client's flow control credit.
+      handle.done(RPCException(py_exc='Streamed calls are not supported by process pool servers; '
+                                      'call %s without .stream() instead.' % rpc_name))
+      return
+
+    if header.flags & wire.FLAG_UPLOAD:
+      self._start_upload(socket, rpc_name, handle, header, payload, buffers)
+    else:
+      self._submit(rpc_name, handle, header, payload, buffers)
+
+  def _submit(self, rpc_name, handle, header, payload, buffers):
+    # a relay only forwards: the request it runs here is admitted itself.
+    if self._admission.active and rpc_name != '_relay':
+      self._admit(rpc_name, handle, header, payload, buffers)
+    else:
+      self._start(rpc_name, handle, header, payload, buffers)
+
+  def _start_upload(self, socket, rpc_name, handle, header, payload, buffers):
+    'The body of this request follows in ``_chunk`` messages.'
+    try:
+      sizes = decode_body(header, payload, buffers)
+      upload = _Upload(rpc_name, handle, header, sizes)
+    except:
+      handle.done(capture_exception())
+      return
+
+    key = (_source(socket), header.rpc_id)
+    self._uploads[key] = upload
+    self._schedule_reap(key, upload)
+
+  def _schedule_reap(self, key, upload):
+    delay = upload.last_active + config.upload_timeout - time.time()
+    if upload.handle.deadline is not None:
+      delay = min(delay, upload.handle.deadline - time.time())
+    timer.schedule(max(0, delay), self._reap_upload, key, upload)
+
+  def _reap_upload(self, key, upload):
+    '''Timer: drop ``upload`` (and its buffers) if the client has stopped
+    sending chunks, or its deadline has passed.'''
+    if self._uploads.get(key) is not upload:
+      # finished
+      return
+    expired = upload.handle.expired()
+    if not expired and time.time() - upload.last_active < config.upload_timeout:
+      self._schedule_reap(key, upload)
+      return
+
+    if self._uploads.pop(key, None) is not upload:
+      return
+    if expired:
+      upload.handle.expire()
+    else:
+      # the client has gone away
+      upload.handle.done(RPCException(py_exc='Upload timed out.'))
+
+  def _chunk(self, socket, header, payload, buffers):
+    '''Reserved message: a chunk of upload ``header.rpc_id``, which is
+    acknowledged with a partial reply.'''
+    key = (_source(socket), header.rpc_id)
+    upload = self._uploads.get(key)
+    if upload is None:
+      return
+
+    handle = upload.handle
+    try:
+      idx, offset = cPickle.load(payload)
+      handle.bytes_in += upload.add(idx, offset, buffers[0])
+    except:
+      if self._uploads.pop(key, None) is upload:
+        handle.done(capture_exception())
+      return
+
+    handle.socket.send(handle._encode(upload.chunks, wire.FLAG_PARTIAL))
+    if upload.remaining == 0:
+      if self._uploads.pop(key, None) is not upload:
+        # reaped meanwhile
+        return
+      pieces = upload.pieces
+      self._submit(upload.rpc_name, handle, upload.header,
+                   cStringIO.StringIO(buffer(pieces[0])[:]), pieces[1:])
+
+  def _credit(self, socket, header, payload, buffers):
+    '''Reserved message: flow control credit for the streamed reply to
+    request ``header.rpc_id`` (see `_ReplyStream.grant`).  No reply.'''
+    stream = self._streams.get((_source(socket), header.rpc_id))
+    if stream is not None:
+      stream.grant(decode_body(header, payload, buffers))
+
+  def _admit(self, rpc_name, handle, header, payload, buffers):
+    handle.on_finished = lambda handle: self._finished(rpc_name)
+    status = self._admission.submit(rpc_name, (rpc_name, handle, header, payload, buffers),
+                                    _source(handle.socket))
+    if status == admission.RUN:
+      self._start(rpc_name, handle, header, payload, buffers)
+    elif status == admission.REJECTED:
+      handle.on_finished = None
+      if handle.stats is not None:
+        handle.stats.record(rejected=1)
+      handle.done(Overloaded(py_exc='Server %s is overloaded: %d requests queued.' % (
+        self.addr, self._admission.max_queue)))
+
+  def _finished(self, rpc_name):
+    '''Called when an admitted request finishes: start queued requests
+    which may now run.'''
+    self._admission.release(rpc_name)
+    if getattr(self._draining, 'active', False):
+      # a request started by the loop below finished straight away;
+      # the loop picks up the next one.
+      return
+
+    self._draining.active = True
+    try:
+      while True:
+        item = self._admission.next()
+        if item is None:
+          break
+        self._start(*item)
+    finally:
+      self._draining.active = False
+
+  def _start(self, rpc_name, handle, header, payload, buffers):
+    if handle.expired():
+      # (it may have waited in the admission queue)
+      handle.expire()
+      return
+
     try:
       # Run the handler on the process pool, not on this thread.
       # Handler is responsible for calling handle.done on the result.
@@ -294,61 +1296,271 @@ class Server(object):
       # calls handle.done() so the programmer can't forget.  The rpc handlers must return a
       # (result, status) tuple, and we can check the value in the wrapper.  Would need to change
       # a bunch of code that calls handle.done() early on exceptions/errors.
-      req = read(reader)
+      if self._process_pool and rpc_name != '_relay':
+        # Workers decode the request themselves.
+        self._process_pool.submit(handle, rpc_name, header, payload, buffers)
+        return
+
+      req = decode_body(header, payload, buffers)
       # TODO(madadam): put the req into the PendingRequest object, stop passing around both.
-      args = (self, rpc_name, handle, req)
-      if self._thread_pool:
-        self._thread_pool.apply_async(run_rpc, args)
-      else:
-        run_rpc(*args)
+      self._dispatch(rpc_name, handle, req)
     except:
       util.log_info('Exception in handle_read.', exc_info=1)
       handle.done(capture_exception())
 
+  def _dispatch(self, rpc_name, handle, req):
+    '''Run the handler for ``rpc_name``.
+
+    Called from the polling thread; subclasses may override this to run
+    handlers elsewhere.
+    '''
+    args = (self, rpc_name, handle, req)
+    if self._thread_pool:
+      self._thread_pool.apply_async(run_rpc, args)
+    else:
+      run_rpc(*args)
+
   def shutdown(self):
     self._running = 0
-    if self._threadpool:
-      self._threadpool.close()
-      self._threadpool.join()
+    if self._thread_pool:
+      self._thread_pool.close()
+      self._thread_pool.join()
+    if self._process_pool:
+      self._process_pool.close()
+      self._process_pool.join()
+    for client in self._relay_clients.values():
+      client.close()
+    self._relay_clients.clear()
     self._socket.close()
     del self._socket
 
 
+class PendingTable(object):
+  '''Outstanding `Future` objects of a client, by rpc id.
+
+  Futures are kept in a slot array indexed by ``rpc_id % capacity``.  Ids
+  are allocated sequentially and most calls finish quickly, so live ids
+  rarely collide; on a collision with a timed out future the old future
+  is dropped, otherwise the table doubles in size.
+
+  Writers hold a lock; `get` does not.  The array and its mask are
+  published together as one ``(slots, mask)`` tuple, so a reader never
+  sees a half-grown table.
+  '''
+  def __init__(self, capacity=1024):
+    assert capacity & (capacity - 1) == 0, 'Capacity must be a power of 2.'
+    self._table = ([None] * capacity, capacity - 1)
+    self._count = 0
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return self._count
+
+  def __contains__(self, rpc_id):
+    return self.get(rpc_id) is not None
+
+  def __getitem__(self, rpc_id):
+    f = self.get(rpc_id)
+    if f is None:
+      raise KeyError(rpc_id)
+    return f
+
+  def get(self, rpc_id, default=None):
+    slots, mask = self._table
+    f = slots[rpc_id & mask]
+    if f is None or f.rpc_id != rpc_id:
+      return default
+    return f
+
+  def __setitem__(self, rpc_id, future):
+    with self._lock:
+      while True:
+        slots, mask = self._table
+        idx = rpc_id & mask
+        cur = slots[idx]
+        if cur is None:
+          self._count += 1
+          break
+        if cur.rpc_id == rpc_id:
+          break
+        if cur.timed_out():
+          self._count -= 1
+          slots[idx] = None
+          continue
+        self._grow()
+      slots[idx] = future
+
+  def pop(self, rpc_id, default=None):
+    with self._lock:
+      slots, mask = self._table
+      idx = rpc_id & mask
+      f = slots[idx]
+      if f is None or f.rpc_id != rpc_id:
+        return default
+      slots[idx] = None
+      self._count -= 1
+      return f
+
+  def values(self):
+    return [f for f in self._table[0] if f is not None]
+
+  def _grow(self):
+    old = self._table[0]
+    slots = [None] * (len(old) * 2)
+    mask = len(slots) - 1
+    for f in old:
+      if f is not None:
+        slots[f.rpc_id & mask] = f
+    self._table = (slots, mask)
+
+
 class ProxyMethod(object):
   def __init__(self, client, method):
     self.client = client
     self.socket = client._socket
     self.method = method
 
-  def __call__(self, request=None):
-    rpc_id = RPC_ID.next()
+  def __call__(self, request=None, deadline=None):
+    '''Send the request.
 
-    header = { 'method' : self.method, 'rpc_id' : rpc_id }
+    :param deadline: time (``time.time()``) after which the result is no
+      longer wanted; the future times out then, and the server skips the
+      request if it has not started it.  Default: ``DEFAULT_TIMEOUT``
+      seconds from now.
+    '''
+    if isinstance(request, PickledData):
+      data, buffers = request.data, request.buffers
+    else:
+      data, buffers = serialization.dumps(request)
+
+    ttl = self.client._cacheable.get(self.method, NO_RESULT)
+    if ttl is NO_RESULT:
+      return self._send(data, buffers, deadline)
+
+    key = cache.request_key(self.method, data, buffers)
+    f, hit = self.client._cache.lookup(key, ttl, lambda: self._send(data, buffers, deadline))
+    if config.collect_stats:
+      self.client._method_stats.method(self.method).record(cache_hits=int(hit),
+                                                           cache_misses=int(not hit))
+    if not hit:
+      f._add_listener(lambda f: self._uncache_error(key, f))
+    return f
 
-    f = Future(self.socket.addr, rpc_id)
+  def _uncache_error(self, key, f):
+    # don't keep errors around
+    if isinstance(f.result, RPCException):
+      self.client._cache.discard(key, f)
+
+  def stream(self, request=None, window=None, deadline=None):
+    '''Send the request to a streaming handler (one which calls
+    ``handle.send_partial``, or yields its results).
+
+    Returns a `Stream`, which yields the chunks of the result as they
+    arrive.
+
+    :param window: chunks the server may send ahead of the consumer
+      (default ``config.stream_window``).
+    :param deadline: as for ``__call__``, for the whole stream; by
+      default the stream times out after ``DEFAULT_TIMEOUT`` seconds
+      without a chunk.
+    '''
+    assert self.client._wire_format == wire.FORMAT_BINARY, 'Streaming needs binary headers.'
+    if isinstance(request, PickledData):
+      data, buffers = request.data, request.buffers
+    else:
+      data, buffers = serialization.dumps(request)
+    return self._send(data, buffers, deadline, window or config.stream_window)
+
+  def upload(self, request=None, chunk_size=None, window=None, deadline=None):
+    '''Send a large request in chunks, so that other messages on the
+    socket are not held up behind it.
+
+    The request is serialized as usual, except that large arrays are
+    not copied (so they must not be modified until the upload is done),
+    and sent in chunks of ``chunk_size`` bytes (default
+    ``config.upload_chunk_size``), at most ``window`` (default
+    ``config.upload_window``) of them ahead of the server.  The server
+    reassembles it into preallocated buffers, then runs the handler as
+    for any other call.  Returns a `Future` for the result.
+    '''
+    assert self.client._wire_format == wire.FORMAT_BINARY, 'Uploads need binary headers.'
+    chunk_size = chunk_size or config.upload_chunk_size
+    if isinstance(request, PickledData):
+      data, buffers = request.data, request.buffers
+    else:
+      data, buffers = serialization.dumps(request, copy=False)
+
+    pieces = [data] + [b.tobytes() if isinstance(b, memoryview) else b for b in buffers]
+    sizes = [_nbytes(p) for p in pieces]
+    if sum(sizes) <= chunk_size:
+      return self._send(data, buffers, deadline)
+
+    rpc_id = self.client._rpc_ids.next() & RPC_ID_MASK
+    f = Upload(self.client, rpc_id, pieces, chunk_size, window or config.upload_window)
+    if deadline is not None:
+      f._deadline = deadline
+      f._refresh_deadline = False
     self.client._futures[rpc_id] = f
 
-    w = cStringIO.StringIO()
-    cPickle.dump(header, w, -1)
+    header = wire.Header(rpc_id, self.method, flags=wire.FLAG_UPLOAD,
+                         format=self.client._wire_format,
+                         deadline=deadline if config.send_deadlines else None)
+    msg = encode_message(header, cPickle.dumps(sizes, -1), [])
+    if config.collect_stats:
+      f.stats = self.client._method_stats.method(self.method)
+      f.stats.record(calls=1, bytes_out=message_size(msg))
+    self.socket.send(msg)
+    f._send_chunks()
+    return f
 
-    if isinstance(request, PickledData):
-      w.write(request.data)
+  def _send(self, data, buffers, deadline=None, window=None):
+    rpc_id = self.client._rpc_ids.next() & RPC_ID_MASK
+
+    if window is None:
+      f = self.client._new_future(rpc_id)
     else:
-      serialize_to(request, w)
+      f = self.client._new_stream(rpc_id, window)
+    if deadline is not None:
+      f._deadline = deadline
+      f._refresh_deadline = False
+    self.client._futures[rpc_id] = f
+
+    # a stream without a deadline only times out between chunks.
+    send_deadline = config.send_deadlines and (window is None or deadline is not None)
+    header = wire.Header(rpc_id, self.method, format=self.client._wire_format,
+                         deadline=f._deadline if send_deadline else None,
+                         window=window)
 
     #util.log_info('Sending %s', self.method)
 #    if len(serialized) > 800000:
 #      util.log_info('%s::\n %s; \n\n\n %s', self.method, ''.join(traceback.format_stack()), request)
 
-    self.socket.send(w.getvalue())
+    msg = encode_message(header, data, buffers)
+    if config.collect_stats:
+      f.stats = self.client._method_stats.method(self.method)
+      f.stats.record(calls=1, bytes_out=message_size(msg))
+    self.socket.send(msg)
     return f
 
 class Client(object):
-  def __init__(self, socket):
+  def __init__(self, socket, wire_format=None):
+    '''
+    :param socket: `SocketBase` to send requests on.
+    :param wire_format: header format for requests: ``wire.FORMAT_BINARY``,
+      or ``wire.FORMAT_PICKLE`` to talk to servers which only understand
+      pickled headers.  Defaults to ``config.wire_format``.
+    '''
     self._socket = socket
     self._socket.register_handler(self.handle_read)
     self._socket.connect()
-    self._futures = {}
+    # next() on a count is atomic, so ids can be allocated from any thread.
+    self._rpc_ids = itertools.count(1)
+    self._futures = PendingTable()
+    self._wire_format = wire_format or config.wire_format
+    self._method_stats = stats.Stats()
+    # method name -> time to live of cached results (see `cacheable`).
+    self._cacheable = {}
+    self._cache = cache.ResultCache(config.client_cache_size)
 
   def __reduce__(self, *args, **kwargs):
     raise cPickle.PickleError('Not pickleable.')
@@ -362,16 +1574,62 @@ class Client(object):
   def __getattr__(self, method_name):
     return ProxyMethod(self, method_name)
 
+  def _new_future(self, rpc_id):
+    return Future(self._socket.addr, rpc_id)
+
+  def _new_stream(self, rpc_id, window):
+    return Stream(self, rpc_id, window)
+
+  def _grant(self, rpc_id, n):
+    'Send flow control credit for ``n`` chunks of stream ``rpc_id`` (-1: close it).'
+    header = wire.Header(rpc_id, '_credit', format=self._wire_format)
+    data, buffers = serialization.dumps(n)
+    self._socket.send(encode_message(header, data, buffers))
+
+  def local_stats(self):
+    '''Returns a `stats.Stats.snapshot` of the calls made by this client.'''
+    return self._method_stats.snapshot()
+
+  def cacheable(self, method, ttl=None):
+    '''Cache the results of ``method``, which must be idempotent.
+
+    Calls with the same (serialized) request share one future: while
+    the first call is in flight, and until ``ttl`` seconds (default
+    ``config.client_cache_ttl``) after it was made.
+    '''
+    if ttl is None:
+      ttl = config.client_cache_ttl
+    self._cacheable[method] = ttl
+
+  def cache_stats(self):
+    '''Size, hits, misses and evictions of the result cache.'''
+    return self._cache.snapshot()
+
   def handle_read(self, socket):
-    data = socket.recv()
-    reader = cStringIO.StringIO(data)
-    header = cPickle.load(reader)
-    resp = read(reader)
+    frames = socket.recv()
+    header, resp = decode_message(frames)
     #resp = cPickle.load(reader)
-    rpc_id = header['rpc_id']
-    f = self._futures[rpc_id]
+    rpc_id = header.rpc_id
+    if header.flags & wire.FLAG_PARTIAL:
+      f = self._futures.get(rpc_id)
+      if f is None:
+        util.log_info('Dropping chunk for unknown stream %s', rpc_id)
+        return
+      if f.stats is not None:
+        f.stats.record(bytes_in=message_size(frames))
+      f._add_chunk(resp)
+      return
+
+    f = self._futures.pop(rpc_id)
+    if f is None:
+      util.log_info('Dropping reply for unknown request %s', rpc_id)
+      return
+
+    if f.stats is not None:
+      f.stats.record(errors=int(isinstance(resp, RPCException)),
+                     bytes_in=message_size(frames),
+                     latency=time.time() - f._start)
     f._set_result(resp)
-    del self._futures[rpc_id]
 
   def close(self):
     self._socket.close()
@@ -384,18 +1642,122 @@ class Client(object):
     self.close()
 
 
-def forall(clients, method, request):
+def forall(clients, method, request, fanout=None):
   '''Invoke ``method`` with ``request`` for each client in ``clients``
 
   ``request`` is only serialized once, so this is more efficient when
   targeting multiple workers with the same data.
 
-  Returns a future wrapping all of the requests.
+  With ``fanout`` (default ``config.forall_fanout``) set and more clients
+  than that, the request is only sent to ``fanout`` of the servers, which
+  relay it (still serialized) down a tree of the others.  The caller
+  then sends O(fanout) copies instead of O(len(clients)), and the
+  broadcast takes O(log(len(clients))) steps.  Servers must be able to
+  connect to each other at the addresses of ``clients``.
+
+  Returns a future wrapping all of the requests, in the order of ``clients``.
   '''
-  futures = []
-  pickled = PickledData(data=serialize(request))
-  for c in clients:
-    futures.append(getattr(c, method)(pickled))
+  if fanout is None:
+    fanout = config.forall_fanout
 
+  futures = []
+  data, buffers = serialization.dumps(request)
+  if not fanout or len(clients) <= fanout:
+    pickled = PickledData(data=data, buffers=buffers)
+    for c in clients:
+      futures.append(getattr(c, method)(pickled))
+    return FutureGroup(futures)
+
+  for subtree in _split_tree(list(clients), fanout):
+    children = [c.addr() for c in subtree[1:]]
+    f = subtree[0]._relay(RelayRequest(method, children, fanout, data, buffers))
+    for i in range(len(subtree)):
+      futures.append(FnFuture(f, lambda results, i=i: _relayed_result(results, i)))
   return FutureGroup(futures)
 
+def _relayed_result(results, idx):
+  if results is None:
+    # the relay itself failed, and remote exceptions are ignored.
+    return None
+  result = results[idx]
+  if isinstance(result, RPCException):
+    return _remote_error(result)
+  return result
+
+
+
+def scatter(clients, method, array, axis=0):
+  '''Invoke ``method`` on each client with its own part of ``array``.
+
+  ``array`` is split along ``axis`` into ``len(clients)`` nearly equal
+  parts (with `numpy.array_split`, so the parts are views, not copies);
+  a list with one request per client may be given instead.
+
+  Returns a `FutureGroup` of the requests, in the order of ``clients``.
+  '''
+  if numpy is not None and isinstance(array, numpy.ndarray):
+    parts = numpy.array_split(array, len(clients), axis=axis)
+  else:
+    parts = list(array)
+  assert len(parts) == len(clients), (len(parts), len(clients))
+  return FutureGroup(getattr(c, method)(part) for c, part in zip(clients, parts))
+
+
+def gather(futures, axis=0):
+  '''Wait for ``futures`` and concatenate their (array) results along ``axis``,
+  in the order of ``futures``.
+
+  The parts are copied once, into the result.  Non-array results are
+  returned as a list.
+  '''
+  results = [f.wait() for f in futures]
+  if numpy is not None and results and all(isinstance(r, numpy.ndarray) for r in results):
+    return numpy.concatenate(results, axis=axis)
+  return results
+
+
+# in-place equivalents of reduction operators, for arrays.
+_INPLACE = {}
+if numpy is not None:
+  _INPLACE = { operator.add : numpy.add,
+               operator.mul : numpy.multiply,
+               max : numpy.maximum,
+               min : numpy.minimum }
+
+def _combine(op, acc, value):
+  inplace = _INPLACE.get(op, op)
+  if (numpy is not None and isinstance(inplace, numpy.ufunc) and
+      isinstance(acc, numpy.ndarray) and acc.shape == numpy.shape(value)):
+    return inplace(acc, value, out=acc)
+  return op(acc, value)
+
+def reduce(futures, op=operator.add):
+  '''Combine the results of ``futures`` with ``op``, in the order they arrive.
+
+  Each result is folded into the running total as soon as it arrives,
+  and is not kept afterwards.  For arrays, ``operator.add``,
+  ``operator.mul``, ``max``, ``min`` and numpy ufuncs update the total in
+  place.  ``op`` must be associative and commutative.
+  '''
+  total = NO_RESULT
+  for f in as_completed(futures):
+    value = f.wait()
+    if total is NO_RESULT:
+      # received arrays are read-only views of the message.
+      if numpy is not None and isinstance(value, numpy.ndarray):
+        value = value.copy()
+      total = value
+    else:
+      total = _combine(op, total, value)
+  return None if total is NO_RESULT else total
+
+
+def allreduce(clients, method, request, update_method, op=operator.add, fanout=None):
+  '''Reduce the results of ``method`` across ``clients``, then send the
+  total to every client through ``update_method``.
+
+  Both steps use `forall` (with ``fanout``).  Returns the total.
+  '''
+  total = reduce(forall(clients, method, request, fanout=fanout), op)
+  forall(clients, update_method, total, fanout=fanout).wait()
+  return total
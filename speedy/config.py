@@ -1,4 +1,122 @@
 # should future.wait() throw an exception on remote errors?
 throw_remote_exceptions = True
 
+# buffers (numpy arrays, strings, memoryviews) at least this many bytes
+# are sent as separate zeromq frames instead of being pickled.
+oob_threshold = 16 * 1024
 
+# copy out of band buffers when a message is serialized?  Without the
+# copy, an array (or memoryview) passed to a call, or returned by a
+# handler, must not be modified until the message has been sent.
+oob_copy = True
+
+# header format used by clients: 'binary' or 'pickle' (for old servers).
+wire_format = 'binary'
+
+# accept messages with the old pickled dict header?
+accept_legacy_header = True
+
+# send the deadline of each call (an absolute time, so clocks of clients
+# and servers should be in sync) with the request?
+send_deadlines = True
+
+# what a server does with requests whose deadline passed before they
+# ran: 'reject' replies with an ExpiredRequest error, 'drop' does not reply.
+expired_requests = 'reject'
+
+# admission control (see speedy.admission): requests a server runs at
+# once (0: no limit), and requests queued beyond that.  When the queue is
+# full, 'reject' replies with a retryable Overloaded error, 'pause' stops
+# reading from the socket so that zeromq pushes back on the clients.
+server_max_inflight = 0
+server_max_queue = 1000
+server_overload_policy = 'reject'
+
+# running slots (of server_max_inflight) kept for high priority methods.
+server_reserved_inflight = 0
+
+# poller mode: 'event' blocks until a socket or the wakeup pipe is ready,
+# 'backoff' polls with a timeout that grows while idle.
+poller_mode = 'event'
+
+# number of polling threads, and how sockets are assigned to them
+# ('hash' or 'least_loaded').
+poller_threads = 1
+poller_assignment = 'least_loaded'
+
+# size of the shared memory arena used to pass requests to a ProcessPool.
+process_pool_arena_size = 256 * 1024 * 1024
+
+# record per-method call counts, sizes and latencies (see speedy.stats)?
+collect_stats = True
+
+# pack runs of small messages (at most coalesce_max_message bytes) to the
+# same peer into one zeromq message, up to coalesce_max_batch at a time.
+coalesce_writes = False
+coalesce_max_message = 4096
+coalesce_max_batch = 256
+
+# maximum number of messages read from a socket per poll.
+max_reads_per_poll = 64
+
+# shared memory transport (speedy.shm): size of each ring buffer, frames
+# larger than shm_segment_threshold bytes are passed in their own shared
+# memory file, created in shm_dir (default: /dev/shm, or the temp dir).
+shm_ring_size = 8 * 1024 * 1024
+shm_segment_threshold = 64 * 1024
+shm_dir = None
+
+# tcp servers also listen on an ipc:// endpoint derived from their host
+# and port; with prefer_ipc, clients of a server on the same host connect
+# to it (using the same host name as the server bound) instead of going
+# through tcp.
+server_ipc_alias = False
+prefer_ipc = False
+
+# forall with more than this many clients relays the request through a
+# tree of servers, each forwarding to at most this many others (0: send
+# to every client directly).
+forall_fanout = 0
+
+# client result cache (see Client.cacheable): maximum number of entries,
+# and the default number of seconds results are kept.
+client_cache_size = 10000
+client_cache_ttl = 60
+
+# PoolClient: how to pick a replica ('least_outstanding' or 'p2c'), and
+# how long a replica is taken out of rotation (pool_eject_period) once a
+# request to it has been outstanding for pool_eject_timeout seconds.
+pool_policy = 'p2c'
+pool_eject_timeout = 10.0
+pool_eject_period = 30.0
+
+# PoolClient.idempotent defaults: retries per call, seconds to wait for
+# each attempt, and the delay before the first retry (doubled after).
+retries = 2
+retry_timeout = 10.0
+retry_backoff = 0.01
+
+# hedge=True sends a duplicate request once a call has taken longer than
+# this percentile of its measured latency (measured over at least
+# hedge_min_samples calls, and at least hedge_min_delay seconds).
+hedge_percentile = 95
+hedge_min_samples = 20
+hedge_min_delay = 0.001
+
+# defaults for speedy.batch.batched handlers: requests per call, and how
+# long (in seconds) the first request waits for more.
+batch_max_size = 64
+batch_max_delay = 0.001
+
+# chunks of a streamed result (see ProxyMethod.stream) which the server
+# may send ahead of the consumer.
+stream_window = 16
+
+# chunked uploads (see ProxyMethod.upload): bytes per chunk, chunks sent
+# ahead of the server's acknowledgements, how long (in seconds) a server
+# keeps an upload which has stopped receiving chunks, and the largest
+# upload (in bytes) a server will allocate buffers for.
+upload_chunk_size = 4 << 20
+upload_window = 4
+upload_timeout = 100.0
+upload_max_bytes = 16 << 30
@@ -0,0 +1,327 @@
+'''
+Load balancing over replicas of a server.
+
+A :class:`PoolClient` keeps one `Client` (and socket) per replica and
+sends each call to one of them::
+
+  pool = PoolClient([('host1', 9000), ('host2', 9000)])
+  result = pool.lookup(request).wait()
+
+Replicas are chosen by the number of requests outstanding on each
+(the depth of the client's pending table), either the least loaded of
+all (``least_outstanding``) or the less loaded of two picked at random
+(``p2c``); see ``config.pool_policy``.
+
+A replica whose oldest request has been outstanding for longer than
+``config.pool_eject_timeout`` is taken out of rotation for
+``config.pool_eject_period`` seconds, then tried again.
+
+Methods marked with :meth:`PoolClient.idempotent` may be retried and
+hedged::
+
+  pool.idempotent('lookup', retries=2, timeout=0.5, hedge=True)
+  pool.lookup(request, hedge=0.01)   # per call options
+
+* Retries: an attempt which has no answer after ``timeout`` seconds is
+  sent again (to another replica if there is one) after an exponential
+  backoff, up to ``retries`` times.  Late answers to earlier attempts
+  are still accepted.
+* Overloaded replicas (see speedy.admission) reject requests without
+  running them; these are retried straight away (after the backoff).
+* Hedging: if there is no answer after ``hedge`` seconds (or, with
+  ``hedge=True``, the ``config.hedge_percentile`` latency of the method)
+  a duplicate is sent to another replica.
+
+The first answer wins; the other attempts are cancelled (their replies
+are dropped, but the servers still run them).
+'''
+import collections
+import random
+import threading
+import time
+
+from . import config, serialization, stats, timer, util
+from .common import Client, Future, Overloaded, PickledData, ProxyMethod, RPCException
+
+POLICIES = ('least_outstanding', 'p2c')
+
+
+class Replica(object):
+  '''One server in a `PoolClient`.'''
+  def __init__(self, client):
+    self.client = client
+    self.addr = client.addr()
+    self.calls = 0
+    self.ejections = 0
+    self.ejected_until = 0
+    # outstanding futures sent through the pool, oldest first
+    self._inflight = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def outstanding(self):
+    return len(self.client._futures)
+
+  def available(self, now):
+    return self.ejected_until <= now
+
+  def sent(self, future):
+    with self._lock:
+      self.calls += 1
+      self._inflight[future] = time.time()
+    future._add_listener(self._replied)
+
+  def _replied(self, future):
+    with self._lock:
+      self._inflight.pop(future, None)
+
+  def cancel(self, future):
+    'Stop waiting for ``future``: a reply to it will be dropped.'
+    if self.client._futures.get(future.rpc_id) is future:
+      self.client._futures.pop(future.rpc_id)
+    self._replied(future)
+
+  def check(self, now):
+    '''Take this replica out of rotation if its oldest request has timed out.
+
+    Returns True if it is (still) available.
+    '''
+    if not self.available(now):
+      return False
+
+    with self._lock:
+      if not self._inflight:
+        return True
+      oldest = next(self._inflight.itervalues())
+      if now - oldest <= config.pool_eject_timeout:
+        return True
+      # the outstanding requests are considered lost.
+      lost = list(self._inflight)
+      self._inflight.clear()
+      self.ejections += 1
+      self.ejected_until = now + config.pool_eject_period
+
+    # (or they would count against this replica once it is back)
+    for f in lost:
+      self.cancel(f)
+    util.log_warn('Replica %s timed out; ejected for %s seconds.',
+                  self.addr, config.pool_eject_period)
+    return False
+
+  def snapshot(self, now):
+    return { 'addr' : self.addr,
+             'calls' : self.calls,
+             'outstanding' : self.outstanding(),
+             'ejections' : self.ejections,
+             'available' : self.available(now) }
+
+
+class _Call(object):
+  '''A call which may be retried or hedged (see `PoolClient.idempotent`).'''
+  def __init__(self, pool, method, request, retries, timeout, backoff, hedge, deadline=None):
+    self.pool = pool
+    self.method = method
+    self.request = request
+    self.deadline = deadline
+    self.retries = retries
+    self.timeout = timeout
+    self.backoff = backoff
+    self.future = Future(None, 0)
+    self.done = False
+    # (replica, future) for each request sent
+    self.attempts = []
+    self._lock = threading.Lock()
+
+    self._send()
+    if hedge is not None:
+      timer.schedule(hedge, self._hedge)
+
+  def _send(self):
+    with self._lock:
+      if self.done:
+        return
+      replica = self.pool._choose(exclude=[r for r, _ in self.attempts])
+      f = ProxyMethod(replica.client, self.method)(self.request, self.deadline)
+      replica.sent(f)
+      attempt = (replica, f)
+      self.attempts.append(attempt)
+
+    f._add_listener(lambda f: self._finished(attempt))
+    if self.timeout is not None:
+      timer.schedule(self.timeout, self._timed_out, attempt)
+
+  def _hedge(self):
+    if not self.done:
+      self._send()
+
+  def _can_retry(self, now):
+    return self.retries > 0 and (self.deadline is None or now < self.deadline)
+
+  def _retry(self):
+    delay = self.backoff * (2 ** (len(self.attempts) - 1)) * random.uniform(0.5, 1.5)
+    timer.schedule(delay, self._send)
+
+  def _finished(self, attempt):
+    replica, f = attempt
+    with self._lock:
+      if self.done:
+        return
+      if isinstance(f.result, Overloaded) and self._can_retry(time.time()):
+        self.retries -= 1
+        retry = True
+      else:
+        retry = False
+        self.done = True
+        losers = [a for a in self.attempts if a is not attempt]
+
+    if retry:
+      self._retry()
+      return
+
+    for r, loser in losers:
+      r.cancel(loser)
+    if not isinstance(f.result, RPCException):
+      self.pool._latency.method(self.method).record(latency=time.time() - f._start)
+    self.future._set_result(f.result)
+
+  def _timed_out(self, attempt):
+    with self._lock:
+      if self.done or attempt[1].have_result:
+        return
+      now = time.time()
+      if self._can_retry(now):
+        self.retries -= 1
+        retry = True
+      else:
+        retry = False
+        # give up, unless another attempt (a hedge) is still running.
+        if any(now - f._start < self.timeout for r, f in self.attempts):
+          return
+        self.done = True
+
+    if retry:
+      self._retry()
+      return
+
+    for r, f in self.attempts:
+      r.cancel(f)
+    self.future._set_result(RPCException(
+      py_exc='Timed out on %s after %d attempts (%s seconds each).' % (
+        self.method, len(self.attempts), self.timeout)))
+
+
+class PoolProxyMethod(object):
+  def __init__(self, pool, method):
+    self.pool = pool
+    self.method = method
+
+  def __call__(self, request=None, deadline=None, **options):
+    '''Call the method on a replica.
+
+    ``deadline`` is passed to each attempt (see `ProxyMethod`); no retries
+    are sent after it.  ``options`` (``retries``, ``timeout``, ``backoff``
+    and ``hedge``) override those given to `PoolClient.idempotent`.
+    '''
+    policy = self.pool._idempotent.get(self.method)
+    if policy is None:
+      if options:
+        raise ValueError('%s must be marked idempotent to be retried or hedged.' % self.method)
+      replica = self.pool._choose()
+      f = ProxyMethod(replica.client, self.method)(request, deadline)
+      replica.sent(f)
+      return f
+
+    policy = dict(policy, **options)
+    hedge = policy['hedge']
+    if hedge is True:
+      hedge = self.pool._hedge_delay(self.method)
+    elif hedge is False:
+      hedge = None
+
+    # serialize once for all attempts
+    if not isinstance(request, PickledData):
+      request = PickledData(*serialization.dumps(request))
+    return _Call(self.pool, self.method, request, policy['retries'], policy['timeout'],
+                 policy['backoff'], hedge, deadline).future
+
+
+class PoolClient(object):
+  '''Sends calls to one of several replicas of a server.'''
+  def __init__(self, addrs, socket_fn=None, policy=None):
+    '''
+    :param addrs: addresses of the replicas.
+    :param socket_fn: creates the client socket for an address
+      (default: `zeromq.client_socket`).
+    :param policy: ``least_outstanding`` or ``p2c`` (default:
+      ``config.pool_policy``).
+    '''
+    if socket_fn is None:
+      from .zeromq import client_socket as socket_fn
+    self._policy = policy or config.pool_policy
+    assert self._policy in POLICIES, self._policy
+    assert len(addrs) > 0
+    self.replicas = [Replica(Client(socket_fn(addr))) for addr in addrs]
+    # method -> retry and hedging options (see `idempotent`)
+    self._idempotent = {}
+    # latency of retried/hedged methods, for choosing when to hedge
+    self._latency = stats.Stats()
+
+  def __getattr__(self, method_name):
+    return PoolProxyMethod(self, method_name)
+
+  def idempotent(self, method, retries=None, timeout=None, backoff=None, hedge=None):
+    '''Mark ``method`` as safe to send more than once.
+
+    :param retries: times an attempt is retried after ``timeout`` seconds
+      without an answer (default ``config.retries``).
+    :param timeout: seconds to wait for each attempt (default ``config.retry_timeout``).
+    :param backoff: delay before the first retry, doubled for each one
+      after (default ``config.retry_backoff``).
+    :param hedge: seconds after which a duplicate request is sent to
+      another replica; True to use the ``config.hedge_percentile``
+      latency of the method; None not to hedge.
+    '''
+    self._idempotent[method] = {
+      'retries' : config.retries if retries is None else retries,
+      'timeout' : timeout or config.retry_timeout,
+      'backoff' : config.retry_backoff if backoff is None else backoff,
+      'hedge' : hedge }
+
+  def _hedge_delay(self, method):
+    '''The ``config.hedge_percentile`` latency of ``method``, or None
+    until enough calls have been measured.'''
+    latency = self._latency.method(method).latency
+    if latency.count < config.hedge_min_samples:
+      return None
+    return max(latency.percentile(config.hedge_percentile), config.hedge_min_delay)
+
+  def _choose(self, exclude=()):
+    now = time.time()
+    replicas = self.replicas
+    if exclude and len(exclude) < len(replicas):
+      replicas = [r for r in replicas if r not in exclude]
+    if self._policy == 'p2c' and len(replicas) > 2:
+      candidates = [r for r in random.sample(replicas, 2) if r.check(now)]
+      if not candidates:
+        candidates = [r for r in replicas if r.check(now)]
+    else:
+      candidates = [r for r in replicas if r.check(now)]
+
+    if not candidates:
+      # everything is out of rotation: better to try than to fail.
+      candidates = replicas
+    return min(candidates, key=Replica.outstanding)
+
+  def stats(self):
+    '''Calls, outstanding requests and ejections of each replica.'''
+    now = time.time()
+    return [r.snapshot(now) for r in self.replicas]
+
+  def close(self):
+    for r in self.replicas:
+      r.client.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.close()
@@ -0,0 +1,267 @@
+'''
+Run `Server` handlers in worker processes.
+
+A :class:`ProcessPool` forks ``num_workers`` copies of the server when
+it starts serving.  Each request is copied, still serialized, into a
+shared memory arena; workers receive only a small task descriptor and
+deserialize the request directly from the arena, so the payload is
+never re-pickled.  Workers encode the reply themselves and send it
+back to the server process, which forwards it to the client.
+
+Usage::
+
+  server = MyServer(zeromq.server_socket(addr), process_pool=4)
+
+Handlers run in a copy of the server made when it started serving;
+changes to server state made by a handler are not visible to other
+workers or to the parent.  Arrays in a request are read-only views of
+the arena, and are only valid until the request is finished.
+'''
+from cStringIO import StringIO
+import cPickle
+import itertools
+import mmap
+import multiprocessing
+import os
+import struct
+import tempfile
+import threading
+import time
+import zmq
+
+from . import batch, config, timer, util, wire, zeromq
+from .common import Group, PendingRequest, capture_exception, decode_body, run_rpc
+
+TASK_ID = struct.Struct('!Q')
+
+# arena allocations are aligned to this many bytes.
+ALIGN = 64
+
+
+class Arena(object):
+  '''First-fit allocator over a shared, anonymous memory mapping.
+
+  The mapping is created before the workers are forked, so parent and
+  workers all see the same memory.
+  '''
+  def __init__(self, size):
+    self.size = size
+    self.mem = mmap.mmap(-1, size)
+    self._free = [(0, size)]
+    self._lock = threading.Lock()
+
+  def alloc(self, n):
+    'Returns the offset of ``n`` free bytes, or None if none are available.'
+    n = max(ALIGN, (n + ALIGN - 1) & ~(ALIGN - 1))
+    with self._lock:
+      for idx, (off, size) in enumerate(self._free):
+        if size >= n:
+          if size == n:
+            del self._free[idx]
+          else:
+            self._free[idx] = (off + n, size - n)
+          return off
+    return None
+
+  def free(self, off, n):
+    n = max(ALIGN, (n + ALIGN - 1) & ~(ALIGN - 1))
+    with self._lock:
+      free = self._free
+      free.append((off, n))
+      free.sort()
+      merged = [free[0]]
+      for off, size in free[1:]:
+        last_off, last_size = merged[-1]
+        if last_off + last_size == off:
+          merged[-1] = (last_off, last_size + size)
+        else:
+          merged.append((off, size))
+      self._free = merged
+
+  def write(self, off, data):
+    with self._lock:
+      self.mem.seek(off)
+      self.mem.write(data)
+
+  def view(self, off, n):
+    return buffer(self.mem, off, n)
+
+
+class _LocalSocket(zeromq.Socket):
+  '''A `zeromq.Socket` bound to a local (ipc://) endpoint.'''
+  def __init__(self, ctx, sock_type, url):
+    zeromq.Socket.__init__(self, ctx, sock_type, url)
+    # workers read tasks one message at a time.
+    self.coalesce = False
+
+  def bind(self):
+    assert self._closed
+    self._closed = False
+    self._zmq.bind(self.addr)
+    self._poller.add(self, zmq.POLLIN)
+
+
+class _Task(object):
+  __slots__ = ['handle', 'segments']
+
+  def __init__(self, handle, segments):
+    self.handle = handle
+    self.segments = segments
+
+
+class ProcessPool(object):
+  '''Executes requests for a `Server` in ``num_workers`` forked processes.'''
+  def __init__(self, num_workers, arena_size=None):
+    self.num_workers = num_workers
+    self.arena = Arena(arena_size or config.process_pool_arena_size)
+    self._task_ids = itertools.count()
+    self._tasks = {}
+    self._lock = threading.Lock()
+    self._workers = []
+    self._tasks_socket = None
+    self._results_socket = None
+
+  def start(self, server):
+    '''Fork the worker processes.
+
+    Called by the server when it starts serving.
+    '''
+    prefix = os.path.join(tempfile.gettempdir(), 'speedy-pool-%d-%d' % (os.getpid(), id(self)))
+    self.tasks_url = 'ipc://%s-tasks' % prefix
+    self.results_url = 'ipc://%s-results' % prefix
+
+    ctx = zmq.Context.instance()
+    self._tasks_socket = _LocalSocket(ctx, zmq.PUSH, self.tasks_url)
+    self._tasks_socket.bind()
+    self._results_socket = _LocalSocket(ctx, zmq.PULL, self.results_url)
+    self._results_socket.register_handler(self._handle_result)
+    self._results_socket.bind()
+
+    for i in range(self.num_workers):
+      p = multiprocessing.Process(target=_worker_main, args=(self, server),
+                                  name='speedy.PoolWorker-%d' % i)
+      p.daemon = True
+      p.start()
+      self._workers.append(p)
+
+  def submit(self, handle, rpc_name, header, payload, buffers):
+    '''Queue a request for execution by a worker.
+
+    ``payload`` and ``buffers`` are the still-encoded request, as returned
+    by `decode_header`.
+    '''
+    task_id = self._task_ids.next()
+    frames = [payload.read()] + list(buffers)
+    segments = []
+    inline = []
+    for frame in frames:
+      n = len(frame)
+      off = self.arena.alloc(n)
+      if off is None:
+        # arena full: send the frame along with the task
+        segments.append(None)
+        inline.append(frame)
+      else:
+        self.arena.write(off, buffer(frame))
+        segments.append((off, n))
+
+    with self._lock:
+      self._tasks[task_id] = _Task(handle, segments)
+
+    desc = (task_id, header.rpc_id, rpc_name, header.codec, header.format, header.deadline,
+            segments)
+    self._tasks_socket.send(Group([cPickle.dumps(desc, -1)] + inline))
+
+  def _handle_result(self, socket):
+    frames = socket.recv()
+    task_id, = TASK_ID.unpack(frames[0].bytes)
+    with self._lock:
+      task = self._tasks.pop(task_id)
+
+    for seg in task.segments:
+      if seg is not None:
+        self.arena.free(*seg)
+    if len(frames) == 1:
+      # expired while queued for a worker
+      task.handle.expire()
+    else:
+      task.handle.forward(Group(frames[1:]))
+
+  def close(self):
+    for _ in self._workers:
+      self._tasks_socket.send(cPickle.dumps(None, -1))
+
+  def join(self):
+    for p in self._workers:
+      p.join()
+    self._workers = []
+    self._tasks_socket.close()
+    self._results_socket.close()
+    for url in (self.tasks_url, self.results_url):
+      try:
+        os.unlink(url[len('ipc://'):])
+      except OSError:
+        pass
+
+
+class _ReplySocket(object):
+  '''Sends a worker's replies back to the server process.'''
+  def __init__(self, task_id, results, lock):
+    self.task_id = task_id
+    self.results = results
+    self.lock = lock
+
+  def send(self, msg):
+    if not isinstance(msg, Group):
+      msg = [msg]
+    with self.lock:
+      self.results.send_multipart([TASK_ID.pack(self.task_id)] + list(msg), copy=False)
+
+
+def _worker_main(pool, server):
+  # The polling, timer and batch flushing threads of the parent do not
+  # exist in this process (and their locks may have been held at the fork).
+  zeromq.POLLER = None
+  zeromq.POLLER_LOCK = threading.RLock()
+  timer.TIMER = None
+  timer.TIMER_LOCK = threading.Lock()
+  batch.FLUSHER = None
+  batch.FLUSHER_LOCK = threading.Lock()
+
+  ctx = zmq.Context()
+  tasks = ctx.socket(zmq.PULL)
+  tasks.setsockopt(zmq.RCVHWM, 1)
+  tasks.connect(pool.tasks_url)
+  results = ctx.socket(zmq.PUSH)
+  results.connect(pool.results_url)
+  lock = threading.Lock()
+  arena = pool.arena
+
+  while True:
+    frames = tasks.recv_multipart(copy=False)
+    desc = cPickle.loads(frames[0].bytes)
+    if desc is None:
+      break
+
+    task_id, rpc_id, rpc_name, codec, wire_format, deadline, segments = desc
+    if deadline is not None and deadline < time.time():
+      with lock:
+        results.send(TASK_ID.pack(task_id))
+      continue
+
+    header = wire.Header(rpc_id, rpc_name, codec=codec, format=wire_format)
+    inline = iter(frames[1:])
+    data = [arena.view(*seg) if seg is not None else inline.next() for seg in segments]
+
+    handle = PendingRequest(_ReplySocket(task_id, results, lock), rpc_id, wire_format)
+    try:
+      req = decode_body(header, StringIO(data[0]), data[1:])
+      run_rpc(server, rpc_name, handle, req)
+    except:
+      util.log_info('Exception in worker.', exc_info=1)
+      if not handle.finished:
+        handle.done(capture_exception())
+
+  tasks.close()
+  results.close(linger=-1)
+  ctx.term()
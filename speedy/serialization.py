@@ -0,0 +1,155 @@
+'''
+Pickle based serialization with out-of-band buffers.
+
+Large contiguous buffers (numpy arrays, strings and memoryviews) are
+not copied into the pickle stream; :func:`dumps` replaces them with a
+small reference and returns them separately, so they can be sent as
+extra zeromq frames.  :func:`loads` rebuilds arrays directly on top
+of the received frames.
+
+Out of band arrays and memoryviews are copied when serialized, unless
+``config.oob_copy`` is off (or ``copy=False`` is passed to :func:`dumps`),
+in which case they are sent straight from the caller's memory.
+
+Arrays rebuilt from received frames are read-only views of the
+message memory.
+'''
+from cPickle import PickleError
+import cPickle
+import cStringIO
+import sys
+
+from . import config
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+try:
+  import cloudpickle
+except ImportError:
+  cloudpickle = None
+
+# Persistent id tags.
+_STR = 0
+_MEMORYVIEW = 1
+_NDARRAY = 2
+
+
+class _Collector(object):
+  '''Pickler ``persistent_id`` hook which pulls large buffers out of band.'''
+  def __init__(self, threshold, copy):
+    self.threshold = threshold
+    self.copy = copy
+    self.buffers = []
+    self._seen = {}
+
+  def _add(self, obj, buf):
+    idx = self._seen.get(id(obj))
+    if idx is None:
+      idx = len(self.buffers)
+      self._seen[id(obj)] = idx
+      self.buffers.append(buf)
+    return idx
+
+  def __call__(self, obj):
+    t = type(obj)
+    if t is str:
+      if len(obj) < self.threshold:
+        return None
+      return (_STR, self._add(obj, obj))
+
+    if t is memoryview:
+      if obj.itemsize * len(obj) < self.threshold:
+        return None
+      return (_MEMORYVIEW, self._add(obj, obj.tobytes() if self.copy else obj))
+
+    if numpy is not None and t is numpy.ndarray:
+      if obj.nbytes < self.threshold or obj.dtype.hasobject:
+        return None
+      if obj.flags.c_contiguous:
+        order = 'C'
+      elif obj.flags.f_contiguous:
+        order = 'F'
+      else:
+        return None
+      # ravel(order='A') of a contiguous array is a view, not a copy.
+      flat = obj.ravel(order='A')
+      if self.copy:
+        flat = flat.copy()
+      # the dtype itself: ``dtype.str`` loses the fields of structured arrays.
+      return (_NDARRAY, self._add(obj, flat), obj.dtype, obj.shape, order)
+
+    return None
+
+
+def dumps(obj, threshold=None, copy=None):
+  '''Serialize ``obj``.
+
+  :param threshold: minimum size in bytes of a buffer sent out of band
+    (defaults to ``config.oob_threshold``).
+  :param copy: copy out of band arrays and memoryviews, rather than
+    referencing the caller's memory (defaults to ``config.oob_copy``).
+  :rtype: tuple of (pickled string, list of out of band buffers)
+  '''
+  if threshold is None:
+    threshold = config.oob_threshold
+  if copy is None:
+    copy = config.oob_copy
+
+  collector = _Collector(threshold, copy)
+  pickler = cPickle.Pickler(-1)
+  pickler.persistent_id = collector
+  try:
+    pickler.dump(obj)
+    return pickler.getvalue(), collector.buffers
+  except (PickleError, TypeError):
+    if cloudpickle is None:
+      raise
+    return cloudpickle.dumps(obj, -1), []
+
+
+class _Resolver(object):
+  '''Unpickler ``persistent_load`` hook which maps references back to buffers.'''
+  def __init__(self, buffers):
+    self.buffers = buffers
+
+  def __call__(self, pid):
+    kind, idx = pid[0], pid[1]
+    buf = self.buffers[idx]
+    if kind == _STR:
+      if hasattr(buf, 'bytes'):
+        return buf.bytes
+      if hasattr(buf, 'tobytes'):
+        return buf.tobytes()
+      return str(buf)
+    if kind == _MEMORYVIEW:
+      return memoryview(buf)
+    if kind == _NDARRAY:
+      _, _, dtype, shape, order = pid
+      return numpy.frombuffer(buf, dtype=dtype).reshape(shape, order=order)
+    raise PickleError('Unknown out of band reference: %s' % (pid,))
+
+
+def load(f, buffers=()):
+  '''Read one object from the file-like ``f``.
+
+  :param buffers: the out of band buffers (``zmq.Frame``, ``str``, or
+    byte arrays) returned by :func:`dumps`.
+  '''
+  unpickler = cPickle.Unpickler(f)
+  unpickler.persistent_load = _Resolver(buffers)
+  return unpickler.load()
+
+
+def loads(data, buffers=()):
+  return load(cStringIO.StringIO(data), buffers)
+
+
+def inline(data, buffers):
+  '''Re-serialize the output of :func:`dumps` as a plain pickle, with
+  the out of band ``buffers`` back in the stream.'''
+  if not buffers:
+    return data
+  return dumps(loads(data, buffers), threshold=sys.maxint)[0]
@@ -0,0 +1,551 @@
+'''
+Same-host transport over shared memory.
+
+Each connection is a pair of single-producer, single-consumer ring
+buffers in shared memory (one per direction), plus a unix domain socket
+used only to signal the other side::
+
+  server = MyServer(shm.shm_server_socket())
+  client = speedy.Client(shm.shm_client_socket(server.addr))
+
+The server address is the path of its unix socket.  Small messages are
+copied through the rings; frames larger than ``config.shm_segment_threshold``
+are written once into their own shared memory file, which the reader
+maps instead of copying.
+
+A byte is written to the unix socket after each message, and by a
+reader which has made space for a writer waiting on a full ring.  The
+bytes themselves carry no meaning: a write which fails because the
+socket buffer is full is dropped, as unread bytes already guarantee the
+peer will wake up and look at the rings.
+'''
+import collections
+import errno
+import itertools
+import mmap
+import os
+import socket
+import stat
+import struct
+import tempfile
+import threading
+import zmq
+
+from .common import Group, SocketBase
+from . import config, util
+from .zeromq import StubSocket, pollers
+
+HANDSHAKE = 'speedy-shm 1'
+
+# ring layout: reader position, writer position and the writer's
+# "waiting for space" flag (on separate cache lines), then the data.
+HEAD_OFFSET = 0
+TAIL_OFFSET = 64
+WAITING_OFFSET = 128
+DATA_OFFSET = 192
+
+POS = struct.Struct('=Q')
+LENGTH = struct.Struct('=I')
+RECORD = struct.Struct('=I')
+FRAME = struct.Struct('=BI')
+
+# record length marking the unused end of the ring
+WRAP = 0xFFFFFFFF
+
+FRAME_INLINE = 0
+FRAME_SEGMENT = 1
+
+_names = itertools.count()
+
+
+def _shm_dir():
+  if config.shm_dir:
+    return config.shm_dir
+  if os.path.isdir('/dev/shm'):
+    return '/dev/shm'
+  return tempfile.gettempdir()
+
+def _new_name(kind):
+  return os.path.join(_shm_dir(), 'speedy-%s-%d-%d' % (kind, os.getpid(), _names.next()))
+
+def _peer_path(name, kind):
+  '''Returns the path of the shared memory file ``name`` sent by a peer.
+
+  Raises ValueError unless it is a ``kind`` file of `_new_name` in the
+  shared memory directory.
+  '''
+  base = os.path.basename(name)
+  if not base.startswith('speedy-%s-' % kind):
+    raise ValueError('Not a speedy %s file: %r' % (kind, name))
+  shm_dir = _shm_dir()
+  if base != name and os.path.realpath(os.path.dirname(name)) != os.path.realpath(shm_dir):
+    raise ValueError('Shared memory file outside of %s: %r' % (shm_dir, name))
+  return os.path.join(shm_dir, base)
+
+def _open_peer_file(path, flags):
+  # the directory is shared: don't follow links planted in it.
+  fd = os.open(path, flags | os.O_NOFOLLOW)
+  if not stat.S_ISREG(os.fstat(fd).st_mode):
+    os.close(fd)
+    raise ValueError('Not a regular file: %r' % path)
+  return fd
+
+def _align(n):
+  return (n + 7) & ~7
+
+def _as_buffer(frame):
+  if isinstance(frame, str):
+    return frame
+  if isinstance(frame, memoryview):
+    return frame.tobytes()
+  return buffer(frame)
+
+
+class Ring(object):
+  '''A single-producer, single-consumer ring of variable length records.
+
+  Positions are byte counts which only grow; the offset of a position in
+  the data area is ``pos % capacity``.  Each record is a 4 byte length
+  followed by the record, padded to 8 bytes.  A record never wraps
+  around the end of the ring; the remainder is skipped with a `WRAP`
+  marker instead.
+  '''
+  def __init__(self, path, size=None):
+    if size is not None:
+      fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0600)
+      os.ftruncate(fd, DATA_OFFSET + size)
+    else:
+      fd = _open_peer_file(path, os.O_RDWR)
+    try:
+      self.mem = mmap.mmap(fd, 0)
+    finally:
+      os.close(fd)
+    self.path = path
+    self.capacity = len(self.mem) - DATA_OFFSET
+    # largest record, so a full ring always drains to make room for one.
+    self.max_record = self.capacity / 4
+
+  def _get(self, offset):
+    return POS.unpack_from(self.mem, offset)[0]
+
+  def _set(self, offset, pos):
+    POS.pack_into(self.mem, offset, pos)
+
+  def write(self, parts, n):
+    '''Append a record made of ``parts`` (``n`` bytes in total).
+
+    Returns False if there is not enough free space.
+    '''
+    cap = self.capacity
+    head = self._get(HEAD_OFFSET)
+    tail = self._get(TAIL_OFFSET)
+    off = tail % cap
+    need = _align(LENGTH.size + n)
+    pad = cap - off if cap - off < need else 0
+    if need + pad > cap - (tail - head):
+      return False
+
+    mem = self.mem
+    if pad:
+      LENGTH.pack_into(mem, DATA_OFFSET + off, WRAP)
+      tail += pad
+      off = 0
+
+    mem.seek(DATA_OFFSET + off)
+    mem.write(LENGTH.pack(n))
+    for p in parts:
+      mem.write(p)
+    # publish the record
+    self._set(TAIL_OFFSET, tail + need)
+    return True
+
+  def read(self):
+    '''Remove and return the next record (as a string), or None.'''
+    cap = self.capacity
+    head = self._get(HEAD_OFFSET)
+    tail = self._get(TAIL_OFFSET)
+    if head == tail:
+      return None
+
+    off = head % cap
+    n = LENGTH.unpack_from(self.mem, DATA_OFFSET + off)[0]
+    if n == WRAP:
+      head += cap - off
+      self._set(HEAD_OFFSET, head)
+      return self.read()
+
+    start = DATA_OFFSET + off + LENGTH.size
+    record = self.mem[start:start + n]
+    self._set(HEAD_OFFSET, head + _align(LENGTH.size + n))
+    return record
+
+  def set_waiting(self):
+    'Called by the writer when the ring is full.'
+    self._set(WAITING_OFFSET, 1)
+
+  def take_waiting(self):
+    'Called by the reader: returns (and clears) the waiting flag.'
+    if self._get(WAITING_OFFSET):
+      self._set(WAITING_OFFSET, 0)
+      return True
+    return False
+
+  def close(self):
+    self.mem.close()
+
+
+def _write_segment(data):
+  '''Copy ``data`` into a new shared memory file, returning its name.'''
+  path = _new_name('seg')
+  fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0600)
+  try:
+    view = buffer(data)
+    while view:
+      view = view[os.write(fd, view):]
+  finally:
+    os.close(fd)
+  return os.path.basename(path)
+
+def _read_segment(name):
+  '''Map (and remove) a segment written by `_write_segment`.'''
+  path = _peer_path(name, 'seg')
+  fd = _open_peer_file(path, os.O_RDONLY)
+  try:
+    mem = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+  finally:
+    os.close(fd)
+    os.unlink(path)
+  return buffer(mem)
+
+
+def encode_record(msg, max_record):
+  '''Returns (parts, size) of the ring record for ``msg``.'''
+  if not isinstance(msg, Group):
+    msg = (msg,)
+
+  threshold = config.shm_segment_threshold
+  inline = sum(len(_as_buffer(f)) for f in msg) <= max_record / 2
+  table = [RECORD.pack(len(msg))]
+  data = []
+  for frame in msg:
+    buf = _as_buffer(frame)
+    if len(buf) > 0 and (len(buf) > threshold or not inline):
+      name = _write_segment(buf)
+      table.append(FRAME.pack(FRAME_SEGMENT, len(name)))
+      data.append(name)
+    else:
+      table.append(FRAME.pack(FRAME_INLINE, len(buf)))
+      data.append(buf)
+
+  parts = table + data
+  return parts, sum(len(p) for p in parts)
+
+def decode_record(record):
+  '''Inverse of `encode_record`: returns a list of frames.'''
+  count = RECORD.unpack_from(record)[0]
+  pos = RECORD.size
+  table = []
+  for i in range(count):
+    table.append(FRAME.unpack_from(record, pos))
+    pos += FRAME.size
+
+  frames = []
+  for kind, n in table:
+    if kind == FRAME_SEGMENT:
+      frames.append(_read_segment(record[pos:pos + n]))
+    else:
+      frames.append(buffer(record, pos, n))
+    pos += n
+  return frames
+
+
+class Channel(SocketBase):
+  '''One end of a shared memory connection.
+
+  Messages are written straight into the outgoing ring by the sending
+  thread.  If the ring is full they are queued, and written when the
+  reader signals that it has made space.
+  '''
+  def __init__(self, addr):
+    self.addr = addr
+    self._sock = None
+    self._in = None
+    self._out = None
+    self._pending = collections.deque()
+    self._lock = threading.RLock()
+    self._received = None
+    self._closed = True
+    self._poller = pollers().assign(self)
+
+  def __repr__(self):
+    return '%s(%s)' % (self.__class__.__name__, self.addr)
+
+  def zmq(self):
+    return self._fd
+
+  def in_poll_loop(self):
+    return threading.current_thread() is self._poller
+
+  def _open(self, sock, in_ring, out_ring):
+    self._sock = sock
+    self._sock.setblocking(0)
+    self._fd = sock.fileno()
+    self._in = in_ring
+    self._out = out_ring
+    self._closed = False
+    self._poller.add(self, zmq.POLLIN)
+
+  def _signal(self, byte):
+    try:
+      self._sock.send(byte)
+    except socket.error, e:
+      # a full socket buffer already guarantees a wakeup.
+      if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+        raise
+
+  def send(self, msg):
+    assert not self._closed
+    record = encode_record(msg, self._out.max_record)
+    with self._lock:
+      if not self._pending and self._out.write(*record):
+        self._signal('M')
+        return
+      self._pending.append(record)
+      self._wait_for_space()
+
+  def _wait_for_space(self):
+    # set the flag before signalling, so the reader sees it once it
+    # has been woken up.
+    self._out.set_waiting()
+    self._signal('W')
+
+  def _flush_pending(self):
+    with self._lock:
+      sent = False
+      while self._pending and self._out.write(*self._pending[0]):
+        self._pending.popleft()
+        sent = True
+      if sent:
+        self._signal('M')
+      if self._pending:
+        self._wait_for_space()
+
+  def flush(self):
+    pass
+
+  def recv(self):
+    msg, self._received = self._received, None
+    return msg
+
+  def _read_signals(self):
+    '''Returns the signal bytes waiting on the socket, or None if the peer closed.'''
+    signals = []
+    while True:
+      try:
+        data = self._sock.recv(4096)
+      except socket.error, e:
+        if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+          return ''.join(signals)
+        raise
+      if not data:
+        return None
+      signals.append(data)
+
+  def _dispatch(self, frames):
+    self._received = frames
+    self._handler(self)
+
+  def handle_read(self, socket):
+    signals = self._read_signals()
+    if signals is None:
+      self._poller.remove(self)
+      self.handle_close()
+      return
+
+    if self._pending:
+      self._flush_pending()
+
+    while not self._closed:
+      record = self._in.read()
+      if record is None:
+        break
+      try:
+        frames = decode_record(record)
+      except (ValueError, EnvironmentError):
+        util.log_warn('Bad record from %s, closing.', self, exc_info=1)
+        self._poller.remove(self)
+        self.handle_close()
+        return
+      self._dispatch(frames)
+
+    if not self._closed and self._in.take_waiting():
+      self._signal('S')
+
+  def handle_write(self):
+    pass
+
+  def close(self, *args):
+    if self._closed:
+      return
+    if self.in_poll_loop():
+      self._poller.remove(self)
+      self.handle_close()
+    else:
+      self._poller.close(self)
+
+  def handle_close(self):
+    if self._closed:
+      return
+    self._closed = True
+    self._sock.close()
+    self._in.close()
+    self._out.close()
+    self._poller.release(self)
+
+
+class ShmSocket(Channel):
+  '''Client end of a shared memory connection to the server at ``path``.'''
+  def __init__(self, path, ring_size=None):
+    Channel.__init__(self, path)
+    self._ring_size = ring_size or config.shm_ring_size
+
+  def connect(self):
+    assert self._closed
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(self.addr)
+
+    # the client creates both rings; the server removes the files once
+    # it has mapped them.
+    to_server = Ring(_new_name('ring'), self._ring_size)
+    to_client = Ring(_new_name('ring'), self._ring_size)
+    sock.sendall('%s %s %s\n' % (HANDSHAKE, to_server.path, to_client.path))
+    self._open(sock, to_client, to_server)
+
+
+def _read_line(sock):
+  # read byte by byte: anything after the newline is a signal.
+  chars = []
+  while not chars or chars[-1] != '\n':
+    c = sock.recv(1)
+    if not c:
+      break
+    chars.append(c)
+  return ''.join(chars)
+
+
+class _ServerChannel(Channel):
+  '''Server end of a connection accepted by a `ShmServerSocket`.'''
+  def __init__(self, server, sock):
+    Channel.__init__(self, server.addr)
+    self.server = server
+
+    sock.settimeout(5)
+    line = _read_line(sock).split()
+    if ' '.join(line[:2]) != HANDSHAKE or len(line) != 4:
+      raise ValueError('Bad handshake from shm client: %r' % line)
+
+    to_server, to_client = [_peer_path(path, 'ring') for path in line[2:]]
+    in_ring = Ring(to_server)
+    out_ring = Ring(to_client)
+    for path in (to_server, to_client):
+      os.unlink(path)
+    self._open(sock, in_ring, out_ring)
+
+  def _dispatch(self, frames):
+    self.server._handler(StubSocket(self, self.server, frames))
+
+  def handle_close(self):
+    Channel.handle_close(self)
+    self.server._channels.discard(self)
+
+
+class ShmServerSocket(SocketBase):
+  '''Accepts shared memory connections on the unix socket ``path``.'''
+  def __init__(self, path=None):
+    self.addr = path or _new_name('server')
+    self._sock = None
+    self._channels = set()
+    self._closed = True
+    self._poller = pollers().assign(self)
+
+  def __repr__(self):
+    return 'ShmServerSocket(%s)' % self.addr
+
+  def zmq(self):
+    return self._fd
+
+  def bind(self):
+    assert self._closed
+    self._closed = False
+    util.log_info('Binding... %s', self.addr)
+    self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self._sock.bind(self.addr)
+    self._sock.listen(128)
+    self._fd = self._sock.fileno()
+    self._poller.add(self, zmq.POLLIN)
+
+  def send(self, msg):
+    '''Send ``msg`` to a client.
+
+    :param msg: `.Group`, with the first element being the `Channel` to send to.
+    '''
+    channel = msg[0]
+    if not channel._closed:
+      channel.send(Group(msg[1:]))
+
+  def handle_read(self, socket):
+    sock, _ = self._sock.accept()
+    # the handshake may block: read it off the polling thread.
+    t = threading.Thread(target=self._accept, args=(sock,), name='speedy.ShmAccept')
+    t.setDaemon(True)
+    t.start()
+
+  def _accept(self, sock):
+    try:
+      channel = _ServerChannel(self, sock)
+    except (ValueError, EnvironmentError):
+      util.log_info('Failed to accept shm connection.', exc_info=1)
+      sock.close()
+      return
+    self._channels.add(channel)
+    if self._closed:
+      channel.close()
+
+  def handle_write(self):
+    pass
+
+  def flush(self):
+    pass
+
+  def close(self, *args):
+    if self._closed:
+      return
+    if threading.current_thread() is self._poller:
+      self._poller.remove(self)
+      self.handle_close()
+    else:
+      self._poller.close(self)
+
+  def handle_close(self):
+    if self._closed:
+      return
+    self._closed = True
+    for channel in list(self._channels):
+      channel.close()
+    self._sock.close()
+    try:
+      os.unlink(self.addr)
+    except OSError:
+      pass
+    self._poller.release(self)
+
+
+def shm_server_socket(path=None):
+  '''A server socket accepting shared memory connections on ``path``
+  (a new temporary path if not given).'''
+  return ShmServerSocket(path)
+
+
+def shm_client_socket(path):
+  '''A client socket connected to the `shm_server_socket` at ``path``.'''
+  return ShmSocket(path)
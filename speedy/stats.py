@@ -0,0 +1,170 @@
+'''
+Per-method RPC statistics.
+
+`Client` and `Server` each keep a :class:`Stats` registry, with one
+:class:`MethodStats` per RPC method: call and error counts, bytes in
+and out, and latency histograms.  ``Client.local_stats()`` and the
+reserved ``_stats`` RPC on every server return a :meth:`Stats.snapshot`.
+'''
+import threading
+
+# Each power of two is split into 2**(SUB_BITS - 1) buckets, which
+# bounds the relative error of a recorded value to about 3%.
+SUB_BITS = 6
+SUB_COUNT = 1 << SUB_BITS
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def _bucket(v):
+  if v < SUB_COUNT:
+    return v
+  e = v.bit_length() - SUB_BITS
+  return (e << (SUB_BITS - 1)) + (v >> e)
+
+
+def _bucket_value(idx):
+  'Lowest value which falls into bucket ``idx``.'
+  if idx < SUB_COUNT:
+    return idx
+  e = (idx >> (SUB_BITS - 1)) - 1
+  return (idx - (e << (SUB_BITS - 1))) << e
+
+
+class Histogram(object):
+  '''HDR style log-linear histogram of durations.
+
+  Durations are recorded in seconds and stored as whole microseconds.
+  Not thread-safe; `MethodStats` serializes updates.
+  '''
+  def __init__(self):
+    self.counts = []
+    self.count = 0
+    self.total = 0
+    self.min = None
+    self.max = 0
+
+  def record(self, seconds):
+    v = max(0, int(seconds * 1e6))
+    idx = _bucket(v)
+    counts = self.counts
+    if idx >= len(counts):
+      counts.extend([0] * (idx + 1 - len(counts)))
+    counts[idx] += 1
+    self.count += 1
+    self.total += v
+    if self.min is None or v < self.min:
+      self.min = v
+    if v > self.max:
+      self.max = v
+
+  def merge(self, other):
+    if len(other.counts) > len(self.counts):
+      self.counts.extend([0] * (len(other.counts) - len(self.counts)))
+    for idx, c in enumerate(other.counts):
+      self.counts[idx] += c
+    self.count += other.count
+    self.total += other.total
+    if other.min is not None and (self.min is None or other.min < self.min):
+      self.min = other.min
+    self.max = max(self.max, other.max)
+
+  def percentile(self, p):
+    '''Value (in seconds) below which ``p`` percent of durations fall.'''
+    if self.count == 0:
+      return 0.0
+    target = max(1, int(round(self.count * p / 100.0)))
+    seen = 0
+    for idx, c in enumerate(self.counts):
+      seen += c
+      if seen >= target:
+        return min(_bucket_value(idx + 1) - 1, self.max) / 1e6
+    return self.max / 1e6
+
+  def mean(self):
+    if self.count == 0:
+      return 0.0
+    return self.total / 1e6 / self.count
+
+  def summary(self):
+    s = { 'count' : self.count,
+          'mean' : self.mean(),
+          'min' : (self.min or 0) / 1e6,
+          'max' : self.max / 1e6 }
+    for p in PERCENTILES:
+      s['p%s' % p] = self.percentile(p)
+    return s
+
+
+class MethodStats(object):
+  '''Counters and histograms for one RPC method.'''
+  HISTOGRAMS = ('latency', 'queue_time', 'handler_time')
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.calls = 0
+    self.errors = 0
+    self.bytes_in = 0
+    self.bytes_out = 0
+    self.cache_hits = 0
+    self.cache_misses = 0
+    self.expired = 0
+    self.rejected = 0
+    self.latency = Histogram()
+    self.queue_time = Histogram()
+    self.handler_time = Histogram()
+
+  def record(self, calls=0, errors=0, bytes_in=0, bytes_out=0,
+             cache_hits=0, cache_misses=0, expired=0,
+             rejected=0, **durations):
+    '''Add to the counters, and record each of ``durations`` (in seconds)
+    to the histogram of the same name.'''
+    with self._lock:
+      self.calls += calls
+      self.errors += errors
+      self.bytes_in += bytes_in
+      self.bytes_out += bytes_out
+      self.cache_hits += cache_hits
+      self.cache_misses += cache_misses
+      self.expired += expired
+      self.rejected += rejected
+      for name, seconds in durations.iteritems():
+        getattr(self, name).record(seconds)
+
+  def snapshot(self):
+    with self._lock:
+      s = { 'calls' : self.calls,
+            'errors' : self.errors,
+            'bytes_in' : self.bytes_in,
+            'bytes_out' : self.bytes_out }
+      if self.cache_hits or self.cache_misses:
+        s['cache_hits'] = self.cache_hits
+        s['cache_misses'] = self.cache_misses
+      if self.expired:
+        s['expired'] = self.expired
+      if self.rejected:
+        s['rejected'] = self.rejected
+      for name in self.HISTOGRAMS:
+        h = getattr(self, name)
+        if h.count:
+          s[name] = h.summary()
+      return s
+
+
+class Stats(object):
+  '''Registry of `MethodStats`, by method name.'''
+  def __init__(self):
+    self._methods = {}
+    self._lock = threading.Lock()
+
+  def method(self, name):
+    s = self._methods.get(name)
+    if s is None:
+      with self._lock:
+        s = self._methods.setdefault(name, MethodStats())
+    return s
+
+  def snapshot(self):
+    '''Returns a dict of method name to a dict of counters and histogram
+    summaries (in seconds).'''
+    return dict((name, s.snapshot()) for name, s in self._methods.items())
@@ -0,0 +1,101 @@
+'''
+A shared thread for running functions after a delay.
+
+Used for request deadlines, hedging and retries, so that waiting for a
+timeout does not take a thread per request::
+
+  entry = timer.schedule(0.5, fn, arg)
+  entry.cancel()
+
+Functions run on the timer thread, and should be quick.
+'''
+import heapq
+import itertools
+import threading
+import time
+
+from . import util
+
+TIMER = None
+TIMER_LOCK = threading.Lock()
+
+
+class Entry(object):
+  __slots__ = ['when', 'fn', 'args', 'cancelled']
+
+  def __init__(self, when, fn, args):
+    self.when = when
+    self.fn = fn
+    self.args = args
+    self.cancelled = False
+
+  def cancel(self):
+    self.cancelled = True
+
+
+class TimerThread(threading.Thread):
+  def __init__(self):
+    threading.Thread.__init__(self, name='speedy.Timer')
+    self.setDaemon(True)
+    self._heap = []
+    self._seq = itertools.count()
+    self._cv = threading.Condition()
+    self._running = True
+
+  def schedule(self, delay, fn, *args):
+    entry = Entry(time.time() + delay, fn, args)
+    with self._cv:
+      heapq.heappush(self._heap, (entry.when, self._seq.next(), entry))
+      if self._heap[0][2] is entry:
+        self._cv.notify()
+    return entry
+
+  def stop(self):
+    'Stop the thread; pending calls are dropped.'
+    with self._cv:
+      self._running = False
+      self._cv.notify()
+    if threading.current_thread() is not self:
+      self.join()
+
+  def run(self):
+    while True:
+      with self._cv:
+        while self._running and (not self._heap or self._heap[0][0] > time.time()):
+          self._cv.wait(self._heap[0][0] - time.time() if self._heap else None)
+        if not self._running:
+          return
+        entry = heapq.heappop(self._heap)[2]
+
+      if entry.cancelled:
+        continue
+      try:
+        entry.fn(*entry.args)
+      except:
+        util.log_warn('Exception in timer callback %s.', entry.fn, exc_info=1)
+
+
+def timer():
+  '''Return the process wide `TimerThread`, starting it if needed.'''
+  global TIMER
+  with TIMER_LOCK:
+    if TIMER is None:
+      TIMER = TimerThread()
+      TIMER.start()
+    return TIMER
+
+def schedule(delay, fn, *args):
+  '''Call ``fn(*args)`` on the timer thread in ``delay`` seconds.
+
+  Returns an `Entry`, whose ``cancel()`` stops the call if it has not
+  happened yet.
+  '''
+  return timer().schedule(delay, fn, *args)
+
+def shutdown():
+  if TIMER is not None:
+    TIMER.stop()
+
+
+import atexit
+atexit.register(shutdown)
@@ -0,0 +1,108 @@
+'''
+Wire format for RPC messages.
+
+A message is sent as a list of frames::
+
+  [header, payload, buffer_0, buffer_1, ...]
+
+The header frame is a fixed size struct (`HEADER`) followed by the
+method name, so messages can be routed without unpickling anything.
+If ``FLAG_DEADLINE`` is set, the absolute deadline of the request (a
+``double``, in seconds since the epoch) follows the method name.
+Streamed calls (``FLAG_STREAM``) then carry the initial flow control
+window (an ``unsigned int``); replies with ``FLAG_PARTIAL`` are chunks
+of a streamed result, which ends with a reply without it.  Requests
+with ``FLAG_UPLOAD`` are followed by their body in ``_chunk`` messages.
+The payload is encoded according to the header ``codec``, and any out
+of band buffers (see :mod:`speedy.serialization`) follow as extra frames.
+
+Older peers send a pickled ``dict`` with ``rpc_id`` and ``method``
+keys, followed by the pickled payload, in the first frame.  These
+messages are still accepted if ``config.accept_legacy_header`` is set,
+and replies use the same format as the request they answer.
+'''
+import struct
+
+MAGIC = 'SP'
+VERSION = 1
+
+# magic, version, flags, codec, rpc_id, length of method name
+HEADER = struct.Struct('!2sBBBQH')
+
+# header flags
+FLAG_DEADLINE = 0x1
+FLAG_PARTIAL = 0x2
+FLAG_STREAM = 0x4
+FLAG_UPLOAD = 0x8
+
+DEADLINE = struct.Struct('!d')
+WINDOW = struct.Struct('!I')
+
+# payload codecs
+CODEC_PICKLE = 0
+CODEC_RAW = 1
+
+# header formats
+FORMAT_BINARY = 'binary'
+FORMAT_PICKLE = 'pickle'
+
+
+class Header(object):
+  __slots__ = ['rpc_id', 'method', 'flags', 'codec', 'format', 'deadline', 'window']
+
+  def __init__(self, rpc_id, method='', flags=0, codec=CODEC_PICKLE, format=FORMAT_BINARY,
+               deadline=None, window=None):
+    self.rpc_id = rpc_id
+    self.method = method
+    self.flags = flags
+    self.codec = codec
+    self.format = format
+    # absolute time (time.time()) after which the caller no longer waits.
+    self.deadline = deadline
+    # for streamed calls: chunks the server may send before more credit.
+    self.window = window
+
+  def __repr__(self):
+    return 'Header(%s, %r, flags=%d, codec=%d, format=%s, deadline=%s, window=%s)' % (
+      self.rpc_id, self.method, self.flags, self.codec, self.format, self.deadline,
+      self.window)
+
+
+def pack(header):
+  method = header.method or ''
+  flags = header.flags
+  if header.deadline is not None:
+    flags |= FLAG_DEADLINE
+  if header.window is not None:
+    flags |= FLAG_STREAM
+  data = HEADER.pack(MAGIC, VERSION, flags, header.codec,
+                     header.rpc_id, len(method)) + method
+  if header.deadline is not None:
+    data += DEADLINE.pack(header.deadline)
+  if header.window is not None:
+    data += WINDOW.pack(header.window)
+  return data
+
+
+def is_binary(frame):
+  '''True if ``frame`` starts with a binary header.'''
+  return len(frame) >= HEADER.size and struct.unpack_from('!2s', frame)[0] == MAGIC
+
+
+def unpack(frame):
+  '''Parse a header frame (a ``zmq.Frame`` or ``str``).'''
+  data = getattr(frame, 'bytes', frame)
+  magic, version, flags, codec, rpc_id, method_len = HEADER.unpack_from(data)
+  if magic != MAGIC:
+    raise ValueError('Bad header magic: %r' % magic)
+  if version > VERSION:
+    raise ValueError('Unsupported header version: %d' % version)
+  end = HEADER.size + method_len
+  method = data[HEADER.size:end]
+  deadline = window = None
+  if flags & FLAG_DEADLINE:
+    deadline = DEADLINE.unpack_from(data, end)[0]
+    end += DEADLINE.size
+  if flags & FLAG_STREAM:
+    window = WINDOW.unpack_from(data, end)[0]
+  return Header(rpc_id, method, flags, codec, deadline=deadline, window=window)
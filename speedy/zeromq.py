@@ -2,29 +2,148 @@
 
 import cProfile
 import collections
+import errno
+import fcntl
 import os
+import socket
+import struct
+import tempfile
 import threading
 import zmq
 
-from .common import Group, SocketBase
-from . import util
+from .common import Group, SocketBase, message_size
+from . import config, util
+
+# First frame of a message which packs several messages together; see
+# `Socket.handle_write`.
+BATCH_MARKER = '\x00SPB'
 
 POLLER = None
 POLLER_LOCK = threading.RLock()
 PROFILER = None
 
-def poller():
+def pollers():
+  '''Return the process wide `PollerPool`, starting it if needed.'''
   global POLLER
   with POLLER_LOCK:
     if POLLER is None:
       util.log_info('Started poller.. %s %s', os.getpid(), __file__)
-      POLLER = ZMQPoller()
-      POLLER.start()
+      POLLER = PollerPool(config.poller_threads, config.poller_assignment)
     return POLLER
 
+def poller():
+  '''Return the first polling thread of the pool.'''
+  return pollers().shard(0)
+
+
+TRANSPORTS = ('tcp', 'ipc', 'inproc')
+
+def parse_address(addr):
+  '''Normalize an address to a ``(host, port)`` tuple (for tcp) or a URL.
+
+  Accepts ``(host, port)`` tuples and ``tcp://host:port``, ``ipc://path``
+  and ``inproc://name`` URLs.  A port of -1 (or ``*``) asks the server
+  to pick a free port; an empty ipc path a new temporary file.
+  '''
+  if isinstance(addr, tuple):
+    host, port = addr
+    return (host, int(port))
+
+  transport, sep, rest = addr.partition('://')
+  if not sep or transport not in TRANSPORTS:
+    raise ValueError('Unsupported address: %r' % (addr,))
+  if transport != 'tcp':
+    return addr
+
+  host, _, port = rest.rpartition(':')
+  if not host:
+    raise ValueError('Missing port in address: %r' % (addr,))
+  return (host, -1 if port == '*' else int(port))
+
+
+def address_url(addr):
+  'The zeromq endpoint for ``addr`` (as returned by `parse_address`).'
+  if isinstance(addr, tuple):
+    return 'tcp://%s:%s' % addr
+  return addr
+
+
+def ipc_alias(host, port):
+  '''The ipc:// endpoint a server listening on tcp ``host:port`` also
+  binds (see ``config.server_ipc_alias``).'''
+  name = 'speedy-%s-%d.ipc' % (host.replace(os.sep, '_'), port)
+  return 'ipc://%s' % os.path.join(tempfile.gettempdir(), name)
+
+def _file_id(path):
+  try:
+    st = os.stat(path)
+  except OSError:
+    return None
+  return st.st_dev, st.st_ino
+
+
+_LOCAL_HOSTS = None
+
+def is_local_host(host):
+  '''True if ``host`` names this machine.'''
+  global _LOCAL_HOSTS
+  if host in ('localhost', '0.0.0.0', '::1', '*') or host.startswith('127.'):
+    return True
+  if _LOCAL_HOSTS is None:
+    names = set([socket.gethostname(), socket.getfqdn()])
+    try:
+      names.update(socket.gethostbyname_ex(socket.gethostname())[2])
+    except socket.error:
+      pass
+    _LOCAL_HOSTS = names
+  return host in _LOCAL_HOSTS
+
+
+def pack_batch(messages, routing_frames=0):
+  '''Pack ``messages`` into one multipart message.
+
+  The first ``routing_frames`` frames (the destination, for ROUTER
+  sockets) must be the same for all messages, and are sent once.
+  '''
+  counts = []
+  body = []
+  for msg in messages:
+    if isinstance(msg, Group):
+      frames = msg[routing_frames:]
+    else:
+      frames = (msg,)
+    counts.append(len(frames))
+    body.extend(frames)
+
+  route = list(messages[0][:routing_frames])
+  return route + [BATCH_MARKER, struct.pack('!%dI' % len(counts), *counts)] + body
+
+
+def unpack_batch(frames):
+  '''Split a message built by `pack_batch` (after any routing frames).
+
+  Returns a list of messages, each a list of frames.  Messages which
+  are not batches are returned as the only element.
+  '''
+  if len(frames) < 2 or len(frames[0]) != len(BATCH_MARKER) or frames[0].bytes != BATCH_MARKER:
+    return [frames]
+
+  counts = frames[1].bytes
+  counts = struct.unpack('!%dI' % (len(counts) / 4), counts)
+  messages = []
+  pos = 2
+  for n in counts:
+    messages.append(frames[pos:pos + n])
+    pos += n
+  return messages
+
 
 class Socket(SocketBase):
-  __slots__ = ['_zmq', '_hostport', '_out', '_in', '_addr', '_closed', '_shutdown', '_lock']
+  __slots__ = ['_zmq', '_hostport', '_out', '_in', '_addr', '_closed', '_shutdown', '_lock', '_poller',
+               '_write_pending', '_reading', '_received', 'coalesce']
+
+  # number of leading frames which address the destination of a message.
+  routing_frames = 0
 
   def __init__(self, ctx, sock_type, hostport):
     # util.log_info('New socket...')
@@ -34,9 +153,17 @@ class Socket(SocketBase):
     self._closed = True
     self._shutdown = False
     self._lock = threading.RLock()
+    self._poller = pollers().assign(self)
+    # True while the poller is watching for POLLOUT on our behalf.
+    self._write_pending = False
+    # False while reading is paused (see `pause_reading`).
+    self._reading = True
+    self._received = None
+    # pack runs of small messages into a single zeromq message?
+    self.coalesce = config.coalesce_writes
 
   def in_poll_loop(self):
-    return threading.current_thread() == poller()
+    return threading.current_thread() is self._poller
 
   def __repr__(self):
     return 'Socket(%s)' % ((self.addr,))
@@ -46,33 +173,60 @@ class Socket(SocketBase):
 
   def close(self, *args):
     if self.in_poll_loop():
-      poller().remove(self)
+      self._poller.remove(self)
       self.handle_close()
     else:
       self._shutdown = True
-      poller().close(self)
+      self._poller.close(self)
 
   def send(self, msg):
     assert not self._closed
     #util.log_info('SEND %s', len(msg))
-    self._out.append(msg)
-    poller().modify(self, zmq.POLLIN | zmq.POLLOUT)
+    with self._lock:
+      self._out.append(msg)
+      if self._write_pending:
+        # handle_write will pick this message up.
+        return
+      self._write_pending = True
+    self._poller.modify(self)
+
+  def events(self):
+    'The events the poller should watch for.'
+    events = zmq.POLLIN if self._reading else 0
+    if self._write_pending:
+      events |= zmq.POLLOUT
+    return events
+
+  def pause_reading(self):
+    '''Stop reading messages until `resume_reading`: unread messages
+    queue up in zeromq, until its high water mark blocks the senders.'''
+    self._reading = False
+    self._poller.modify(self)
+
+  def resume_reading(self):
+    self._reading = True
+    self._poller.modify(self)
 
   def zmq(self):
     return self._zmq
 
   def recv(self):
     assert not self._closed
-    frames = self._zmq.recv_multipart(copy=False, track=False)
-    assert len(frames) == 1
-    return frames[0]
+    if self._received is not None:
+      msg, self._received = self._received, None
+      return msg
+    return self._zmq.recv_multipart(copy=False, track=False)
 
   def connect(self):
     assert self._closed
     self._closed = False
     #util.log_info('Connecting: %s:%d' % self.addr)
-    self._zmq.connect('tcp://%s:%s' % self.addr)
-    poller().add(self, zmq.POLLIN)
+    self._zmq.connect(self.url)
+    self._poller.add(self, zmq.POLLIN)
+
+  @property
+  def url(self):
+    return address_url(self.addr)
 
   @property
   def port(self):
@@ -86,12 +240,39 @@ class Socket(SocketBase):
     self.flush()
     self._closed = True
     self._zmq.close()
+    self._poller.release(self)
     #del self._zmq
 
+  def _route(self, msg):
+    if not self.routing_frames:
+      return ()
+    return tuple(getattr(f, 'bytes', f) for f in msg[:self.routing_frames])
+
+  def _next_batch(self, first):
+    '''Pop the run of small messages following ``first`` with the same destination.'''
+    out = self._out
+    max_size = config.coalesce_max_message
+    if not out or message_size(first) > max_size:
+      return [first]
+
+    route = self._route(first)
+    batch = [first]
+    while (out and len(batch) < config.coalesce_max_batch and
+           message_size(out[0]) <= max_size and self._route(out[0]) == route):
+      batch.append(out.popleft())
+    return batch
+
   def handle_write(self):
     with self._lock:
-      while self._out:
-        next = self._out.popleft()
+      out = self._out
+      while out:
+        next = out.popleft()
+        if self.coalesce:
+          batch = self._next_batch(next)
+          if len(batch) > 1:
+            self._zmq.send_multipart(pack_batch(batch, self.routing_frames), copy=False)
+            continue
+
         if isinstance(next, Group):
           #util.log_info('Sending group. %s', len(next))
           self._zmq.send_multipart(next, copy=False)
@@ -99,16 +280,36 @@ class Socket(SocketBase):
           #util.log_info('Sending %s', len(next))
           self._zmq.send(next, copy=False)
 
-      poller().modify(self, zmq.POLLIN)
+      self._write_pending = False
+      self._poller.modify(self)
+
+  def _recv_messages(self):
+    '''Yield waiting messages (up to ``config.max_reads_per_poll``), until
+    reading is paused.'''
+    for i in range(config.max_reads_per_poll):
+      if not self._reading:
+        break
+      try:
+        yield self._zmq.recv_multipart(zmq.NOBLOCK, copy=False, track=False)
+      except zmq.Again:
+        break
 
   def handle_read(self, socket):
-    self._handler(socket)
+    for packet in self._recv_messages():
+      for msg in unpack_batch(packet):
+        self._received = msg
+        self._handler(socket)
 
 
 class ServerSocket(Socket):
+  routing_frames = 1
+
   def __init__(self, ctx, sock_type, hostport):
     Socket.__init__(self, ctx, sock_type, hostport)
     self.addr = hostport
+    # ipc:// paths bound by this socket -> their file ids, so that
+    # only files still ours are removed on close.
+    self._ipc_paths = {}
 
   def send(self, msg):
     '''Send ``msg`` to a remote client.
@@ -120,19 +321,46 @@ class ServerSocket(Socket):
   def bind(self):
     assert self._closed
     self._closed = False
-    host, port = self.addr
-    util.log_info('Binding... %s', (host, port))
-    if port == -1:
-      self.addr = (host, self._zmq.bind_to_random_port('tcp://%s' % host))
+    util.log_info('Binding... %s', self.addr)
+    if isinstance(self.addr, tuple):
+      host, port = self.addr
+      if port == -1:
+        self.addr = (host, self._zmq.bind_to_random_port('tcp://%s' % host))
+      else:
+        self._zmq.bind('tcp://%s:%d' % (host, port))
+      if config.server_ipc_alias:
+        self._bind_ipc(ipc_alias(*self.addr))
+    elif self.addr == 'ipc://':
+      fd, path = tempfile.mkstemp(prefix='speedy-', suffix='.ipc')
+      os.close(fd)
+      self.addr = 'ipc://' + path
+      self._bind_ipc(self.addr)
+    elif self.addr.startswith('ipc://'):
+      self._bind_ipc(self.addr)
     else:
-      self._zmq.bind('tcp://%s:%d' % (host, port))
-    poller().add(self, zmq.POLLIN)
+      self._zmq.bind(self.addr)
+    self._poller.add(self, zmq.POLLIN)
+
+  def _bind_ipc(self, url):
+    self._zmq.bind(url)
+    path = url[len('ipc://'):]
+    self._ipc_paths[path] = _file_id(path)
+
+  def handle_close(self):
+    Socket.handle_close(self)
+    for path, file_id in self._ipc_paths.items():
+      # another server may have bound the path since.
+      if file_id is not None and _file_id(path) == file_id:
+        try:
+          os.unlink(path)
+        except OSError:
+          pass
 
   def handle_read(self, socket):
-    packet = self._zmq.recv_multipart(copy=False, track=False)
-    source, rest = packet[0], packet[1:]
-    stub_socket = StubSocket(source, self, rest)
-    self._handler(stub_socket)
+    for packet in self._recv_messages():
+      source, rest = packet[0], packet[1:]
+      for msg in unpack_batch(rest):
+        self._handler(StubSocket(source, self, msg))
 
   def zmq(self):
     return self._zmq
@@ -147,8 +375,7 @@ class StubSocket(SocketBase):
     self.socket = socket
 
     assert isinstance(data, list)
-    assert len(data) == 1
-    self.data = data[0]
+    self.data = data
 
   @property
   def addr(self):
@@ -170,13 +397,28 @@ class StubSocket(SocketBase):
 
 
 class ZMQPoller(threading.Thread):
-  def __init__(self):
-    threading.Thread.__init__(self, name='zmq.PollingThread', target=self._run)
+  '''Polls registered sockets and dispatches reads and writes.
+
+  In ``event`` mode (see ``config.poller_mode``) the poll blocks until a
+  socket is ready or the poller is woken through its pipe; registration
+  changes are applied as soon as the poller wakes up.  In ``backoff``
+  mode the poll timeout doubles (up to 100ms) while the poller is idle.
+
+  Registration changes made from the polling thread itself take effect
+  immediately; changes from other threads are queued and signalled
+  through the wakeup pipe.
+  '''
+  def __init__(self, mode=None, name='zmq.PollingThread'):
+    threading.Thread.__init__(self, name=name, target=self._run)
 
     self._poller = zmq.Poller()
     self._lock = threading.RLock()
+    self._mode = mode or config.poller_mode
+    assert self._mode in ('event', 'backoff'), self._mode
 
     self._pipe = os.pipe()
+    for fd in self._pipe:
+      fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
     self._poller.register(self._pipe[0], zmq.POLLIN)
     self._sockets = {}
 
@@ -189,6 +431,9 @@ class ZMQPoller(threading.Thread):
 
     self._epoch = 0
 
+    # number of open sockets assigned to this poller
+    self.load = 0
+
     self.setDaemon(True)
 
   def _run(self):
@@ -196,21 +441,23 @@ class ZMQPoller(threading.Thread):
     _poll = self._poller.poll
     _poll_time = 1
     MAX_TIMEOUT = 100
+    blocking = self._mode == 'event'
 
     while self._running:
-      socks = dict(_poll(_poll_time))
-      
-      if len(socks) == 0:
-        _poll_time = min(_poll_time * 2, MAX_TIMEOUT)
-      else:
-        _poll_time = 1
+      socks = dict(_poll(None if blocking else _poll_time))
+
+      if not blocking:
+        if len(socks) == 0:
+          _poll_time = min(_poll_time * 2, MAX_TIMEOUT)
+        else:
+          _poll_time = 1
+
+      if self._pipe[0] in socks:
+        self._drain_pipe()
+        self._apply_changes()
 
       #util.log_info('%s', self._sockets)
       for fd, event in socks.iteritems():
-        if fd == self._pipe[0]:
-          os.read(fd, 1)
-          continue
-
         if not fd in self._sockets:
           continue
 
@@ -219,29 +466,53 @@ class ZMQPoller(threading.Thread):
           socket.handle_read(socket)
         if event & zmq.POLLOUT:
           socket.handle_write()
-      
-      with self._lock:
-        for s, dir in self._to_add:
-          self._sockets[s.zmq()] = s
-          self._poller.register(s.zmq(), dir)
-          
-        for s, dir in self._to_mod:
-          self._poller.register(s.zmq(), dir)
-
-        for s in self._to_del:
-          del self._sockets[s.zmq()]
-          self._poller.unregister(s.zmq())
-        
-        del self._to_mod[:]
-        del self._to_add[:]
-        del self._to_del[:]
-
-        for socket in self._closing.keys():
-          socket.handle_close()
-        self._closing.clear()
-      
+
+      self._apply_changes()
       self._epoch += 1
 
+  def _drain_pipe(self):
+    try:
+      while os.read(self._pipe[0], 4096):
+        pass
+    except OSError, e:
+      if e.errno != errno.EAGAIN:
+        raise
+
+  def _apply_changes(self):
+    with self._lock:
+      for s, dir in self._to_add:
+        self._sockets[s.zmq()] = s
+        self._poller.register(s.zmq(), dir)
+
+      for s, dir in self._to_mod:
+        if s.zmq() in self._sockets:
+          self._poller.register(s.zmq(), s.events() if dir is None else dir)
+
+      for s in self._to_del:
+        self._unregister(s)
+
+      del self._to_mod[:]
+      del self._to_add[:]
+      del self._to_del[:]
+
+      for socket in self._closing.keys():
+        socket.handle_close()
+      self._closing.clear()
+
+  def _unregister(self, socket):
+    if socket.zmq() in self._sockets:
+      del self._sockets[socket.zmq()]
+      # (registering for no events unregisters, if still registered)
+      self._poller.register(socket.zmq(), 0)
+
+  def _in_loop(self):
+    return threading.current_thread() is self
+
+  def release(self, socket):
+    'Called when ``socket``, assigned to this poller, is closed.'
+    with self._lock:
+      self.load -= 1
+
   def close(self, socket):
     'Execute socket.handle_close() from within the polling thread.'
     with self._lock:
@@ -259,38 +530,117 @@ class ZMQPoller(threading.Thread):
       self.join()
 
   def wakeup(self):
-    os.write(self._pipe[1], 'x')
+    try:
+      os.write(self._pipe[1], 'x')
+    except OSError, e:
+      # A full pipe already guarantees a wakeup.
+      if e.errno != errno.EAGAIN:
+        raise
+
+  def modify(self, socket, direction=None):
+    '''Watch ``socket`` for ``direction`` events; by default, for those
+    returned by ``socket.events()`` when the change is applied.'''
+    if self._in_loop():
+      if socket.zmq() in self._sockets:
+        self._poller.register(socket.zmq(), socket.events() if direction is None else direction)
+      return
 
-  def modify(self, socket, direction):
     with self._lock:
       self._to_mod.append((socket, direction))
       self.wakeup()
 
   def add(self, socket, direction):
     util.log_info('Add %s', socket.zmq())
+    if self._in_loop():
+      self._sockets[socket.zmq()] = socket
+      self._poller.register(socket.zmq(), direction)
+      return
+
     with self._lock:
       self._to_add.append((socket, direction))
       self.wakeup()
 
   def remove(self, socket):
+    if self._in_loop():
+      self._unregister(socket)
+      return
+
     with self._lock:
-      assert socket.zmq() in self._sockets
       self._to_del.append(socket)
       self.wakeup()
 
 
+class PollerPool(object):
+  '''A set of `ZMQPoller` threads.
+
+  Each socket is assigned to one poller for its lifetime, either by
+  hashing the socket (``hash``) or by picking the poller with the fewest
+  sockets (``least_loaded``).  Every poller has its own lock and wakeup
+  pipe, so sockets on different pollers are serviced in parallel.
+  '''
+  def __init__(self, num_threads=1, assignment='least_loaded'):
+    assert num_threads >= 1
+    assert assignment in ('hash', 'least_loaded'), assignment
+    self._assignment = assignment
+    self._lock = threading.Lock()
+    self._pollers = []
+    for i in range(num_threads):
+      name = 'zmq.PollingThread' if num_threads == 1 else 'zmq.PollingThread-%d' % i
+      p = ZMQPoller(name=name)
+      p.start()
+      self._pollers.append(p)
+
+  def __len__(self):
+    return len(self._pollers)
+
+  def shard(self, idx):
+    return self._pollers[idx]
+
+  def assign(self, socket):
+    'Choose the poller which will service ``socket``.'
+    with self._lock:
+      if self._assignment == 'hash':
+        p = self._pollers[(id(socket) >> 4) % len(self._pollers)]
+      else:
+        p = min(self._pollers, key=lambda p: p.load)
+      with p._lock:
+        p.load += 1
+      return p
+
+  def stop(self):
+    for p in self._pollers:
+      p.stop()
+
+
 def shutdown():
-  poller().stop()
+  if POLLER is not None:
+    POLLER.stop()
 
 
 import atexit
 atexit.register(shutdown)
 
 def server_socket(addr):
-  host, port = addr
-  return ServerSocket(zmq.Context.instance(), zmq.ROUTER, (host, port))
-
-
-def client_socket(addr):
-  host, port = addr
-  return Socket(zmq.Context.instance(), zmq.DEALER, (host, port))
+  '''A server socket listening on ``addr``.
+
+  :param addr: ``(host, port)``, or a ``tcp://``, ``ipc://`` or
+    ``inproc://`` URL (see `parse_address`).
+  '''
+  return ServerSocket(zmq.Context.instance(), zmq.ROUTER, parse_address(addr))
+
+
+def client_socket(addr, prefer_ipc=None):
+  '''A client socket connected to the server at ``addr``.
+
+  :param prefer_ipc: connect through the server's ipc:// alias instead of
+    tcp if the server is on this machine and the alias exists.  Defaults
+    to ``config.prefer_ipc``.
+  '''
+  addr = parse_address(addr)
+  if prefer_ipc is None:
+    prefer_ipc = config.prefer_ipc
+  if prefer_ipc and isinstance(addr, tuple) and is_local_host(addr[0]):
+    alias = ipc_alias(*addr)
+    if os.path.exists(alias[len('ipc://'):]):
+      addr = alias
+  return Socket(zmq.Context.instance(), zmq.DEALER, addr)
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+import logging
+import sys
+logging.basicConfig(level=logging.DEBUG, stream=sys.stderr)
+
+import threading
+import time
+import unittest
+
+import speedy
+from speedy import zeromq
+
+try:
+  from speedy import aio
+  from trollius import From, Return
+except ImportError:
+  aio = None
+
+
+class Ping(object):
+  def __init__(self, ping):
+    self.ping = ping
+
+
+if aio is not None:
+  asyncio = aio.asyncio
+
+  class AsyncEchoWorker(aio.AsyncServer):
+    def ping(self, handle, req):
+      return req.ping
+
+    @asyncio.coroutine
+    def slow_ping(self, handle, req):
+      yield From(asyncio.sleep(0.01, loop=self._loop))
+      raise Return(req.ping)
+
+    @asyncio.coroutine
+    def bad_call(self, handle, req):
+      yield From(asyncio.sleep(0, loop=self._loop))
+      raise Exception('Bad!')
+
+    def count(self, handle, req):
+      for i in range(req):
+        yield i
+
+
+class StreamWorker(speedy.Server):
+  hung = []
+
+  def count(self, handle, req):
+    for i in range(req):
+      yield i
+
+  def hang(self, handle, req):
+    # never replies
+    self.hung.append(handle)
+
+
+@unittest.skipIf(aio is None, 'asyncio is not available')
+class AsyncTest(unittest.TestCase):
+  def setUp(self):
+    self.loop = asyncio.new_event_loop()
+    self.thread = threading.Thread(target=self.loop.run_forever)
+    self.thread.daemon = True
+    self.thread.start()
+    self.server = AsyncEchoWorker(zeromq.server_socket(('127.0.0.1', -1)), loop=self.loop)
+    self.server.serve_nonblock()
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.loop.call_soon_threadsafe(self.loop.stop)
+    self.thread.join()
+    self.loop.close()
+
+  def test_async_server(self):
+    with speedy.Client(zeromq.client_socket(self.server.addr)) as client:
+      self.assertEqual(client.ping(Ping('Hello!')).wait(), 'Hello!')
+      self.assertEqual(client.slow_ping(Ping('Hello!')).wait(), 'Hello!')
+      self.assertRaises(speedy.RemoteException, client.bad_call(Ping(1)).wait)
+      self.assertEqual(list(client.count.stream(5, window=2)), range(5))
+      self.assertEqual(client.count(5).wait(), range(5))
+
+  def test_async_client(self):
+    loop = asyncio.new_event_loop()
+    client = aio.AsyncClient(zeromq.client_socket(self.server.addr), loop=loop)
+
+    @asyncio.coroutine
+    def run():
+      futures = [client.slow_ping(Ping(i)) for i in range(100)]
+      results = yield From(asyncio.gather(*futures, loop=loop))
+      raise Return(results)
+
+    try:
+      self.assertEqual(loop.run_until_complete(run()), range(100))
+      self.assertRaises(speedy.RemoteException,
+                        loop.run_until_complete, client.bad_call(Ping(1)))
+    finally:
+      client.close()
+      loop.close()
+
+  def test_async_timeout(self):
+    server = StreamWorker(zeromq.server_socket(('127.0.0.1', -1)))
+    server.serve_nonblock()
+    loop = asyncio.new_event_loop()
+    client = aio.AsyncClient(zeromq.client_socket(server.addr), loop=loop)
+    try:
+      start = time.time()
+      self.assertRaises(speedy.DeadlineExceeded, loop.run_until_complete,
+                        client.hang(None, deadline=time.time() + 0.1))
+      self.assertLess(time.time() - start, 1)
+      self.assertEqual(len(client._futures), 0)
+    finally:
+      client.close()
+      loop.close()
+      for handle in server.hung:
+        handle.done()
+      server.shutdown()
+
+  def test_async_stream(self):
+    server = StreamWorker(zeromq.server_socket(('127.0.0.1', -1)))
+    server.serve_nonblock()
+    loop = asyncio.new_event_loop()
+    client = aio.AsyncClient(zeromq.client_socket(server.addr), loop=loop)
+
+    @asyncio.coroutine
+    def run():
+      stream = client.count.stream(50, window=4)
+      chunks = []
+      while True:
+        try:
+          chunks.append((yield From(stream.next_chunk())))
+        except aio.StopAsyncIteration:
+          raise Return(chunks)
+
+    try:
+      self.assertEqual(loop.run_until_complete(run()), range(50))
+    finally:
+      client.close()
+      loop.close()
+      server.shutdown()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,9 +1,11 @@
 #!/usr/bin/env python
 
+import cStringIO
 import logging
 import sys
 logging.basicConfig(level=logging.DEBUG, stream=sys.stderr)
 
+import os
 import time
 import threading
 import unittest
@@ -12,6 +14,7 @@ import signal
 import numpy as N
 import speedy
 from speedy import zeromq, wait_for_all, util
+from speedy.batch import batched
 from numpy.random import randn
 
 
@@ -58,6 +61,116 @@ class EchoWorker(speedy.Server):
   def bad_call(self, handle, req):
     raise Exception, 'Bad!'
 
+  def sleep(self, handle, req):
+    threading.Timer(req, handle.done).start()
+
+  def block(self, handle, req):
+    # holds up the polling thread
+    time.sleep(req)
+    handle.done()
+
+  def remaining(self, handle, req):
+    handle.done(handle.remaining())
+
+  def count(self, handle, req):
+    try:
+      for i in range(req):
+        self.produced = i + 1
+        yield i
+    finally:
+      self.stream_closed = True
+
+  def thread_count(self, handle, req):
+    def produce():
+      for i in range(req):
+        handle.send_partial(i)
+      handle.done()
+    threading.Thread(target=produce).start()
+
+  def fill_after_reply(self, handle, req):
+    # the reply must not change with the array it was made from
+    out = N.zeros(req, dtype=N.int64)
+    handle.done(out)
+    out[:] = -1
+
+  def checksum(self, handle, req):
+    handle.done((req[0].sum(), req[1]))
+
+  def bad_count(self, handle, req):
+    yield 0
+    raise Exception, 'Bad!'
+
+class ProcessWorker(EchoWorker):
+  def pid(self, handle, req):
+    handle.done(os.getpid())
+
+  def sum(self, handle, req):
+    handle.done(req.sum())
+
+class SlowWorker(EchoWorker):
+  def __init__(self, *args, **kw):
+    EchoWorker.__init__(self, *args, **kw)
+    self.timers = []
+
+  def ping(self, handle, req):
+    t = threading.Timer(1, EchoWorker.ping, (self, handle, req))
+    self.timers.append(t)
+    t.start()
+
+  def shutdown(self):
+    # reply to what is still waiting now, while the socket is open.
+    for t in self.timers:
+      t.cancel()
+      t.join()
+      handle = t.args[1]
+      if not handle.finished:
+        handle.done()
+    EchoWorker.shutdown(self)
+
+class StallWorker(EchoWorker):
+  'Holds on to pings, unanswered, while ``stalled`` is set.'
+  def __init__(self, *args, **kw):
+    EchoWorker.__init__(self, *args, **kw)
+    self.stalled = False
+    self.held = []
+
+  def ping(self, handle, req):
+    if self.stalled:
+      self.held.append((handle, req))
+    else:
+      EchoWorker.ping(self, handle, req)
+
+  def shutdown(self):
+    for handle, req in self.held:
+      EchoWorker.ping(self, handle, req)
+    EchoWorker.shutdown(self)
+
+class CollectiveWorker(speedy.Server):
+  def double(self, handle, req):
+    handle.done(req * 2)
+
+  def store(self, handle, req):
+    self.value = req
+    handle.done()
+
+class BatchWorker(speedy.Server):
+  batches = []
+  threads = []
+
+  @batched(max_batch=4, max_delay=0.01)
+  def square(self, reqs):
+    self.batches.append(len(reqs))
+    self.threads.append(threading.current_thread().name)
+    return [r * r for r in reqs]
+
+  @batched(max_batch=8, stack=True)
+  def total(self, reqs):
+    return reqs.sum(axis=1)
+
+  @batched()
+  def broken(self, reqs):
+    return reqs[1:]
+
 class PingWorker(threading.Thread):
   def __init__(self, addr):
     threading.Thread.__init__(self)
@@ -77,6 +190,104 @@ class PingWorker(threading.Thread):
     #  assert N.all(r.pong == content)
     self.client.close()
 
+class PendingTableTest(unittest.TestCase):
+  def test_collisions(self):
+    table = speedy.PendingTable(capacity=4)
+    futures = [speedy.Future(None, rpc_id) for rpc_id in range(1, 11)]
+    for f in futures:
+      table[f.rpc_id] = f
+    self.assertEqual(len(table), 10)
+    for f in futures:
+      self.assertIs(table[f.rpc_id], f)
+
+    self.assertIs(table.pop(3), futures[2])
+    self.assertIsNone(table.pop(3))
+    self.assertNotIn(3, table)
+    self.assertEqual(len(table), 9)
+
+  def test_timed_out_evicted(self):
+    table = speedy.PendingTable(capacity=4)
+    stale = speedy.Future(None, 1)
+    stale._deadline = 0
+    table[1] = stale
+    table[5] = speedy.Future(None, 5)
+    self.assertNotIn(1, table)
+    self.assertEqual(len(table), 1)
+    self.assertEqual(len(table._table[0]), 4)
+
+  def test_get_while_growing(self):
+    first = speedy.Future(None, 1)
+    tables = []
+    missed = []
+    done = []
+    def new_table():
+      table = speedy.PendingTable(capacity=1)
+      table[1] = first
+      tables.append(table)
+      return table
+    def reader():
+      while not done:
+        if tables[-1].get(1) is not first:
+          missed.append(1)
+    new_table()
+    t = threading.Thread(target=reader)
+    # switch threads as often as possible
+    interval = sys.getcheckinterval()
+    sys.setcheckinterval(1)
+    t.start()
+    try:
+      for i in range(1000):
+        table = new_table()
+        for rpc_id in range(2, 64):
+          table[rpc_id] = speedy.Future(None, rpc_id)
+    finally:
+      done.append(1)
+      t.join()
+      sys.setcheckinterval(interval)
+    self.assertEqual(missed, [])
+
+
+class FutureTest(unittest.TestCase):
+  def test_set_result_twice(self):
+    f = speedy.Future(None, 1)
+    results = []
+    f._add_listener(lambda f: results.append(f.result))
+    f._set_result(1)
+    f._set_result(2)
+    self.assertEqual(f.wait(), 1)
+    self.assertEqual(results, [1])
+
+
+class AdmissionTest(unittest.TestCase):
+  def test_fair_queuing(self):
+    from speedy import admission
+    a = admission.Admission(None, max_inflight=1, max_queue=100)
+    a.priorities['ping'] = admission.HIGH
+    self.assertEqual(a.submit('bulk', 'a0', 'a'), admission.RUN)
+    for i in range(1, 5):
+      self.assertEqual(a.submit('bulk', 'a%d' % i, 'a'), admission.QUEUED)
+    for i in range(1, 3):
+      a.submit('bulk', 'b%d' % i, 'b')
+    a.submit('ping', 'ping', 'c')
+
+    order = []
+    for i in range(7):
+      a.release('bulk')
+      order.append(a.next())
+    self.assertEqual(order, ['ping', 'a1', 'b1', 'a2', 'b2', 'a3', 'a4'])
+    self.assertIsNone(a.next())
+
+  def test_reserved(self):
+    from speedy import admission
+    a = admission.Admission(None, max_inflight=2, max_queue=0, reserved=1)
+    a.priorities['ping'] = admission.HIGH
+    self.assertEqual(a.submit('bulk', 1), admission.RUN)
+    self.assertEqual(a.submit('bulk', 2), admission.REJECTED)
+    self.assertEqual(a.submit('ping', 3), admission.RUN)
+    # the queue limit does not apply to high priority requests
+    self.assertEqual(a.submit('ping', 4), admission.QUEUED)
+
+
 class RPCTest(unittest.TestCase):
   def setUp(self):
     util.log_info('HERE')
@@ -114,6 +325,84 @@ class RPCTest(unittest.TestCase):
           ping_req.wait()
   #      self.assertEqual(ping_req.wait(), Pong(pong=big_str))
 
+  def test_big_array(self):
+    with self._connect() as proxy:
+      c_order = randn(500, 300)
+      f_order = N.asfortranarray(randn(300, 200))
+      strided = randn(200, 200)[::2]
+      big_str = 'x' * (1 << 20)
+      req = Ping(ping=(c_order, f_order, strided, big_str, c_order))
+      pong = proxy.ping(req).wait().pong
+      util.Assert.all_eq(pong[0], c_order)
+      util.Assert.all_eq(pong[1], f_order)
+      util.Assert.all_eq(pong[2], strided)
+      self.assertEqual(pong[3], big_str)
+      self.assertTrue(pong[1].flags.f_contiguous)
+
+  def test_structured_array(self):
+    with self._connect() as proxy:
+      records = N.zeros(4096, dtype=[('a', '<i4'), ('b', '<f8')])
+      records['a'] = N.arange(4096)
+      records['b'] = randn(4096)
+      pong = proxy.ping(Ping(ping=records)).wait().pong
+      self.assertEqual(pong.dtype, records.dtype)
+      util.Assert.all_eq(pong['a'], records['a'])
+      util.Assert.all_eq(pong['b'], records['b'])
+
+  def test_oob_copy(self):
+    with self._connect() as proxy:
+      for i in range(50):
+        big = N.zeros(1 << 16, dtype=N.int64)
+        f = proxy.ping(Ping(ping=big))
+        big[:] = i + 1
+        self.assertEqual(f.wait().pong.sum(), 0)
+        self.assertEqual(proxy.fill_after_reply(1 << 16).wait().sum(), 0)
+
+  def test_legacy_header(self):
+    client = speedy.Client(zeromq.client_socket(self.server.addr), wire_format='pickle')
+    with client as proxy:
+      self.assertEqual(proxy.ping(Ping(ping='Hello!')).wait().pong, 'Hello!')
+      big = randn(100, 100)
+      util.Assert.all_eq(proxy.ping(Ping(ping=big)).wait().pong, big)
+
+  def test_legacy_peer(self):
+    # peers from before out of band buffers read exactly one frame
+    import cPickle, zmq
+    ctx = zmq.Context.instance()
+    big = randn(100, 100)
+
+    old_client = ctx.socket(zmq.DEALER)
+    old_client.connect('tcp://%s:%d' % self.server.addr)
+    old_client.send(cPickle.dumps({ 'rpc_id' : 1, 'method' : 'ping' }, -1) +
+                    cPickle.dumps(Ping(ping=big), -1))
+    self.assertTrue(old_client.poll(5000))
+    frames = old_client.recv_multipart()
+    old_client.close()
+    self.assertEqual(len(frames), 1)
+    reader = cStringIO.StringIO(frames[0])
+    self.assertEqual(cPickle.load(reader)['rpc_id'], 1)
+    util.Assert.all_eq(cPickle.load(reader).pong, big)
+
+    old_server = ctx.socket(zmq.ROUTER)
+    port = old_server.bind_to_random_port('tcp://127.0.0.1')
+    def serve():
+      frames = old_server.recv_multipart()
+      if len(frames) == 2:
+        reader = cStringIO.StringIO(frames[1])
+        header = cPickle.load(reader)
+        reply = Pong(pong=cPickle.load(reader).ping)
+        old_server.send_multipart([frames[0], cPickle.dumps({ 'rpc_id' : header['rpc_id'] }, -1) +
+                                              cPickle.dumps(reply, -1)])
+    t = threading.Thread(target=serve)
+    t.start()
+    client = speedy.Client(zeromq.client_socket(('127.0.0.1', port)), wire_format='pickle')
+    try:
+      util.Assert.all_eq(client.ping(Ping(ping=big), deadline=time.time() + 5).wait().pong, big)
+    finally:
+      t.join(5)
+      client.close()
+      old_server.close()
+
   def test_threads(self):
     with self._connect() as proxy:
       ping_req = Ping(ping='Hello!')
@@ -154,6 +443,621 @@ class RPCTest(unittest.TestCase):
     for w in workers: w.start()
     for w in workers: w.join()
 
+  def test_poller_pool(self):
+    pool = zeromq.PollerPool(4, 'least_loaded')
+    old, zeromq.POLLER = zeromq.POLLER, pool
+    try:
+      servers = [EchoWorker(zeromq.server_socket(('127.0.0.1', -1))) for i in range(4)]
+      for s in servers: s.serve_nonblock()
+      clients = [speedy.Client(zeromq.client_socket(s.addr)) for s in servers]
+      self.assertEqual([p.load for p in pool._pollers], [2, 2, 2, 2])
+
+      futures = [c.ping(Ping(ping=i)) for i, c in enumerate(clients)]
+      self.assertEqual([f.wait().pong for f in futures], range(4))
+
+      for c in clients: c.close()
+      for s in servers: s.shutdown()
+    finally:
+      zeromq.POLLER = old
+      pool.stop()
+
+  def test_process_pool(self):
+    server = ProcessWorker(zeromq.server_socket(('127.0.0.1', -1)), process_pool=2)
+    server.serve_nonblock()
+    try:
+      with speedy.Client(zeromq.client_socket(server.addr)) as proxy:
+        pids = wait_for_all([proxy.pid() for i in range(20)])
+        self.assertNotIn(os.getpid(), pids)
+
+        big = randn(1000, 1000)
+        sums = wait_for_all([proxy.sum(big) for i in range(10)])
+        self.assertEqual(sums, [big.sum()] * 10)
+
+        self.assertRaises(speedy.RemoteException, proxy.bad_call(Ping(1)).wait)
+
+        self.assertEqual(proxy.count(5).wait(), range(5))
+        self.assertRaises(speedy.RemoteException, proxy.count.stream(5).wait)
+        self.assertEqual(server._streams, {})
+    finally:
+      server.shutdown()
+
+  def test_stats(self):
+    with self._connect() as proxy:
+      wait_for_all([proxy.ping(Ping(ping=i)) for i in range(10)])
+      try:
+        proxy.bad_call(Ping(1)).wait()
+      except speedy.RemoteException:
+        pass
+
+      local = proxy.local_stats()
+      self.assertEqual(local['ping']['calls'], 10)
+      self.assertEqual(local['ping']['latency']['count'], 10)
+      self.assertEqual(local['bad_call']['errors'], 1)
+      self.assertGreater(local['ping']['bytes_out'], 0)
+
+      remote = proxy._stats().wait()
+      self.assertEqual(remote['ping']['calls'], 10)
+      self.assertEqual(remote['ping']['handler_time']['count'], 10)
+      self.assertEqual(remote['bad_call']['errors'], 1)
+      self.assertEqual(remote['ping']['bytes_in'], local['ping']['bytes_out'])
+
+  def test_deadlines(self):
+    with self._connect() as proxy:
+      speedy.config.send_deadlines = False
+      try:
+        self.assertIsNone(proxy.remaining().wait())
+      finally:
+        speedy.config.send_deadlines = True
+      left = proxy.remaining(deadline=time.time() + 5).wait()
+      self.assertTrue(4 < left <= 5, left)
+
+      blocked = proxy.block(0.2)
+      f = proxy.ping(Ping(ping=1), deadline=time.time() + 0.05)
+      blocked.wait()
+      while not f.have_result:
+        time.sleep(0.01)
+      self.assertIsInstance(f.result, speedy.ExpiredRequest)
+      self.assertRaises(speedy.DeadlineExceeded, f.wait)
+      self.assertEqual(proxy._stats().wait()['ping']['expired'], 1)
+
+  def test_admission(self):
+    from speedy import config
+    saved = (config.server_max_inflight, config.server_max_queue, config.server_overload_policy,
+             config.server_reserved_inflight)
+    config.server_max_inflight, config.server_max_queue = 2, 2
+    servers = []
+    try:
+      for policy in ('reject', 'pause'):
+        config.server_overload_policy = policy
+        server = EchoWorker(zeromq.server_socket(('127.0.0.1', -1)))
+        server.serve_nonblock()
+        servers.append(server)
+        with speedy.Client(zeromq.client_socket(server.addr)) as proxy:
+          futures = [proxy.sleep(0.1) for i in range(6)]
+          if policy == 'reject':
+            for f in futures[4:]:
+              self.assertRaises(speedy.ServerOverloaded, f.wait)
+            futures = futures[:4]
+          wait_for_all(futures)
+          admission = proxy._stats().wait()['_admission']
+          self.assertEqual(admission['inflight'], 1)  # the _stats call
+          if policy == 'reject':
+            self.assertEqual(admission['rejected'], 2)
+            self.assertEqual(admission['peak_queued'], 2)
+          else:
+            self.assertEqual(admission['pauses'], 1)
+            self.assertFalse(admission['paused'])
+
+      # control RPCs are not held up by a saturated data plane
+      config.server_overload_policy = 'reject'
+      config.server_reserved_inflight = 1
+      server = EchoWorker(zeromq.server_socket(('127.0.0.1', -1)))
+      server.serve_nonblock()
+      servers.append(server)
+      with speedy.Client(zeromq.client_socket(server.addr)) as proxy:
+        futures = [proxy.sleep(0.5) for i in range(3)]
+        proxy._stats().wait()
+        # ... it did not wait for any of them
+        self.assertFalse(any(f.have_result for f in futures))
+        wait_for_all(futures)
+
+      # per method limits
+      config.server_max_inflight = 0
+      self.server.limit('sleep', 1)
+      with self._connect() as proxy:
+        st = time.time()
+        futures = [proxy.sleep(0.2) for i in range(3)]
+        self.assertEqual(proxy.ping(Ping(ping=1)).wait().pong, 1)
+        # other methods are not limited ...
+        self.assertFalse(any(f.have_result for f in futures))
+        wait_for_all(futures)
+        # ... but these ran one at a time
+        self.assertGreaterEqual(time.time() - st, 0.6)
+    finally:
+      (config.server_max_inflight, config.server_max_queue, config.server_overload_policy,
+       config.server_reserved_inflight) = saved
+      for s in servers:
+        s.shutdown()
+
+  def test_batched(self):
+    server = BatchWorker(zeromq.server_socket(('127.0.0.1', -1)))
+    server.serve_nonblock()
+    try:
+      with speedy.Client(zeromq.client_socket(server.addr)) as proxy:
+        self.assertEqual(wait_for_all([proxy.square(i) for i in range(10)]),
+                         [i * i for i in range(10)])
+        self.assertEqual(sum(server.batches), 10)
+        self.assertEqual(max(server.batches), 4)
+        self.assertLess(len(server.batches), 10)
+        # the last, partial batch did not run on the shared timer thread
+        self.assertNotIn('speedy.Timer', server.threads)
+
+        arrays = [N.arange(3) + i for i in range(5)]
+        self.assertEqual(wait_for_all([proxy.total(a) for a in arrays]),
+                         [a.sum() for a in arrays])
+        self.assertRaises(speedy.RemoteException, proxy.broken(1).wait)
+    finally:
+      server.shutdown()
+
+  def test_batched_process_pool(self):
+    from speedy import timer
+    # the timer thread is running in the parent when the workers fork
+    timer.schedule(0, lambda: None)
+    server = BatchWorker(zeromq.server_socket(('127.0.0.1', -1)), process_pool=1)
+    server.serve_nonblock()
+    try:
+      with speedy.Client(zeromq.client_socket(server.addr)) as proxy:
+        # a partial batch, flushed by its delay in the worker
+        self.assertEqual(proxy.square(3, deadline=time.time() + 5).wait(), 9)
+        self.assertEqual(wait_for_all([proxy.square(i) for i in range(6)]),
+                         [i * i for i in range(6)])
+    finally:
+      server.shutdown()
+
+  def test_stream(self):
+    with self._connect() as proxy:
+      self.assertEqual(list(proxy.count.stream(100, window=4)), range(100))
+      self.assertEqual(proxy.thread_count.stream(100, window=4).wait(), range(100))
+      # not streamed: the chunks come back as a list
+      self.assertEqual(proxy.count(5).wait(), range(5))
+      self.assertEqual(proxy.thread_count(5).wait(), range(5))
+
+      stream = proxy.bad_count.stream()
+      self.assertEqual(stream.next(), 0)
+      self.assertRaises(speedy.RemoteException, stream.next)
+
+      # a slow consumer holds the producer back
+      self.server.stream_closed = False
+      with proxy.count.stream(1000, window=4) as stream:
+        self.assertEqual([stream.next() for i in range(2)], [0, 1])
+        time.sleep(0.05)
+        self.assertLessEqual(self.server.produced, 7)
+      time.sleep(0.05)
+      self.assertTrue(self.server.stream_closed)
+      self.assertLess(self.server.produced, 10)
+      self.assertEqual(self.server._streams, {})
+
+  def test_upload(self):
+    with self._connect() as proxy:
+      self.assertEqual(proxy.ping.upload(Ping(ping=1)).wait().pong, 1)
+
+      big = randn(4 << 20)
+      upload = proxy.checksum.upload((big, 'x' * 100000), chunk_size=1 << 18, window=2)
+      # small calls are not held up behind the upload
+      self.assertEqual(proxy.ping(Ping(ping=2)).wait().pong, 2)
+      self.assertFalse(upload.have_result)
+      self.assertEqual(upload.wait(), (big.sum(), 'x' * 100000))
+
+      remote = proxy._stats().wait()
+      self.assertGreater(remote['checksum']['bytes_in'], big.nbytes)
+
+  def test_upload_abandoned(self):
+    from speedy import common, config
+    timeout, send_chunks = config.upload_timeout, common.Upload._send_chunks
+    # the client sends the start of the upload, then nothing
+    config.upload_timeout = 0.1
+    common.Upload._send_chunks = lambda self: None
+    try:
+      with self._connect() as proxy:
+        upload = proxy.checksum.upload((randn(1 << 16), 'x'), chunk_size=1 << 16)
+        self.assertRaises(speedy.RemoteException, upload.wait)
+        self.assertEqual(self.server._uploads, {})
+
+        upload = proxy.checksum.upload((randn(1 << 16), 'x'), chunk_size=1 << 16,
+                                       deadline=time.time() + 0.05)
+        config.upload_timeout = 100
+        self.assertRaises(speedy.DeadlineExceeded, upload.wait)
+        self.assertEqual(self.server._uploads, {})
+    finally:
+      config.upload_timeout, common.Upload._send_chunks = timeout, send_chunks
+
+  def test_upload_bad_sizes(self):
+    import cPickle
+    from speedy import common, wire
+    with self._connect() as proxy:
+      for sizes in ([-1], [1 << 50], ['x'], 3):
+        # the start of an upload, with no chunks to follow
+        rpc_id = proxy._rpc_ids.next() & common.RPC_ID_MASK
+        f = proxy._futures[rpc_id] = common.Upload(proxy, rpc_id, [], 1, 1)
+        header = wire.Header(rpc_id, 'checksum', flags=wire.FLAG_UPLOAD,
+                             format=proxy._wire_format)
+        proxy.checksum.socket.send(common.encode_message(header, cPickle.dumps(sizes, -1), []))
+        self.assertRaises(speedy.RemoteException, f.wait)
+        self.assertEqual(self.server._uploads, {})
+      # the server is still answering
+      self.assertEqual(proxy.ping(Ping(ping=1)).wait().pong, 1)
+
+  def test_coalesce(self):
+    from speedy import config
+    config.coalesce_writes = True
+    try:
+      server = EchoWorker(zeromq.server_socket(('127.0.0.1', -1)))
+      server.serve_nonblock()
+      proxy = speedy.Client(zeromq.client_socket(server.addr))
+    finally:
+      config.coalesce_writes = False
+
+    try:
+      big = N.arange(100000)
+      futures = [proxy.ping(Ping(ping=i if i % 10 else big)) for i in range(500)]
+      results = wait_for_all(futures)
+      for i, r in enumerate(results):
+        if i % 10:
+          self.assertEqual(r.pong, i)
+        else:
+          self.assertTrue(N.all(r.pong == big))
+    finally:
+      proxy.close()
+      server.shutdown()
+
+  def test_shm(self):
+    from speedy import config, shm
+    server = EchoWorker(shm.shm_server_socket())
+    server.serve_nonblock()
+    proxy = speedy.Client(shm.shm_client_socket(server.addr))
+    ring_size = config.shm_ring_size
+    try:
+      big = N.arange(1000000)
+      self.assertTrue(N.all(proxy.ping(Ping(ping=big)).wait().pong == big))
+      self.assertRaises(speedy.RemoteException, proxy.bad_call(Ping(1)).wait)
+
+      # more data in flight than fits in the rings
+      config.shm_ring_size = 64 * 1024
+      small = speedy.Client(shm.shm_client_socket(server.addr))
+      futures = [small.ping(Ping(ping='x' * (i % 5000))) for i in range(1000)]
+      for i, r in enumerate(wait_for_all(futures)):
+        self.assertEqual(r.pong, 'x' * (i % 5000))
+      small.close()
+    finally:
+      config.shm_ring_size = ring_size
+      proxy.close()
+      server.shutdown()
+
+  def test_shm_handshake(self):
+    import shutil, socket, tempfile
+    from speedy import shm
+    server = EchoWorker(shm.shm_server_socket())
+    server.serve_nonblock()
+    tmp = tempfile.mkdtemp()
+    victims = [os.path.join(tmp, 'speedy-ring-%d' % i) for i in range(2)]
+    for path in victims:
+      open(path, 'w').write('x' * 4096)
+    try:
+      # a silent client doesn't hold up the others
+      silent = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      silent.connect(server.addr)
+
+      # rings outside of the shm directory are refused, and left alone
+      bad = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      bad.connect(server.addr)
+      bad.sendall('%s %s %s\n' % (shm.HANDSHAKE, victims[0], victims[1]))
+      self.assertEqual(bad.recv(1), '')
+
+      proxy = speedy.Client(shm.shm_client_socket(server.addr))
+      self.assertEqual(proxy.ping(Ping(ping=1)).wait().pong, 1)
+      self.assertTrue(all(os.path.exists(path) for path in victims))
+      proxy.close()
+      silent.close()
+      bad.close()
+    finally:
+      shutil.rmtree(tmp)
+      server.shutdown()
+
+  def test_transports(self):
+    for addr in ('tcp://127.0.0.1:*', 'ipc://', 'inproc://speedy-test'):
+      server = EchoWorker(zeromq.server_socket(addr))
+      server.serve_nonblock()
+      try:
+        with speedy.Client(zeromq.client_socket(server.addr)) as proxy:
+          self.assertEqual(proxy.ping(Ping(ping=addr)).wait().pong, addr)
+      finally:
+        server.shutdown()
+
+  def test_prefer_ipc(self):
+    from speedy import config
+    config.server_ipc_alias = True
+    try:
+      a = EchoWorker(zeromq.server_socket(('127.0.0.1', -1)))
+      a.serve_nonblock()
+      # same port on another address
+      b = EchoWorker(zeromq.server_socket(('127.0.0.2', a.addr[1])))
+      b.serve_nonblock()
+    finally:
+      config.server_ipc_alias = False
+
+    try:
+      socket = zeromq.client_socket(a.addr, prefer_ipc=True)
+      self.assertEqual(socket.addr, zeromq.ipc_alias(*a.addr))
+      self.assertNotEqual(socket.addr, zeromq.ipc_alias(*b.addr))
+      with speedy.Client(socket) as proxy:
+        self.assertEqual(proxy.ping(Ping(ping=1)).wait().pong, 1)
+    finally:
+      b.shutdown()
+    try:
+      time.sleep(0.1)
+      self.assertTrue(os.path.exists(socket.addr[len('ipc://'):]))
+    finally:
+      a.shutdown()
+
+  def test_forall_tree(self):
+    servers = [EchoWorker(zeromq.server_socket(('127.0.0.1', -1))) for i in range(10)]
+    for s in servers:
+      s.serve_nonblock()
+    clients = [speedy.Client(zeromq.client_socket(s.addr)) for s in servers]
+    try:
+      big = N.arange(100000)
+      results = speedy.forall(clients, 'ping', Ping(ping=big), fanout=3).wait()
+      self.assertEqual(len(results), 10)
+      for r in results:
+        self.assertTrue(N.all(r.pong == big))
+
+      # only the roots of the 3 subtrees were sent the request
+      relayed = [c.local_stats().get('_relay', {}).get('calls', 0) for c in clients]
+      self.assertEqual(sum(relayed), 3)
+      # ... but every server ran it
+      for s in servers:
+        self.assertEqual(s._method_stats.snapshot()['_relay']['calls'], 1)
+
+      futures = speedy.forall(clients, 'bad_call', Ping(ping=1), fanout=2)
+      for f in futures:
+        self.assertRaises(speedy.RemoteException, f.wait)
+    finally:
+      for c in clients:
+        c.close()
+      for s in servers:
+        s.shutdown()
+
+  def test_forall_relay_pool(self):
+    # relayed requests are admitted, and run on the process pool, as others
+    servers = [ProcessWorker(zeromq.server_socket(('127.0.0.1', -1)), process_pool=1)
+               for i in range(3)]
+    for s in servers:
+      s._admission.max_inflight = 1
+      s._admission.max_queue = 0
+      s.serve_nonblock()
+    clients = [speedy.Client(zeromq.client_socket(s.addr)) for s in servers]
+    try:
+      pids = speedy.forall(clients, 'pid', None, fanout=1).wait()
+      self.assertEqual(len(pids), 3)
+      self.assertNotIn(os.getpid(), pids)
+
+      busy = clients[0].sleep(0.5)
+      time.sleep(0.1)
+      futures = speedy.forall(clients, 'pid', None, fanout=1)
+      self.assertRaises(speedy.ServerOverloaded, futures[0].wait)
+      self.assertNotIn(os.getpid(), [f.wait() for f in futures[1:]])
+      busy.wait()
+      self.assertRaises(speedy.RemoteException,
+                        speedy.forall(clients, 'missing', None, fanout=1)[2].wait)
+      for s in servers:
+        self.assertEqual(s._admission.inflight, 0)
+    finally:
+      for c in clients:
+        c.close()
+      for s in servers:
+        s.shutdown()
+
+  def test_collectives(self):
+    servers = [CollectiveWorker(zeromq.server_socket(('127.0.0.1', -1))) for i in range(4)]
+    for s in servers:
+      s.serve_nonblock()
+    clients = [speedy.Client(zeromq.client_socket(s.addr)) for s in servers]
+    try:
+      data = N.arange(100003, dtype=N.float64).reshape(-1, 1)
+      parts = speedy.scatter(clients, 'double', data)
+      self.assertTrue(N.all(speedy.gather(parts) == data * 2))
+
+      matrix = N.ones((4, 1000))
+      total = speedy.reduce(speedy.scatter(clients, 'double', matrix, axis=0))
+      self.assertTrue(N.all(total == 8))
+      self.assertEqual(speedy.reduce(speedy.scatter(clients, 'double', [1, 2, 3, 4]), max), 8)
+      # the same future twice counts twice
+      f = clients[0].double(1)
+      self.assertEqual(speedy.reduce([f, f, clients[1].double(2)]), 8)
+
+      total = speedy.allreduce(clients, 'double', N.ones(10), 'store', fanout=2)
+      self.assertTrue(N.all(total == 8))
+      for s in servers:
+        self.assertTrue(N.all(s.value == 8))
+    finally:
+      for c in clients:
+        c.close()
+      for s in servers:
+        s.shutdown()
+
+  def test_as_completed(self):
+    with self._connect() as proxy:
+      slow = proxy.sleep(0.5)
+      fast = [proxy.ping(Ping(ping=i)) for i in range(5)]
+      order = list(speedy.as_completed([slow] + fast))
+      self.assertEqual(len(order), 6)
+      self.assertIs(order[-1], slow)
+      other = proxy.sleep(0.5)
+      self.assertIn(speedy.wait_any([other, fast[0]]), fast)
+
+      late = proxy.sleep(0.5)
+      self.assertRaises(Exception, list, speedy.as_completed([late], timeout=0.05))
+      # don't leave the handlers to reply after shutdown
+      wait_for_all([other, late])
+
+  def test_callbacks(self):
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(2)
+    with self._connect() as proxy:
+      threads = []
+      done = threading.Event()
+      def callback(f):
+        threads.append(threading.current_thread())
+        done.set()
+      proxy.ping(Ping(ping=1)).add_done_callback(callback, executor=pool)
+      done.wait(5)
+      self.assertNotIn(threads[0], [zeromq.poller(), threading.current_thread()])
+
+      f = (proxy.ping(Ping(ping=1))
+           .then(lambda pong: proxy.ping(Ping(ping=pong.pong + 1)))
+           .then(lambda pong: pong.pong * 10))
+      self.assertEqual(f.wait(), 20)
+
+      self.assertRaises(speedy.RemoteException, proxy.ping(Ping(ping=1)).then(lambda pong: 1 / 0).wait)
+      self.assertRaises(speedy.RemoteException, proxy.bad_call(Ping(1)).then(lambda r: r).wait)
+    pool.close()
+    pool.join()
+
+  def test_cache(self):
+    with self._connect() as proxy:
+      proxy.cacheable('ping')
+      first = proxy.ping(Ping(ping=1))
+      self.assertIs(proxy.ping(Ping(ping=1)), first)
+      self.assertEqual(first.wait().pong, 1)
+      self.assertIs(proxy.ping(Ping(ping=1)), first)
+      self.assertIsNot(proxy.ping(Ping(ping=2)), first)
+
+      stats = proxy.local_stats()['ping']
+      self.assertEqual((stats['cache_hits'], stats['cache_misses']), (2, 2))
+      self.assertEqual(stats['calls'], 2)
+      self.assertEqual(proxy.cache_stats()['size'], 2)
+
+      proxy.cacheable('bad_call')
+      self.assertRaises(speedy.RemoteException, proxy.bad_call(Ping(1)).wait)
+      self.assertEqual(proxy.cache_stats()['size'], 2)
+
+      # large arrays are keyed on their contents
+      big = N.arange(1 << 16)
+      f = proxy.ping(Ping(ping=big))
+      self.assertIs(proxy.ping(Ping(ping=big.copy())), f)
+      other = proxy.ping(Ping(ping=big + 1))
+      self.assertIsNot(other, f)
+      wait_for_all([f, other])
+
+      # (a slow call, so that it is still in flight)
+      proxy.cacheable('sleep', ttl=0)
+      f = proxy.sleep(0.1)
+      self.assertIs(proxy.sleep(0.1), f)
+      f.wait()
+      g = proxy.sleep(0.1)
+      self.assertIsNot(g, f)
+      g.wait()
+
+  def test_pool_client(self):
+    from speedy import config
+    from speedy.pool import PoolClient
+    servers = [EchoWorker(zeromq.server_socket(('127.0.0.1', -1))) for i in range(3)]
+    for s in servers:
+      s.serve_nonblock()
+    # nothing listens on the last address
+    dead = servers[-1].addr
+    servers[-1].shutdown()
+
+    timeout = config.pool_eject_timeout
+    config.pool_eject_timeout = 0.2
+    try:
+      for policy in ('least_outstanding', 'p2c'):
+        with PoolClient([s.addr for s in servers[:2]], policy=policy) as pool:
+          results = wait_for_all([pool.ping(Ping(ping=i)) for i in range(100)])
+          self.assertEqual([r.pong for r in results], range(100))
+          self.assertTrue(all(r['calls'] > 0 for r in pool.stats()))
+
+      with PoolClient([servers[0].addr, dead]) as pool:
+        for i in range(10):
+          pool.ping(Ping(ping=i))
+        time.sleep(0.3)
+        results = wait_for_all([pool.ping(Ping(ping=i)) for i in range(10)])
+        self.assertEqual([r.pong for r in results], range(10))
+        self.assertEqual([r['ejections'] for r in pool.stats()], [0, 1])
+    finally:
+      config.pool_eject_timeout = timeout
+      for s in servers[:2]:
+        s.shutdown()
+
+  def test_pool_recovery(self):
+    from speedy import config
+    from speedy.pool import PoolClient
+    stall = StallWorker(zeromq.server_socket(('127.0.0.1', -1)))
+    stall.serve_nonblock()
+    timeout, period = config.pool_eject_timeout, config.pool_eject_period
+    config.pool_eject_timeout, config.pool_eject_period = 0.1, 0.2
+    try:
+      with PoolClient([stall.addr, self.server.addr], policy='least_outstanding') as pool:
+        stall.stalled = True
+        lost = pool.ping(Ping(ping=0))
+        time.sleep(0.15)
+        self.assertEqual(pool.ping(Ping(ping=1)).wait().pong, 1)
+        self.assertEqual([r['ejections'] for r in pool.stats()], [1, 0])
+        self.assertFalse(lost.have_result)
+
+        # back after the ejection period, with nothing outstanding
+        stall.stalled = False
+        time.sleep(0.25)
+        self.assertEqual([r['outstanding'] for r in pool.stats()], [0, 0])
+        calls = pool.replicas[0].calls
+        results = [pool.ping(Ping(ping=i)).wait() for i in range(10)]
+        self.assertEqual([r.pong for r in results], range(10))
+        self.assertGreater(pool.replicas[0].calls, calls)
+    finally:
+      config.pool_eject_timeout, config.pool_eject_period = timeout, period
+      stall.shutdown()
+
+  def test_hedge_and_retry(self):
+    from speedy.pool import PoolClient
+    slow = SlowWorker(zeromq.server_socket(('127.0.0.1', -1)))
+    slow.serve_nonblock()
+    server = EchoWorker(zeromq.server_socket(('127.0.0.1', -1)))
+    server.serve_nonblock()
+    dead = server.addr
+    server.shutdown()
+    try:
+      with PoolClient([slow.addr, self.server.addr], policy='least_outstanding') as pool:
+        self.assertRaises(ValueError, pool.ping, Ping(ping=1), hedge=0.01)
+        pool.idempotent('ping', retries=0, timeout=5)
+        st = time.time()
+        self.assertEqual(pool.ping(Ping(ping=1), hedge=0.05).wait().pong, 1)
+        # (the slow replica takes a second)
+        self.assertLess(time.time() - st, 0.9)
+        # the slow attempt was cancelled
+        self.assertEqual(len(pool.replicas[0].client._futures), 0)
+
+      with PoolClient([dead, self.server.addr], policy='least_outstanding') as pool:
+        pool.idempotent('ping', retries=1, timeout=0.1)
+        self.assertEqual(pool.ping(Ping(ping=2)).wait().pong, 2)
+        self.assertEqual([r.calls for r in pool.replicas], [1, 1])
+
+      with PoolClient([dead]) as pool:
+        pool.idempotent('ping', retries=1, timeout=0.05)
+        self.assertRaises(speedy.RemoteException, pool.ping(Ping(ping=3)).wait)
+        self.assertEqual(pool.replicas[0].calls, 2)
+    finally:
+      slow.shutdown()
+
+  def test_bench(self):
+    from speedy import bench
+    results = bench.run(latency_calls=10, throughput_calls=10, concurrency=(1, 4),
+                        sizes=(1024, 1 << 20), bandwidth_calls=2,
+                        workers=(1, 2), forall_size=1024, forall_calls=2)
+    self.assertEqual(results['latency']['count'], 10)
+    self.assertEqual([t['concurrency'] for t in results['throughput']], [1, 4])
+    self.assertEqual([b['bytes'] for b in results['bandwidth']], [1024, 1 << 20])
+    self.assertEqual([f['workers'] for f in results['forall']], [1, 2])
+
   def test_reponse(self):
     with self._connect() as proxy:
       content = "hello"